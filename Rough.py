@@ -16,11 +16,17 @@ Notes:
 import sys
 import re
 import textwrap
+import time
+
+from block_translator import BlockTranslator
+from program_cache import ProgramCache
 
 # ---------------------------
 # Utilities
 # ---------------------------
 
+MASK64 = (1 << 64) - 1
+
 def hexdump(buf: bytes, base_addr: int = 0):
     out_lines = []
     for i in range(0, len(buf), 16):
@@ -54,6 +60,30 @@ def is_reg(tok):
     tok = tok.upper()
     return tok.startswith('X') or tok.startswith('W') or tok in ('SP', 'XZR', 'PC')
 
+# Register operand text -> (regs key, read/write mask), resolved once per
+# spelling so register access does no string work. XZR maps to key None.
+_REG_CACHE = {}
+
+def resolve_reg(name: str):
+    entry = _REG_CACHE.get(name)
+    if entry is None:
+        upper = name.upper()
+        if upper.startswith('W'):
+            entry = ('X' + upper[1:], 0xffffffff)
+        elif upper == 'XZR':
+            entry = (None, MASK64)
+        else:
+            entry = (upper, MASK64)
+        _REG_CACHE[name] = entry
+    return entry
+
+# Register names the block translator handles directly; anything else
+# (PC, WZR, WSP, X31, ...) falls back to exec_instr.
+TRANSLATABLE_REG = re.compile(r'^(?:[XW](?:[0-9]|[12][0-9]|30)|SP|XZR)$')
+
+# execute() halts once more than this many steps have run
+STEP_LIMIT = 10000
+
 # ---------------------------
 # CPU State
 # ---------------------------
@@ -68,9 +98,10 @@ class CPU:
         self.stack_base = stack_base
         self.stack_size = stack_size
         self.stack = bytearray(stack_size)
-        # Flags
-        self.N = 0
-        self.Z = 0
+        # Flags: N and Z are derived on demand from the last flag-setting
+        # result and its width (1 -> N=0, Z=0)
+        self._flag_result = 1
+        self._flag_width = 64
         # Instruction storage (list of dicts)
         self.instructions = []  # list of {addr, text, mnemonic, operands}
         self.addr_to_idx = {}   # map address -> instruction index (for quick dispatch)
@@ -83,46 +114,51 @@ class CPU:
 
     # register read with W vs X handling:
     def read_reg(self, name: str):
-        name = name.upper()
-        if name.startswith('W'):
-            # read lower 32 bits
-            xname = 'X' + name[1:]
-            v = self.regs.get(xname, 0) & 0xffffffff
-            return v
-        if name == 'XZR':
+        key, mask = resolve_reg(name)
+        if key is None:
+            # XZR
             return 0
-        return self.regs.get(name, 0)
+        # W registers read the lower 32 bits
+        return self.regs.get(key, 0) & mask
 
     def write_reg(self, name: str, value: int):
-        name = name.upper()
-        # mask to 64 bits
-        value = value & ((1 << 64) - 1)
-        if name == 'XZR':
+        key, mask = resolve_reg(name)
+        if key is None:
             # Writes are ignored to XZR
             return
-        if name.startswith('W'):
-            # zero-extend 32-bit value to 64-bit
-            xname = 'X' + name[1:]
-            v32 = value & 0xffffffff
-            self.regs[xname] = v32  # upper 32 bits cleared by assign
-            return
-        # normal X register or SP or PC
-        if name in self.regs:
-            self.regs[name] = value
+        # W writes zero-extend the 32-bit value (upper 32 bits cleared by the mask)
+        if mask != MASK64 or key in self.regs or key.startswith('X'):
+            self.regs[key] = value & mask
         else:
-            # fall back to Xn mapping
-            if name.startswith('X'):
-                self.regs[name] = value
-            else:
-                raise KeyError(f"Unknown register {name}")
+            raise KeyError(f"Unknown register {key}")
 
     def set_flags_from_result(self, res: int, width_bits=64):
+        # Record only; N and Z are computed when a branch or dump reads them
+        self._flag_result = res
+        self._flag_width = width_bits
+
+    @property
+    def N(self):
         # N: MSB of result at width_bits
-        mask = (1 << width_bits) - 1
-        res_masked = res & mask
-        msb = (res_masked >> (width_bits - 1)) & 1
-        self.N = 1 if msb else 0
-        self.Z = 1 if res_masked == 0 else 0
+        width = self._flag_width
+        return (self._flag_result >> (width - 1)) & 1
+
+    @N.setter
+    def N(self, value):
+        self._set_nz(value, self.Z)
+
+    @property
+    def Z(self):
+        return 1 if self._flag_result & ((1 << self._flag_width) - 1) == 0 else 0
+
+    @Z.setter
+    def Z(self, value):
+        self._set_nz(self.N, value)
+
+    def _set_nz(self, n, z):
+        # pick a 64-bit result with the requested N and Z (N=1, Z=1 has none)
+        self._flag_result = (1 << 63 if n else 0) | (0 if z else 1)
+        self._flag_width = 64
 
     # Memory helpers: translate virtual address to stack offset
     def check_addr_in_stack(self, addr):
@@ -193,6 +229,9 @@ def preprocess_lines(lines):
 def parse_asm_file(path):
     with open(path, 'r') as f:
         raw_lines = f.readlines()
+    return parse_asm_lines(raw_lines)
+
+def parse_asm_lines(raw_lines):
     lines = preprocess_lines(raw_lines)
 
     # First pass: detect labels and build instruction list
@@ -219,10 +258,33 @@ def parse_asm_file(path):
         addr += 4
     return instructions, labels
 
+# Bump whenever decode_asm_file output changes, so stale cache entries miss
+DECODER_VERSION = 2
+
+def decode_asm_file(path, cache=None):
+    """
+    parse_asm_file plus the per-instruction operand split done by
+    load_instructions, returned as (entries, labels) where each entry is
+    (addr, text, mnemonic, operands). With a ProgramCache the result is
+    reused across runs.
+    """
+    with open(path, 'r') as f:
+        raw_lines = f.readlines()
+
+    def build():
+        instrs, labels = parse_asm_lines(raw_lines)
+        entries = [(it['addr'], it['text']) + tuple(parse_instruction_text(it['text']))
+                   for it in instrs]
+        return entries, labels
+
+    if cache is None:
+        return build()
+    return cache.get_or_build('rough', DECODER_VERSION, ''.join(raw_lines), build)
+
 def split_operands(opstr):
-    # Split operands by commas, but keep memory bracket as single operand.
-    # Simpler: split on comma, then strip.
-    parts = [p.strip() for p in opstr.split(',')]
+    # Split operands by commas, but keep memory bracket as single operand
+    # (commas inside [...] don't split)
+    parts = [p.strip() for p in re.split(r',(?![^\[]*\])', opstr)]
     return parts
 
 def parse_instruction_text(instr_text):
@@ -244,6 +306,7 @@ def parse_instruction_text(instr_text):
 class Emulator:
     def __init__(self, cpu: CPU):
         self.cpu = cpu
+        self.profiler = None  # optional profiler.Profiler, filled in by execute()
 
     def load_instructions(self, instrs, labels):
         # parse each text into mnemonic/operands and index mapping
@@ -255,6 +318,14 @@ class Emulator:
             self.cpu.addr_to_idx[it['addr']] = idx
         self.cpu.labels = labels
 
+    def load_decoded(self, entries, labels):
+        # same as load_instructions, from decode_asm_file output
+        self.cpu.instructions = []
+        for idx, (addr, text, mnem, ops) in enumerate(entries):
+            self.cpu.instructions.append({'addr': addr, 'text': text, 'mnemonic': mnem, 'operands': list(ops)})
+            self.cpu.addr_to_idx[addr] = idx
+        self.cpu.labels = dict(labels)
+
     def resolve_operand_value(self, op):
         # determine operand value for register or immediate
         op = op.strip()
@@ -277,37 +348,223 @@ class Emulator:
         except Exception:
             raise ValueError(f"Unknown operand form: {op}")
 
+    def _step(self):
+        """Executes the instruction at PC. Returns False when execution must halt."""
+        cpu = self.cpu
+        pc = cpu.regs['PC']
+        if pc not in cpu.addr_to_idx:
+            print(f"PC {pc} has no instruction mapped. Halting.")
+            return False
+        idx = cpu.addr_to_idx[pc]
+        instr = cpu.instructions[idx]
+        mnem = instr['mnemonic']
+        ops = instr['operands']
+        # trace line
+        cpu.trace.append(f"{pc:08x}: {instr['text']}")
+        # advance PC by default (4 bytes). Branches will override if needed.
+        cpu.regs['PC'] = pc + 4
+
+        # dispatch
+        try:
+            self.exec_instr(mnem, ops)
+        except Exception as e:
+            print(f"Error executing instruction at {pc:08x} '{instr['text']}': {e}")
+            cpu.running = False
+            return False
+        return True
+
     def execute(self):
         cpu = self.cpu
         cpu.running = True
+        if self.profiler is not None:
+            self._execute_profiled()
+            return
         # run loop
         step = 0
+        while cpu.running:
+            if not self._step():
+                break
+
+            step += 1
+            if step > STEP_LIMIT:
+                print("Exceeded step limit, halting to avoid infinite loop.")
+                break
+
+    def _execute_profiled(self):
+        # execute() with per-instruction counts and host time in self.profiler
+        cpu = self.cpu
+        prof = self.profiler
+        prof.reset([it['text'] for it in cpu.instructions],
+                   [it['mnemonic'] for it in cpu.instructions],
+                   [(it['mnemonic'] or '').startswith('B') for it in cpu.instructions],
+                   cpu.labels)
+        clock = time.perf_counter_ns
+        step = 0
+        while cpu.running:
+            pc = cpu.regs['PC']
+            idx = cpu.addr_to_idx.get(pc)
+            start = clock()
+            if not self._step():
+                break
+            if idx is not None:
+                prof.times[idx] += clock() - start
+                prof.counts[idx] += 1
+                if prof.is_branch[idx]:
+                    if cpu.regs['PC'] != pc + 4:
+                        prof.taken[idx] += 1
+                    else:
+                        prof.not_taken[idx] += 1
+
+            step += 1
+            if step > STEP_LIMIT:
+                print("Exceeded step limit, halting to avoid infinite loop.")
+                break
+
+    # ---------------------------
+    # Block translation engine
+    # ---------------------------
+
+    def _lower_reg(self, name, write=False):
+        # (key, mask) for a register the translator can access directly, else None
+        name = reg_normalize(name)
+        if not TRANSLATABLE_REG.match(name):
+            return None
+        if name == 'XZR':
+            return ('discard', None) if write else ('zero', None)
+        if name.startswith('W'):
+            return 'X' + name[1:], 0xffffffff
+        return name, MASK64
+
+    def _lower_src(self, op):
+        op = op.strip()
+        if is_reg(op):
+            reg = self._lower_reg(op)
+            if reg is None:
+                return None
+            return ('imm', 0) if reg[0] == 'zero' else ('reg',) + reg
+        try:
+            return ('imm', parse_imm(op))
+        except ValueError:
+            return None
+
+    def _lower_dst(self, op):
+        reg = self._lower_reg(op, write=True)
+        if reg is None:
+            return False
+        return None if reg[0] == 'discard' else reg
+
+    def _lower_instruction(self, instr):
+        """Lowers one loaded instruction to the block translator's IR."""
+        m = instr['mnemonic']
+        ops = instr['operands']
+        fallback = ('call', self.exec_instr, (m, ops))
+        if m in ('ADD', 'SUB', 'AND', 'EOR', 'MUL') and len(ops) == 3:
+            dst, src1, src2 = self._lower_dst(ops[0]), self._lower_src(reg_normalize(ops[1])), self._lower_src(ops[2])
+            if dst is False or src1 is None or src2 is None or src1[0] == 'imm' and not is_reg(ops[1]):
+                return fallback
+            sym = {'ADD': '+', 'SUB': '-', 'AND': '&', 'EOR': '^', 'MUL': '*'}[m]
+            return ('alu', sym, dst, src1, src2, False)
+        if m == 'MOV' and len(ops) == 2:
+            dst, src = self._lower_dst(ops[0]), self._lower_src(ops[1])
+            if dst is False or src is None:
+                return fallback
+            return ('mov', dst, src)
+        if m == 'CMP' and len(ops) == 2:
+            src1, src2 = self._lower_src(reg_normalize(ops[0])), self._lower_src(ops[1])
+            if src1 is None or src2 is None or src1[0] == 'imm' and not is_reg(ops[0]):
+                return fallback
+            return ('cmp', src1, src2)
+        if m in ('STR', 'STRB', 'LDR', 'LDRB') and len(ops) == 2:
+            mem = ops[1].strip()
+            if not (mem.startswith('[') and mem.endswith(']')):
+                return fallback
+            parts = [p.strip() for p in mem[1:-1].split(',')]
+            base = self._lower_src(parts[0])
+            if base is None or base[0] != 'reg' or len(parts) > 2:
+                return fallback
+            try:
+                offset = parse_imm(parts[1]) if len(parts) == 2 else 0
+            except ValueError:
+                return fallback
+            num_bytes = 1 if m.endswith('B') else 8
+            if m.startswith('STR'):
+                src = self._lower_src(reg_normalize(ops[0]))
+                if src is None:
+                    return fallback
+                return ('store', src, base, offset, num_bytes)
+            dst = self._lower_dst(ops[0])
+            if dst is False:
+                return fallback
+            return ('load', dst, base, offset, num_bytes)
+        if m in ('B', 'B.GT', 'B.LE') and len(ops) == 1:
+            target = ops[0].strip()
+            if target not in self.cpu.labels:
+                return fallback
+            cond = {'B': None, 'B.GT': 'GT', 'B.LE': 'LE'}[m]
+            return ('b', cond, self.cpu.labels[target], target)
+        if m == 'NOP':
+            return ('nop',)
+        if m == 'RET':
+            return ('ret',)
+        return fallback
+
+    def _make_translator(self):
+        cpu = self.cpu
+        leaders = {addr // 4 for addr in cpu.labels.values()}
+        for idx, instr in enumerate(cpu.instructions):
+            if instr['mnemonic'] in ('B', 'B.GT', 'B.LE'):
+                leaders.add(idx + 1)
+        return BlockTranslator(
+            [self._lower_instruction(instr) for instr in cpu.instructions],
+            [f"{instr['addr']:08x}: {instr['text']}" for instr in cpu.instructions],
+            leaders,
+            loads={8: 'S.read_mem64({addr})', 1: 'S.read_mem8({addr})'},
+            stores={8: 'S.write_mem64({addr}, {value})', 1: 'S.write_mem8({addr}, {value})'},
+            call_setup="R['PC'] = {next}",
+            call_next="R['PC']",
+            n_attr='N', z_attr='Z',
+            flag_result_attr='_flag_result', flag_width_attr='_flag_width',
+        )
+
+    def execute_translated(self):
+        """
+        Same as execute(), but runs whole basic blocks compiled by the
+        block translator. Trace, registers, flags and memory match execute().
+        """
+        cpu = self.cpu
+        translator = self._make_translator()
+        cpu.running = True
+        step = 0
         while cpu.running:
             pc = cpu.regs['PC']
             if pc not in cpu.addr_to_idx:
                 print(f"PC {pc} has no instruction mapped. Halting.")
                 break
-            idx = cpu.addr_to_idx[pc]
-            instr = cpu.instructions[idx]
-            mnem = instr['mnemonic']
-            ops = instr['operands']
-            # trace line
-            cpu.trace.append(f"{pc:08x}: {instr['text']}")
-            # advance PC by default (4 bytes). Branches will override if needed.
-            cpu.regs['PC'] = pc + 4
-
-            # dispatch
+            block = translator.block_at(pc)
+            if step + block.length > STEP_LIMIT:
+                # near the step limit: finish one instruction at a time
+                if not self._step():
+                    break
+                step += 1
+                if step > STEP_LIMIT:
+                    print("Exceeded step limit, halting to avoid infinite loop.")
+                    break
+                continue
+
             try:
-                self.exec_instr(mnem, ops)
+                next_pc = block.func(cpu)
             except Exception as e:
-                print(f"Error executing instruction at {pc:08x} '{instr['text']}': {e}")
+                done = translator.fault_offset
+                fault_pc = block.pcs[done]
+                cpu.trace.extend(block.texts[:done + 1])
+                cpu.regs['PC'] = fault_pc + 4
+                text = cpu.instructions[cpu.addr_to_idx[fault_pc]]['text']
+                print(f"Error executing instruction at {fault_pc:08x} '{text}': {e}")
                 cpu.running = False
                 break
-
-            step += 1
-            if step > 10000:
-                print("Exceeded step limit, halting to avoid infinite loop.")
-                break
+            cpu.trace.extend(block.texts)
+            cpu.regs['PC'] = next_pc
+            step += block.length
 
     def exec_instr(self, mnem, ops):
         cpu = self.cpu
@@ -485,11 +742,11 @@ class Emulator:
 # Main runner
 # ---------------------------
 
-def run_file(path):
-    instrs, labels = parse_asm_file(path)
+def run_file(path, cache=None):
+    entries, labels = decode_asm_file(path, cache)
     cpu = CPU(stack_size=256, stack_base=0x0)
     emu = Emulator(cpu)
-    emu.load_instructions(instrs, labels)
+    emu.load_decoded(entries, labels)
     # set PC start at 0
     cpu.regs['PC'] = 0
     print("Loaded program:")
@@ -521,7 +778,7 @@ def main():
         dump_test_file(path)
         print("No input supplied; writing small demo to test.asm")
     else:
-        run_file(sys.argv[1])
+        run_file(sys.argv[1], ProgramCache())
 
 if __name__ == '__main__':
     main()
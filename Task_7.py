@@ -1,26 +1,44 @@
 import re
-import struct # Used for packing/unpacking bytes for memory access
 
+from paged_memory import PagedMemory
 from Task_1 import parse_arm64_instruction
 from Task_2 import ARM64Registers
 from Task_3 import StackMemory
 from Task_4 import run_parser_with_pc
 
+XZR_INDEX = 31 # X31 reads as zero and ignores writes
+
+# Bump whenever load_program output changes, so stale program cache entries miss
+DECODER_VERSION = 2
+
+# Register name -> (index into the register list, value mask), resolved once
+# here so register access does no string work. Other spellings take the slow path.
+REG_TABLE = {}
+for _i in range(32):
+    for _prefix, _mask in (('X', 0xFFFFFFFFFFFFFFFF), ('W', 0xFFFFFFFF)):
+        REG_TABLE[f'{_prefix}{_i}'] = REG_TABLE[f'{_prefix.lower()}{_i}'] = (_i, _mask)
+del _i, _prefix, _mask
+
 class ARM64Emulator:
     """
     A simplified ARM64 emulator that combines registers, memory, and instruction execution.
     """
     def __init__(self, stack_size=256):
         # --- Registers (Task 2 & 6) ---
-        self.x = {i: 0 for i in range(31)} # X0-X30 registers
+        self.x = [0] * 32 # X0-X30 registers, plus XZR at index 31
         self.sp = stack_size # Stack Pointer starts at the top of the stack
         self.pc = 0 # Program Counter
-        self.pstate = {'N': 0, 'Z': 1, 'C': 0, 'V': 0} # Processor State
+        self._pstate = {'N': 0, 'Z': 1, 'C': 0, 'V': 0} # Processor State
+        self._pending_flags = None # (result, is_64bit) not yet folded into _pstate
         self.labels = {} # To store address of labels like 'loop:'
         self.emulation_finished = False
 
         # --- Memory (Task 3) ---
-        self.stack = bytearray(stack_size)
+        # Paged memory with the stack mapped at [0, stack_size); accesses
+        # outside it raise MemoryError instead of resizing the buffer.
+        self.stack_size = stack_size
+        self.memory = PagedMemory()
+        self.memory.map_region('stack', 0, stack_size)
 
         # --- Instruction Handlers (Task 5) ---
         self.handlers = {
@@ -41,6 +59,11 @@ class ARM64Emulator:
 
     def get_register(self, name):
         """Reads a value from a register (X, W, SP)."""
+        entry = REG_TABLE.get(name)
+        if entry is not None:
+            # W registers are masked to the lower 32 bits; XZR's slot is always 0
+            idx, mask = entry
+            return self.x[idx] & mask
         name = name.upper()
         if name == 'SP':
             return self.sp
@@ -50,11 +73,17 @@ class ARM64Emulator:
         elif name.startswith('X'):
             idx = self._get_reg_idx(name)
             # XZR (register 31) always reads as 0
-            return self.x.get(idx, 0) if idx != 31 else 0
+            return self.x[idx] if idx < XZR_INDEX else 0
         return 0
 
     def set_register(self, name, value):
         """Writes a value to a register, handling 32-bit zero-extension."""
+        entry = REG_TABLE.get(name)
+        if entry is not None:
+            idx, mask = entry
+            if idx != XZR_INDEX: # Cannot write to XZR
+                self.x[idx] = value & mask
+            return
         name = name.upper()
         if name == 'SP':
             self.sp = value
@@ -86,15 +115,29 @@ class ARM64Emulator:
 
     # --- PSTATE Update Helper ---
     def _update_flags(self, result, is_64bit=True):
-        """Updates N and Z flags based on a result."""
-        mask = 0xFFFFFFFFFFFFFFFF if is_64bit else 0xFFFFFFFF
-        result &= mask
-
-        self.pstate['Z'] = 1 if result == 0 else 0
-        
-        # Check the most significant bit for negativity
-        msb_pos = 63 if is_64bit else 31
-        self.pstate['N'] = 1 if (result >> msb_pos) & 1 else 0
+        """Records a flag-setting result; N and Z are computed when PSTATE is read."""
+        self._pending_flags = (result, is_64bit)
+
+    @property
+    def pstate(self):
+        """Processor State, with N and Z brought up to date on first read."""
+        if self._pending_flags is not None:
+            result, is_64bit = self._pending_flags
+            self._pending_flags = None
+            mask = 0xFFFFFFFFFFFFFFFF if is_64bit else 0xFFFFFFFF
+            result &= mask
+
+            self._pstate['Z'] = 1 if result == 0 else 0
+
+            # Check the most significant bit for negativity
+            msb_pos = 63 if is_64bit else 31
+            self._pstate['N'] = 1 if (result >> msb_pos) & 1 else 0
+        return self._pstate
+
+    @pstate.setter
+    def pstate(self, value):
+        self._pstate = value
+        self._pending_flags = None
         
     # --- Instruction Handler Implementations (Task 5 & 6) ---
     def _handle_arithmetic(self, operands, op_func):
@@ -124,26 +167,24 @@ class ARM64Emulator:
         src_reg, mem_op = operands
         addr = self._parse_operand(mem_op)
         val = self.get_register(src_reg)
-        self.stack[addr:addr+8] = struct.pack('<Q', val) # <Q is little-endian 64-bit
+        self.memory.write(addr, 8, val) # little-endian 64-bit
 
     def _handle_strb(self, operands): # Store byte (lower 8 bits of register)
         src_reg, mem_op = operands
         addr = self._parse_operand(mem_op)
         val = self.get_register(src_reg)
-        self.stack[addr:addr+1] = struct.pack('<B', val & 0xFF) # <B is 1 byte
+        self.memory.write(addr, 1, val & 0xFF) # 1 byte
 
     def _handle_ldr(self, operands): # Load 64-bit register
         dest_reg, mem_op = operands
         addr = self._parse_operand(mem_op)
-        val_bytes = self.stack[addr:addr+8]
-        val = struct.unpack('<Q', val_bytes)[0]
+        val = self.memory.read(addr, 8)
         self.set_register(dest_reg, val)
         
     def _handle_ldrb(self, operands): # Load byte
         dest_reg, mem_op = operands
         addr = self._parse_operand(mem_op)
-        val_bytes = self.stack[addr:addr+1]
-        val = struct.unpack('<B', val_bytes)[0]
+        val = self.memory.read(addr, 1)
         self.set_register(dest_reg, val)
 
     def _handle_cmp(self, operands):
@@ -174,23 +215,32 @@ class ARM64Emulator:
         self.emulation_finished = True
 
     # --- Main Emulator Logic ---
-    def load_program(self, filepath):
-        """Loads a program, parsing lines and finding labels."""
+    def load_program(self, filepath, cache=None):
+        """Loads a program, parsing lines and finding labels (through `cache`, a ProgramCache, if given)."""
         with open(filepath, 'r') as f:
             lines = f.readlines()
-        
-        # Pre-scan for labels
-        current_addr = 0
-        program = []
-        for line in lines:
-            line = re.sub(r'(//|#).*', '', line).strip() # Clean comments and whitespace
-            if not line: continue
-            
-            if line.endswith(':'):
-                self.labels[line[:-1]] = current_addr
-            else:
-                program.append(line)
-                current_addr += 4
+
+        def parse():
+            # Pre-scan for labels
+            labels = {}
+            current_addr = 0
+            program = []
+            for line in lines:
+                line = re.sub(r'(//|#).*', '', line).strip() # Clean comments and whitespace
+                if not line: continue
+
+                if line.endswith(':'):
+                    labels[line[:-1]] = current_addr
+                else:
+                    program.append(line)
+                    current_addr += 4
+            return labels, program
+
+        if cache is None:
+            labels, program = parse()
+        else:
+            labels, program = cache.get_or_build('task7', DECODER_VERSION, ''.join(lines), parse)
+        self.labels.update(labels)
         return program
 
     def run(self, program): 
@@ -225,28 +275,30 @@ class ARM64Emulator:
         print(f"PSTATE: N={self.pstate['N']} Z={self.pstate['Z']}")
         
         print("\n--- Final Stack State ---")
-        for i in range(0, len(self.stack), 16):
-            chunk = self.stack[i:i+16]
+        for i in range(0, self.stack_size, 16):
+            chunk = self.memory.peek(i, min(16, self.stack_size - i))
             hex_part = ' '.join(f'{b:02x}' for b in chunk)
             ascii_part = ''.join(chr(b) if 32 <= b <= 126 else '.' for b in chunk)
             print(f"0x{i:04x}: {hex_part:<48} |{ascii_part}|")
 
 
 import re
-import struct
 
 class ARM64Emulator:
     """
     A simplified ARM64 emulator that combines registers, memory, and instruction execution.
     """
     def __init__(self, stack_size=256):
-        self.x = {i: 0 for i in range(31)} # X0-X30 registers
+        self.x = [0] * 32 # X0-X30 registers, plus XZR at index 31
         self.sp = stack_size
         self.pc = 0
-        self.pstate = {'N': 0, 'Z': 1, 'C': 0, 'V': 0}
+        self._pstate = {'N': 0, 'Z': 1, 'C': 0, 'V': 0}
+        self._pending_flags = None
         self.labels = {}
         self.emulation_finished = False
-        self.stack = bytearray(stack_size)
+        self.stack_size = stack_size
+        self.memory = PagedMemory()
+        self.memory.map_region('stack', 0, stack_size)
 
         self.handlers = {
             'ADD': self._handle_add, 'SUB': self._handle_sub,
@@ -263,6 +315,10 @@ class ARM64Emulator:
         return int(reg_name[1:])
 
     def get_register(self, name):
+        entry = REG_TABLE.get(name)
+        if entry is not None:
+            idx, mask = entry
+            return self.x[idx] & mask
         name = name.upper()
         if name == 'SP':
             return self.sp
@@ -270,10 +326,16 @@ class ARM64Emulator:
             return self.x[self._get_reg_idx(name)] & 0xFFFFFFFF
         elif name.startswith('X'):
             idx = self._get_reg_idx(name)
-            return self.x.get(idx, 0) if idx != 31 else 0
+            return self.x[idx] if idx < XZR_INDEX else 0
         return 0
 
     def set_register(self, name, value):
+        entry = REG_TABLE.get(name)
+        if entry is not None:
+            idx, mask = entry
+            if idx != XZR_INDEX:
+                self.x[idx] = value & mask
+            return
         name = name.upper()
         if name == 'SP':
             self.sp = value
@@ -300,11 +362,24 @@ class ARM64Emulator:
             return self.get_register(op)
 
     def _update_flags(self, result, is_64bit=True):
-        mask = 0xFFFFFFFFFFFFFFFF if is_64bit else 0xFFFFFFFF
-        result &= mask
-        self.pstate['Z'] = 1 if result == 0 else 0
-        msb_pos = 63 if is_64bit else 31
-        self.pstate['N'] = 1 if (result >> msb_pos) & 1 else 0
+        self._pending_flags = (result, is_64bit)
+
+    @property
+    def pstate(self):
+        if self._pending_flags is not None:
+            result, is_64bit = self._pending_flags
+            self._pending_flags = None
+            mask = 0xFFFFFFFFFFFFFFFF if is_64bit else 0xFFFFFFFF
+            result &= mask
+            self._pstate['Z'] = 1 if result == 0 else 0
+            msb_pos = 63 if is_64bit else 31
+            self._pstate['N'] = 1 if (result >> msb_pos) & 1 else 0
+        return self._pstate
+
+    @pstate.setter
+    def pstate(self, value):
+        self._pstate = value
+        self._pending_flags = None
         
     def _handle_arithmetic(self, operands, op_func):
         dest, src1, src2_op = operands
@@ -330,26 +405,24 @@ class ARM64Emulator:
         src_reg, mem_op = operands
         addr = self._parse_operand(mem_op)
         val = self.get_register(src_reg)
-        self.stack[addr:addr+8] = struct.pack('<Q', val)
+        self.memory.write(addr, 8, val)
 
     def _handle_strb(self, operands):
         src_reg, mem_op = operands
         addr = self._parse_operand(mem_op)
         val = self.get_register(src_reg)
-        self.stack[addr:addr+1] = struct.pack('<B', val & 0xFF)
+        self.memory.write(addr, 1, val & 0xFF)
 
     def _handle_ldr(self, operands):
         dest_reg, mem_op = operands
         addr = self._parse_operand(mem_op)
-        val_bytes = self.stack[addr:addr+8]
-        val = struct.unpack('<Q', val_bytes)[0]
+        val = self.memory.read(addr, 8)
         self.set_register(dest_reg, val)
         
     def _handle_ldrb(self, operands):
         dest_reg, mem_op = operands
         addr = self._parse_operand(mem_op)
-        val_bytes = self.stack[addr:addr+1]
-        val = struct.unpack('<B', val_bytes)[0]
+        val = self.memory.read(addr, 1)
         self.set_register(dest_reg, val)
 
     def _handle_cmp(self, operands):
@@ -377,35 +450,53 @@ class ARM64Emulator:
     def _handle_ret(self, operands):
         self.emulation_finished = True
 
-    def load_program(self, filepath):
+    def load_program(self, filepath, cache=None):
         with open(filepath, 'r') as f:
             lines = f.readlines()
-        current_addr = 0
-        program = []
-        for line in lines:
-            line = re.sub(r'(//|#).*', '', line).strip()
-            if not line: continue
-            if line.endswith(':'):
-                self.labels[line[:-1]] = current_addr
-            else:
-                program.append(line)
-                current_addr += 4
+
+        def parse():
+            labels = {}
+            current_addr = 0
+            program = []
+            for line in lines:
+                # '#' starts an immediate, not a comment
+                line = re.sub(r'//.*', '', line).strip()
+                if not line: continue
+                if line.endswith(':'):
+                    labels[line[:-1]] = current_addr
+                else:
+                    program.append(line)
+                    current_addr += 4
+            return labels, program
+
+        if cache is None:
+            labels, program = parse()
+        else:
+            labels, program = cache.get_or_build('task7', DECODER_VERSION, ''.join(lines), parse)
+        self.labels.update(labels)
         return program
 
+    def step(self, program):
+        """Executes the instruction at PC. Returns False once the program has finished or halted."""
+        if self.emulation_finished or (self.pc // 4) >= len(program):
+            return False
+        addr = self.pc
+        line = program[addr // 4]
+        self.pc += 4
+        parts = line.split(maxsplit=1)
+        instr = parts[0].upper()
+        ops_str = parts[1] if len(parts) > 1 else ''
+        # Commas inside [...] don't separate operands
+        operands = [op.strip() for op in re.split(r',(?![^\[]*\])', ops_str)] if ops_str else []
+        if instr not in self.handlers:
+            print(f"Error: Unknown instruction '{instr}' at address 0x{addr:x}")
+            return False
+        self.handlers[instr](operands)
+        return True
+
     def run(self, program):
-        while not self.emulation_finished and (self.pc // 4) < len(program):
-            addr = self.pc
-            line = program[addr // 4]
-            self.pc += 4
-            parts = line.split(maxsplit=1)
-            instr = parts[0].upper()
-            ops_str = parts[1] if len(parts) > 1 else ''
-            operands = [op.strip() for op in ops_str.split(',', 1)] if ops_str else []
-            if instr in self.handlers:
-                self.handlers[instr](operands)
-            else:
-                print(f"Error: Unknown instruction '{instr}' at address 0x{addr:x}")
-                break
+        while self.step(program):
+            pass
         print("--- Emulation Finished ---")
 
     def display_state(self):
@@ -415,8 +506,8 @@ class ARM64Emulator:
         print(f"\nSP : 0x{self.sp:016x}\tPC : 0x{self.pc:016x}")
         print(f"PSTATE: N={self.pstate['N']} Z={self.pstate['Z']}")
         print("\n--- Final Stack State ---")
-        for i in range(0, len(self.stack), 16):
-            chunk = self.stack[i:i+16]
+        for i in range(0, self.stack_size, 16):
+            chunk = self.memory.peek(i, min(16, self.stack_size - i))
             hex_part = ' '.join(f'{b:02x}' for b in chunk)
             ascii_part = ''.join(chr(b) if 32 <= b <= 126 else '.' for b in chunk)
             print(f"0x{i:04x}: {hex_part:<48} |{ascii_part}|")
@@ -0,0 +1,634 @@
+"""
+A64 machine code for the emulator's instruction subset.
+
+The assembler turns emulator assembly (ADD/SUB/AND/EOR/MUL/MOV/LDR/STR/
+LDRB/STRB/CMP/B/B.GT/B.LE/NOP/RET) into real 32-bit A64 instruction words,
+and write_image() saves them as a flat little-endian binary, the same
+layout `objcopy -O binary` produces. load_image() maps such a file with
+mmap, and a table-driven decoder turns each word back into an emulator
+instruction, so ARM64Emulator can run an image without any text parsing:
+
+    words = assemble(open('test.s').readlines())
+    write_image('test.bin', words)
+    run_image(ARM64Emulator(), 'test.bin', verbosity='final')
+
+Encodings follow the Arm ARM: ADD/SUB (shifted register, extended register
+when SP is involved, 12-bit immediate), AND/EOR (shifted register, bitmask
+immediate), MUL as MADD with XZR, MOV as ORR/ADD #0/MOVZ/MOVN/ORR bitmask,
+CMP as SUBS/ADDS with XZR, LDR/STR(B) with a scaled unsigned offset or
+LDUR/STUR(B), B and B.cond. Decoding also accepts the flag-setting forms
+(ADDS, SUBS, ANDS) since real toolchains emit them.
+
+Like an assembler, labels resolve to the address of the next instruction,
+and blank and comment-only lines take no space. Decoded instructions run
+with the emulator's semantics, so every ALU instruction sets N and Z just
+as it does in text mode. Text that has no single-word A64 encoding (an
+immediate MUL, a 64-bit constant that needs MOVK, a base register of XZR,
+...) raises EncodeError.
+"""
+
+import argparse
+import mmap
+import struct
+import sys
+
+from emulator import ARM64Emulator, INSTRUCTION_LIMIT, VERBOSITY_LEVELS
+
+MASK32 = 0xFFFFFFFF
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+NOP_WORD = 0xD503201F
+RET_WORD = 0xD65F03C0       # RET X30
+
+# Condition codes for B.cond
+COND_CODES = {'GT': 0xC, 'LE': 0xD}
+COND_NAMES = {code: name for name, code in COND_CODES.items()}
+
+# Base opcodes (sf=1; clear bit 31 for the 32-bit form)
+ALU_SHIFTED = {'ADD': 0x8B000000, 'SUB': 0xCB000000, 'AND': 0x8A000000, 'EOR': 0xCA000000}
+ALU_EXTENDED = {'ADD': 0x8B200000, 'SUB': 0xCB200000}
+ALU_IMM = {'ADD': 0x91000000, 'SUB': 0xD1000000}
+LOGICAL_IMM = {'AND': 0x92000000, 'EOR': 0xD2000000}
+MADD = 0x9B000000
+ORR_SHIFTED = 0xAA000000
+ORR_IMM = 0xB2000000
+MOVZ = 0xD2800000
+MOVN = 0x92800000
+SUBS_SHIFTED = 0xEB000000
+SUBS_EXTENDED = 0xEB200000
+SUBS_IMM = 0xF1000000
+ADDS_IMM = 0xB1000000
+# (is_store, num_bytes) -> (unsigned scaled offset opcode, unscaled opcode);
+# LDR/STR take bit 30 off for the 32-bit register form
+MEM_OPCODES = {
+    (False, 8): (0xF9400000, 0xF8400000), (True, 8): (0xF9000000, 0xF8000000),
+    (False, 1): (0x39400000, 0x38400000), (True, 1): (0x39000000, 0x38000000),
+}
+MEM_MNEMONICS = {'LDR': (False, 8), 'STR': (True, 8), 'LDRB': (False, 1), 'STRB': (True, 1)}
+
+
+class EncodeError(ValueError):
+    """Raised for assembly that has no single-instruction A64 encoding."""
+
+
+class DecodeError(ValueError):
+    """Raised for instruction words outside the supported subset."""
+
+
+# --- Bitmask Immediates ---
+def encode_bitmask(value, width):
+    """Returns the (N, immr, imms) fields for a logical immediate, or None if it has none."""
+    if value == 0 or value == (1 << width) - 1:
+        return None
+    size = width
+    while size > 2:
+        half = size // 2
+        if (value & ((1 << half) - 1)) != (value >> half) & ((1 << half) - 1):
+            break
+        size = half
+    element = value & ((1 << size) - 1)
+    ones = bin(element).count('1')
+    # Rotate right until the ones are at the bottom
+    for rotation in range(size):
+        rotated = ((element >> rotation) | (element << (size - rotation))) & ((1 << size) - 1)
+        if rotated == (1 << ones) - 1:
+            break
+    else:
+        return None
+    immr = (size - rotation) % size
+    n = 1 if size == 64 else 0
+    imms = (~(size * 2 - 1) & 0x3F) | (ones - 1)
+    return n, immr, imms
+
+
+def decode_bitmask(n, immr, imms, width):
+    """Inverse of encode_bitmask; None for reserved encodings."""
+    combined = (n << 6) | (~imms & 0x3F)
+    if combined == 0:
+        return None
+    length = combined.bit_length() - 1
+    size = 1 << length
+    if size > width:
+        return None
+    levels = size - 1
+    s, r = imms & levels, immr & levels
+    if s == levels:
+        return None
+    element = (1 << (s + 1)) - 1
+    element = ((element >> r) | (element << (size - r))) & ((1 << size) - 1)
+    value = 0
+    for shift in range(0, width, size):
+        value |= element << shift
+    return value
+
+
+# --- Encoder ---
+def _reg(name, allow):
+    """Register name -> (number, is64). `allow` says whether 31 means 'sp' or 'zr' here."""
+    name = name.strip().upper()
+    if name in ('SP', 'WSP'):
+        if allow != 'sp':
+            raise EncodeError(f"{name} cannot be used here")
+        return 31, name == 'SP'
+    if name in ('XZR', 'WZR'):
+        if allow != 'zr':
+            raise EncodeError(f"{name} cannot be used here")
+        return 31, name == 'XZR'
+    if len(name) >= 2 and name[0] in 'XW' and name[1:].isdigit() and int(name[1:]) <= 30:
+        return int(name[1:]), name[0] == 'X'
+    raise EncodeError(f"Unknown register: {name}")
+
+
+def _is_sp(name):
+    return name.strip().upper() in ('SP', 'WSP')
+
+
+def _imm(op_str):
+    op_str = op_str.strip()
+    if not op_str.startswith('#'):
+        return None
+    return int(op_str[1:], 0)
+
+
+def _sf(is64):
+    """Bits to clear from a 64-bit opcode for the 32-bit form."""
+    return 0 if is64 else 1 << 31
+
+
+def _check_widths(mnemonic, is64, *others):
+    # One A64 instruction has a single operand size; the emulator masks
+    # each register separately, so mixed widths have no faithful encoding
+    if any(other != is64 for other in others):
+        raise EncodeError(f"{mnemonic} mixes X and W registers")
+
+
+def _encode_add_sub_imm(mnemonic, rd, rn, value, is64, set_flags_rd=False):
+    if value < 0:
+        mnemonic = 'SUB' if mnemonic == 'ADD' else 'ADD'
+        value = -value
+    if value < 0x1000:
+        field = value << 10
+    elif value & 0xFFF == 0 and value >> 12 < 0x1000:
+        field = (1 << 22) | (value >> 12) << 10
+    else:
+        raise EncodeError(f"Immediate #{value} does not fit in 12 bits")
+    if set_flags_rd:
+        base = ADDS_IMM if mnemonic == 'ADD' else SUBS_IMM
+    else:
+        base = ALU_IMM[mnemonic]
+    return (base & ~_sf(is64) & MASK32) | field | rn << 5 | rd
+
+
+def _encode_alu(mnemonic, operands):
+    dest, src1, op2 = operands
+    value = _imm(op2)
+    if value is not None:
+        if mnemonic in ALU_IMM:
+            rd, is64 = _reg(dest, 'sp')
+            rn, n64 = _reg(src1, 'sp')
+            _check_widths(mnemonic, is64, n64)
+            return _encode_add_sub_imm(mnemonic, rd, rn, value, is64)
+        if mnemonic in LOGICAL_IMM:
+            rd, is64 = _reg(dest, 'sp')
+            rn, n64 = _reg(src1, 'zr')
+            _check_widths(mnemonic, is64, n64)
+            width = 64 if is64 else 32
+            if is64 or mnemonic == 'AND':
+                # Same result for the emulator, whose immediates are unbounded
+                value &= (1 << width) - 1
+            if not 0 <= value < 1 << width:
+                raise EncodeError(f"Immediate #{value:#x} does not fit in {width} bits")
+            fields = encode_bitmask(value, width)
+            if fields is None:
+                raise EncodeError(f"#{value:#x} is not a bitmask immediate")
+            n, immr, imms = fields
+            base = LOGICAL_IMM[mnemonic] & ~_sf(is64) & MASK32
+            return base | n << 22 | immr << 16 | imms << 10 | rn << 5 | rd
+        raise EncodeError(f"{mnemonic} has no immediate form")
+    if mnemonic in ALU_EXTENDED and (_is_sp(dest) or _is_sp(src1)):
+        rd, is64 = _reg(dest, 'sp')
+        rn, n64 = _reg(src1, 'sp')
+        rm, m64 = _reg(op2, 'zr')
+        _check_widths(mnemonic, is64, n64, m64)
+        option = 0b011 if is64 else 0b010    # UXTX / UXTW
+        base = ALU_EXTENDED[mnemonic] & ~_sf(is64) & MASK32
+        return base | rm << 16 | option << 13 | rn << 5 | rd
+    rd, is64 = _reg(dest, 'zr')
+    rn, n64 = _reg(src1, 'zr')
+    rm, m64 = _reg(op2, 'zr')
+    _check_widths(mnemonic, is64, n64, m64)
+    if mnemonic == 'MUL':
+        return (MADD & ~_sf(is64) & MASK32) | rm << 16 | 31 << 10 | rn << 5 | rd
+    return (ALU_SHIFTED[mnemonic] & ~_sf(is64) & MASK32) | rm << 16 | rn << 5 | rd
+
+
+def _encode_mov(operands):
+    dest, src = operands
+    value = _imm(src)
+    if value is None:
+        if _is_sp(dest) or _is_sp(src):
+            rd, is64 = _reg(dest, 'sp')
+            rn, n64 = _reg(src, 'sp')
+            if is64:
+                _check_widths('MOV', is64, n64)
+            return _encode_add_sub_imm('ADD', rd, rn, 0, is64)
+        rd, is64 = _reg(dest, 'zr')
+        rm, m64 = _reg(src, 'zr')
+        if is64:
+            # A W destination only keeps the low 32 bits anyway
+            _check_widths('MOV', is64, m64)
+        return (ORR_SHIFTED & ~_sf(is64) & MASK32) | rm << 16 | 31 << 5 | rd
+    is64 = _reg(dest, 'sp' if _is_sp(dest) else 'zr')[1]
+    width = 64 if is64 else 32
+    value &= (1 << width) - 1
+    if not _is_sp(dest):
+        rd, _ = _reg(dest, 'zr')
+        for base, chunk_value in ((MOVZ, value), (MOVN, ~value & ((1 << width) - 1))):
+            for hw in range(width // 16):
+                if chunk_value & ~(0xFFFF << (16 * hw)) == 0:
+                    imm16 = chunk_value >> (16 * hw)
+                    return (base & ~_sf(is64) & MASK32) | hw << 21 | imm16 << 5 | rd
+    rd, _ = _reg(dest, 'sp')
+    fields = encode_bitmask(value, width)
+    if fields is None:
+        raise EncodeError(f"#{value:#x} needs more than one instruction (MOVZ/MOVK)")
+    n, immr, imms = fields
+    return (ORR_IMM & ~_sf(is64) & MASK32) | n << 22 | immr << 16 | imms << 10 | 31 << 5 | rd
+
+
+def _encode_cmp(operands):
+    src1, op2 = operands
+    value = _imm(op2)
+    if value is not None:
+        rn, is64 = _reg(src1, 'sp')
+        return _encode_add_sub_imm('SUB', 31, rn, value, is64, set_flags_rd=True)
+    if _is_sp(src1):
+        rn, is64 = _reg(src1, 'sp')
+        rm, m64 = _reg(op2, 'zr')
+        _check_widths('CMP', is64, m64)
+        option = 0b011 if is64 else 0b010
+        return (SUBS_EXTENDED & ~_sf(is64) & MASK32) | rm << 16 | option << 13 | rn << 5 | 31
+    rn, is64 = _reg(src1, 'zr')
+    rm, m64 = _reg(op2, 'zr')
+    _check_widths('CMP', is64, m64)
+    return (SUBS_SHIFTED & ~_sf(is64) & MASK32) | rm << 16 | rn << 5 | 31
+
+
+def _encode_mem(mnemonic, operands, parser):
+    reg, mem_op = operands
+    base_name, offset = parser._parse_mem_operand(mem_op)
+    rn, _ = _reg(base_name, 'sp')
+    rt, is64 = _reg(reg, 'zr')
+    is_store, num_bytes = MEM_MNEMONICS[mnemonic]
+    scaled, unscaled = MEM_OPCODES[(is_store, num_bytes)]
+    scale = num_bytes
+    if num_bytes == 8 and not is64:
+        # 32-bit register form; the emulator still moves 8 bytes
+        scaled &= ~(1 << 30)
+        unscaled &= ~(1 << 30)
+        scale = 4
+    if offset >= 0 and offset % scale == 0 and offset // scale < 0x1000:
+        return scaled | (offset // scale) << 10 | rn << 5 | rt
+    if -256 <= offset < 256:
+        return unscaled | (offset & 0x1FF) << 12 | rn << 5 | rt
+    raise EncodeError(f"Offset #{offset} is out of range for {mnemonic}")
+
+
+def _encode_branch(mnemonic, operands, pc, labels):
+    label = operands[0]
+    if label not in labels:
+        raise EncodeError(f"Undefined label: {label}")
+    delta = (labels[label] - pc) // 4
+    if mnemonic == 'B':
+        if not -(1 << 25) <= delta < 1 << 25:
+            raise EncodeError(f"Branch to {label} is out of range")
+        return 0x14000000 | (delta & 0x3FFFFFF)
+    cond = mnemonic[2:]
+    if not -(1 << 18) <= delta < 1 << 18:
+        raise EncodeError(f"Branch to {label} is out of range")
+    return 0x54000000 | (delta & 0x7FFFF) << 5 | COND_CODES[cond]
+
+
+def encode(mnemonic, operands, pc=0, labels=None, parser=None):
+    """Encodes one parsed instruction (as returned by ARM64Emulator._parse_line) at `pc`."""
+    parser = parser or ARM64Emulator()
+    try:
+        if mnemonic in ALU_SHIFTED or mnemonic == 'MUL':
+            return _encode_alu(mnemonic, operands)
+        if mnemonic == 'MOV':
+            return _encode_mov(operands)
+        if mnemonic == 'CMP':
+            return _encode_cmp(operands)
+        if mnemonic in MEM_MNEMONICS:
+            return _encode_mem(mnemonic, operands, parser)
+        if mnemonic in ('B', 'B.GT', 'B.LE'):
+            return _encode_branch(mnemonic, operands, pc, labels or {})
+        if mnemonic == 'NOP' and not operands:
+            return NOP_WORD
+        if mnemonic == 'RET' and not operands:
+            return RET_WORD
+    except EncodeError:
+        raise
+    except (ValueError, TypeError) as e:
+        raise EncodeError(f"Cannot encode {mnemonic} {', '.join(operands)}: {e}")
+    raise EncodeError(f"Instruction '{mnemonic}' cannot be encoded.")
+
+
+def assemble(program):
+    """Assembles lines of emulator assembly into a list of instruction words."""
+    parser = ARM64Emulator()
+    instructions = []
+    labels = {}
+    for line in program:
+        stripped = line.strip()
+        if stripped.endswith(':'):
+            labels[stripped[:-1]] = len(instructions) * 4
+            continue
+        mnemonic, operands = parser._parse_line(line)
+        if mnemonic:
+            instructions.append((mnemonic, operands, stripped))
+    words = []
+    for i, (mnemonic, operands, text) in enumerate(instructions):
+        try:
+            words.append(encode(mnemonic, operands, i * 4, labels, parser))
+        except EncodeError as e:
+            raise EncodeError(f"Line '{text}': {e}") from None
+    return words
+
+
+# --- Images ---
+def write_image(path, words):
+    with open(path, 'wb') as f:
+        f.write(struct.pack(f'<{len(words)}I', *words))
+
+
+def load_image(path):
+    """Returns the instruction words of a flat little-endian image, read through mmap."""
+    with open(path, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return ()   # empty file
+        with mapped:
+            if len(mapped) % 4:
+                raise DecodeError(f"Image size {len(mapped)} is not a multiple of 4")
+            return struct.unpack(f'<{len(mapped) // 4}I', mapped)
+
+
+# --- Decoder ---
+def _rname(num, is64, sp):
+    if num == 31:
+        if sp:
+            return 'SP' if is64 else 'WSP'
+        return 'XZR' if is64 else 'WZR'
+    return f"{'X' if is64 else 'W'}{num}"
+
+
+def _fields(word):
+    return word >> 31, (word >> 16) & 31, (word >> 5) & 31, word & 31
+
+
+def _dec_alu_shifted(word, pc):
+    sf, rm, rn, rd = _fields(word)
+    if (word >> 10) & 0x3F or (word >> 22) & 3:
+        raise DecodeError(f"Shifted operands are not supported: {word:#010x}")
+    opc = (word >> 29) & 3
+    logical = (word >> 24) & 1 == 0
+    if logical:
+        if (word >> 21) & 1:
+            raise DecodeError(f"Inverted logical operands are not supported: {word:#010x}")
+        mnemonic = ('AND', 'ORR', 'EOR', 'AND')[opc]
+        if mnemonic == 'ORR':
+            if rn != 31:
+                raise DecodeError(f"ORR is only supported as MOV: {word:#010x}")
+            return 'MOV', [_rname(rd, sf, False), _rname(rm, sf, False)]
+    else:
+        mnemonic = 'SUB' if opc & 2 else 'ADD'
+        if opc & 1 and rd == 31:
+            if mnemonic == 'ADD':
+                raise DecodeError(f"CMN is not supported: {word:#010x}")
+            return 'CMP', [_rname(rn, sf, False), _rname(rm, sf, False)]
+    return mnemonic, [_rname(rd, sf, False), _rname(rn, sf, False), _rname(rm, sf, False)]
+
+
+def _dec_alu_extended(word, pc):
+    sf, rm, rn, rd = _fields(word)
+    option, amount = (word >> 13) & 7, (word >> 10) & 7
+    if amount or (word >> 22) & 3 or option != (0b011 if sf else 0b010):
+        raise DecodeError(f"Extended operands are not supported: {word:#010x}")
+    opc = (word >> 29) & 3
+    mnemonic = 'SUB' if opc & 2 else 'ADD'
+    if opc & 1:
+        if rd == 31 and mnemonic == 'SUB':
+            return 'CMP', [_rname(rn, sf, True), _rname(rm, sf, False)]
+        return mnemonic, [_rname(rd, sf, False), _rname(rn, sf, True), _rname(rm, sf, False)]
+    return mnemonic, [_rname(rd, sf, True), _rname(rn, sf, True), _rname(rm, sf, False)]
+
+
+def _dec_alu_imm(word, pc):
+    sf, _, rn, rd = _fields(word)
+    value = (word >> 10) & 0xFFF
+    if (word >> 22) & 1:
+        value <<= 12
+    opc = (word >> 29) & 3
+    mnemonic = 'SUB' if opc & 2 else 'ADD'
+    if opc & 1:
+        if rd == 31:
+            # CMP / CMN
+            return 'CMP', [_rname(rn, sf, True), f'#{-value if mnemonic == "ADD" else value}']
+        return mnemonic, [_rname(rd, sf, False), _rname(rn, sf, True), f'#{value}']
+    if value == 0 and mnemonic == 'ADD' and (rd == 31 or rn == 31):
+        return 'MOV', [_rname(rd, sf, True), _rname(rn, sf, True)]
+    return mnemonic, [_rname(rd, sf, True), _rname(rn, sf, True), f'#{value}']
+
+
+def _dec_logical_imm(word, pc):
+    sf, _, rn, rd = _fields(word)
+    n, immr, imms = (word >> 22) & 1, (word >> 16) & 0x3F, (word >> 10) & 0x3F
+    value = decode_bitmask(n, immr, imms, 64 if sf else 32)
+    if value is None or (n and not sf):
+        raise DecodeError(f"Reserved bitmask immediate: {word:#010x}")
+    opc = (word >> 29) & 3
+    if opc == 1:
+        if rn != 31:
+            raise DecodeError(f"ORR is only supported as MOV: {word:#010x}")
+        return 'MOV', [_rname(rd, sf, True), f'#{value:#x}']
+    if opc == 3:
+        # ANDS: Rd of 31 is XZR
+        return 'AND', [_rname(rd, sf, False), _rname(rn, sf, False), f'#{value:#x}']
+    return ('AND', None, 'EOR')[opc], [_rname(rd, sf, True), _rname(rn, sf, False), f'#{value:#x}']
+
+
+def _dec_move_wide(word, pc):
+    sf, _, _, rd = _fields(word)
+    opc, hw, imm16 = (word >> 29) & 3, (word >> 21) & 3, (word >> 5) & 0xFFFF
+    width = 64 if sf else 32
+    if opc == 1 or (not sf and hw > 1):
+        raise DecodeError(f"Unallocated move-wide encoding: {word:#010x}")
+    if opc == 3:
+        raise DecodeError(f"MOVK is not supported: {word:#010x}")
+    value = imm16 << (16 * hw)
+    if opc == 0:
+        value = ~value & ((1 << width) - 1)
+    return 'MOV', [_rname(rd, sf, False), f'#{value:#x}']
+
+
+def _dec_madd(word, pc):
+    sf, rm, rn, rd = _fields(word)
+    if (word >> 10) & 31 != 31 or (word >> 15) & 1:
+        raise DecodeError(f"Only MUL (MADD with XZR) is supported: {word:#010x}")
+    return 'MUL', [_rname(rd, sf, False), _rname(rn, sf, False), _rname(rm, sf, False)]
+
+
+def _dec_mem(word, pc):
+    size, opc = word >> 30, (word >> 22) & 3
+    rn, rt = (word >> 5) & 31, word & 31
+    if size == 1 or opc > 1:
+        raise DecodeError(f"Only LDR/STR/LDRB/STRB are supported: {word:#010x}")
+    mnemonic = (('STRB', 'LDRB') if size == 0 else ('STR', 'LDR'))[opc]
+    is64 = size == 3
+    if (word >> 24) & 1:
+        offset = ((word >> 10) & 0xFFF) << size
+    else:
+        offset = ((word >> 12) & 0x1FF) - ((word >> 12) & 0x100) * 2
+    return mnemonic, [_rname(rt, is64, False), f'[{_rname(rn, True, True)}, #{offset}]']
+
+
+def _dec_b(word, pc):
+    delta = word & 0x3FFFFFF
+    if delta & 0x2000000:
+        delta -= 1 << 26
+    return 'B', [pc + delta * 4]
+
+
+def _dec_bcond(word, pc):
+    cond = word & 0x1F
+    if cond not in COND_NAMES:
+        raise DecodeError(f"Condition {cond:#x} is not supported: {word:#010x}")
+    delta = (word >> 5) & 0x7FFFF
+    if delta & 0x40000:
+        delta -= 1 << 19
+    return f'B.{COND_NAMES[cond]}', [pc + delta * 4]
+
+
+def _dec_fixed(mnemonic):
+    return lambda word, pc: (mnemonic, [])
+
+
+# (mask, value, decoder) in match order
+DECODE_TABLE = (
+    (0xFFFFFFFF, NOP_WORD, _dec_fixed('NOP')),
+    (0xFFFFFFFF, RET_WORD, _dec_fixed('RET')),
+    (0x1F200000, 0x0B000000, _dec_alu_shifted),   # ADD/ADDS/SUB/SUBS shifted
+    (0x1F000000, 0x0A000000, _dec_alu_shifted),   # AND/ORR/EOR shifted
+    (0x1F200000, 0x0B200000, _dec_alu_extended),  # ADD/SUB extended
+    (0x1F800000, 0x11000000, _dec_alu_imm),       # ADD/ADDS/SUB/SUBS immediate
+    (0x1F800000, 0x12000000, _dec_logical_imm),   # AND/ORR/EOR/ANDS immediate
+    (0x1F800000, 0x12800000, _dec_move_wide),     # MOVN/MOVZ/MOVK
+    (0x7FE08000, 0x1B000000, _dec_madd),          # MADD
+    (0x3F000000, 0x39000000, _dec_mem),           # LDR/STR unsigned offset
+    (0x3F200C00, 0x38000000, _dec_mem),           # LDUR/STUR
+    (0xFC000000, 0x14000000, _dec_b),
+    (0xFF000010, 0x54000000, _dec_bcond),
+)
+
+
+def decode_word(word, pc=0):
+    """
+    Decodes one instruction word at `pc` to (mnemonic, operands) in the
+    emulator's syntax. Branch operands are absolute target addresses.
+    """
+    for mask, value, decoder in DECODE_TABLE:
+        if word & mask == value:
+            return decoder(word, pc)
+    raise DecodeError(f"Unsupported instruction word {word:#010x}")
+
+
+def _label(target):
+    return f'loc_{target:x}'
+
+
+def disassemble(words, base=0):
+    """Returns one line of emulator assembly per word; branch targets become loc_ labels."""
+    lines = []
+    for i, word in enumerate(words):
+        try:
+            mnemonic, operands = decode_word(word, base + i * 4)
+        except DecodeError as e:
+            lines.append(f'.word {word:#010x}  // {e}')
+            continue
+        if mnemonic.startswith('B'):
+            operands = [_label(operands[0])]
+        lines.append(f"{mnemonic} {', '.join(operands)}".rstrip())
+    return lines
+
+
+def decode_image(emulator, words):
+    """
+    Decodes instruction words into ARM64Emulator records (as from
+    emulator.decode), registering a loc_ label for every branch target.
+    Words that do not decode fault when they are executed, like bad text.
+    """
+    decoded = []
+    memo = {}
+    for i, word in enumerate(words):
+        pc = i * 4
+        record = memo.get(word)
+        if record is None:
+            try:
+                mnemonic, operands = decode_word(word, pc)
+                if mnemonic.startswith('B'):
+                    emulator.labels[_label(operands[0])] = operands[0]
+                    operands = [_label(operands[0])]
+                text = f"{mnemonic} {', '.join(operands)}".rstrip()
+                handler, args = emulator._decode_instruction(mnemonic, operands)
+            except Exception as e:
+                mnemonic, text, handler, args = None, f'.word {word:#010x}', emulator._exec_raise, (e,)
+            record = (handler, args, text)
+            if not (mnemonic or '').startswith('B'):
+                # Only branches depend on their PC
+                memo[word] = record
+        decoded.append(record)
+    return decoded
+
+
+def run_image(emulator, path, **kwargs):
+    """Loads an image with load_image and runs it on `emulator` (keyword arguments go to run_decoded)."""
+    decoded = decode_image(emulator, load_image(path))
+    emulator.run_decoded(decoded, **kwargs)
+    return emulator
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Assemble, disassemble and run A64 binary images.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    asm = commands.add_parser('asm', help="assemble a .s file into a flat binary image")
+    asm.add_argument('source')
+    asm.add_argument('image')
+    dis = commands.add_parser('disasm', help="print the instructions in an image")
+    dis.add_argument('image')
+    run = commands.add_parser('run', help="run an image on the emulator")
+    run.add_argument('image')
+    run.add_argument('-v', '--verbosity', choices=VERBOSITY_LEVELS, default='final')
+    run.add_argument('--max-instructions', type=int, default=INSTRUCTION_LIMIT, metavar='N')
+    args = parser.parse_args(argv)
+
+    if args.command == 'asm':
+        with open(args.source, 'r') as f:
+            try:
+                words = assemble(f.readlines())
+            except EncodeError as e:
+                sys.exit(f"Error: {e}")
+        write_image(args.image, words)
+        print(f"{len(words)} instructions written to {args.image}")
+    elif args.command == 'disasm':
+        words = load_image(args.image)
+        for i, (word, line) in enumerate(zip(words, disassemble(words))):
+            print(f"{i * 4:08x}: {word:08x}  {line}")
+    else:
+        run_image(ARM64Emulator(), args.image, verbosity=args.verbosity,
+                  max_instructions=args.max_instructions)
+
+
+if __name__ == "__main__":
+    main()
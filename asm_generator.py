@@ -0,0 +1,432 @@
+"""
+Synthetic program generator for scaling tests of the ARM64 emulator.
+
+Generates valid assembly for the emulator's instruction subset (ADD, SUB,
+AND, EOR, MUL, MOV, CMP, B, B.GT, B.LE, LDR, STR, LDRB, STRB, NOP, RET) at
+any size, together with the final state the program must reach. The
+program is a chain of labelled blocks:
+
+    block_N:   straight-line ALU, MOV and load/store instructions on X0-X15
+               (X and W forms) and a stack frame of `footprint` bytes,
+               ending in a fall-through, a B or a CMP/B.GT/B.LE to a later
+               block (up to `jump_distance` blocks ahead)
+    block_N:   (every blocks / (loops + 1) blocks) a counted loop of
+               `trip_count` iterations over a small body on X20-X28
+    done:      pops the stack frame, sets the flags from X0 and returns
+
+Every branch goes forward or closes a counted loop, so programs always
+terminate. The expected state is computed while generating: executed
+straight-line code is modelled one instruction at a time, skipped blocks
+not at all, and loops in closed form, so generation time grows with the
+static size and not with the trip counts. The model is written
+independently of emulator.py, so it can serve as an oracle for it.
+
+Programs are produced as a stream of lines, so millions of instructions
+don't need to be held in memory:
+
+    program = SyntheticProgram(instructions=1_000_000, loops=10, trip_count=100_000)
+    program.write('big.s')
+    program.expected        # registers, pc, flags, instruction_count, memory_sha256
+
+The expected state uses the result fields of batch_runner.py, and job()
+returns a batch_runner job for the written file, so a generated corpus can
+be run and checked with it. From the command line:
+
+    python asm_generator.py -n 1000000 --loops 10 --trip-count 100000 -o big.s --manifest big.jsonl --check
+
+--self-check N runs N small random programs through the same comparison,
+as a regression check of the model itself:
+
+    python asm_generator.py --self-check 400 --seed 1
+"""
+
+import argparse
+import json
+import operator
+import os
+import random
+import sys
+import tempfile
+
+from batch_runner import memory_hash, run_job
+from emulator import ARM64Emulator
+from paged_memory import PagedMemory
+
+MASK32 = 0xFFFFFFFF
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+SP = 31
+
+# Registers used by straight-line code, loop counters and loop bodies
+DATA_REGS = range(16)
+COND_REG = 16
+COUNTER_REG = 20
+LOOP_REGS = range(21, 29)
+
+_ALU = {'ADD': operator.add, 'SUB': operator.sub, 'AND': operator.and_,
+        'EOR': operator.xor, 'MUL': operator.mul}
+
+# Straight-line instruction kinds and their relative weights
+_STRAIGHT_KINDS = ('alu_imm', 'alu_reg', 'mov_imm', 'mov_reg', 'nop', 'str', 'ldr', 'strb', 'ldrb')
+_STRAIGHT_WEIGHTS = (30, 25, 10, 5, 2, 8, 8, 6, 6)
+
+# Loop body instruction kinds, each on its own register
+_LOOP_KINDS = ('add_imm', 'add_counter', 'eor_imm', 'mul_imm', 'str_counter', 'ldr')
+
+# Block terminators: fall through, B, or CMP and a conditional branch
+_TERMINATOR_WEIGHTS = (60, 15, 25)
+
+
+def _reg(index, wide):
+    return f"{'X' if wide else 'W'}{index}"
+
+
+class SyntheticProgram:
+    """A generated program of about `instructions` static instructions and its expected final state."""
+    def __init__(self, instructions=1000, blocks=None, loops=0, trip_count=100, loop_body=4,
+                 footprint=256, jump_distance=8, seed=0):
+        if loops and not 1 <= trip_count < 1 << 31:
+            raise ValueError("trip_count must be between 1 and 2**31 - 1")
+        if not 1 <= loop_body <= len(LOOP_REGS):
+            raise ValueError(f"loop_body must be between 1 and {len(LOOP_REGS)}")
+        self.instructions = instructions
+        self.blocks = max(1, blocks if blocks is not None else instructions // 20)
+        self.loops = min(loops, self.blocks)
+        self.trip_count = trip_count
+        self.loop_body = loop_body
+        self.footprint = -(-footprint // 16) * 16   # SP stays 16-byte aligned
+        self.jump_distance = max(1, jump_distance)
+        self.seed = seed
+        self.stack_size = max(256, self.footprint)
+        self._expected = None
+
+    @property
+    def expected(self):
+        """The final state, in batch_runner result form (generates the program once if needed)."""
+        if self._expected is None:
+            for _ in self.lines():
+                pass
+        return self._expected
+
+    def job(self, path, name=None):
+        """A batch_runner job that runs the program written to `path`."""
+        return {'name': name or path, 'path': path, 'stack_size': self.stack_size,
+                'max_instructions': self.expected['instruction_count']}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.writelines(self.lines())
+        return self.expected
+
+    def text(self):
+        return ''.join(self.lines())
+
+    # --- Generation and model ---
+    def lines(self):
+        """Yields the program's lines; self.expected is set once they are exhausted."""
+        rng = random.Random(self.seed)
+        regs = [0] * 32
+        regs[SP] = self.stack_size   # relative to the stack region's start
+        memory = bytearray(self.stack_size)
+        frame = self.footprint
+        count = 0       # instructions executed
+        slots = 0       # instruction slots emitted (the PC of the next one is slots * 4)
+
+        loop_blocks = {(k + 1) * self.blocks // (self.loops + 1) for k in range(self.loops)}
+        straight_blocks = self.blocks - len(loop_blocks)
+        fixed = 3 + 2 * bool(frame) + len(loop_blocks) * (self.loop_body + 4)
+        # Terminators take 1.1 instructions on average
+        per_block = max(1, round((self.instructions - fixed) / max(1, straight_blocks) - 1.1))
+
+        # Prologue: open the stack frame and seed X0-X3 (the other registers start at 0)
+        prologue = [f"    MOV  X{i}, #{rng.getrandbits(16)}\n" for i in range(4)]
+        if frame:
+            prologue.insert(0, f"    SUB  SP, SP, #{frame}\n")
+        for line in prologue:
+            yield line
+            count, slots = count + 1, slots + 1
+            self._apply_line(line, regs)
+
+        next_live = 0
+        for block in range(self.blocks):
+            live = block == next_live
+            yield f"block_{block}:\n"
+            if block in loop_blocks:
+                for line in self._loop(rng, block, regs, memory, live):
+                    yield line
+                    slots += not line.endswith(':\n')
+                if live:
+                    count += 1 + self.trip_count * (self.loop_body + 3)
+                    next_live = block + 1
+                continue
+            for _ in range(per_block):
+                kind = rng.choices(_STRAIGHT_KINDS, _STRAIGHT_WEIGHTS)[0]
+                if kind in ('str', 'ldr', 'strb', 'ldrb') and not frame:
+                    kind = 'nop'
+                yield self._straight(rng, kind, regs, memory, live)
+                slots += 1
+            count += per_block if live else 0
+
+            target = min(self.blocks, block + 1 + rng.randint(1, self.jump_distance))
+            label = 'done' if target == self.blocks else f"block_{target}"
+            terminator = rng.choices(range(3), _TERMINATOR_WEIGHTS)[0]
+            if terminator == 0:
+                next_live = block + 1 if live else next_live
+            elif terminator == 1:
+                yield f"    B    {label}\n"
+                slots += 1
+                if live:
+                    count += 1
+                    next_live = target
+            else:
+                source, bound = rng.choice(DATA_REGS), rng.randrange(256)
+                condition = rng.choice(('GT', 'LE'))
+                yield f"    AND  X{COND_REG}, X{source}, #255\n"
+                yield f"    CMP  X{COND_REG}, #{bound}\n"
+                yield f"    B.{condition} {label}\n"
+                slots += 3
+                if live:
+                    count += 3
+                    regs[COND_REG] = regs[source] & 255
+                    taken = (regs[COND_REG] > bound) == (condition == 'GT')
+                    next_live = target if taken else block + 1
+
+        # Epilogue: close the frame, set the flags from X0 and return
+        yield "done:\n"
+        if frame:
+            yield f"    ADD  SP, SP, #{frame}\n"
+            regs[SP] += frame
+            count, slots = count + 1, slots + 1
+        yield "    CMP  X0, #0\n"
+        yield "    RET\n"
+        count, slots = count + 2, slots + 2
+        self._expected = self._final_state(regs, memory, count, slots)
+
+    def _apply_line(self, line, regs):
+        # Prologue lines: MOV Xd, #imm and SUB SP, SP, #frame
+        mnemonic, operands = line.split(maxsplit=1)
+        operands = [op.strip() for op in operands.split(',')]
+        if mnemonic == 'MOV':
+            regs[int(operands[0][1:])] = int(operands[1][1:])
+        else:
+            regs[SP] -= int(operands[2][1:])
+
+    def _straight(self, rng, kind, regs, memory, live):
+        """One straight-line instruction; applies it to the model when `live`."""
+        wide = rng.random() < 0.75
+        mask = MASK64 if wide else MASK32
+        d = rng.choice(DATA_REGS)
+        if kind == 'nop':
+            return "    NOP\n"
+        if kind in ('alu_imm', 'alu_reg'):
+            name = rng.choice(tuple(_ALU))
+            n = rng.choice(DATA_REGS)
+            if kind == 'alu_imm':
+                imm = rng.randrange(4096)
+                text, b = f"#{imm}", imm
+            else:
+                m = rng.choice(DATA_REGS)
+                text, b = _reg(m, wide), regs[m] & mask
+            if live:
+                regs[d] = _ALU[name](regs[n] & mask, b) & mask
+            return f"    {name:<4} {_reg(d, wide)}, {_reg(n, wide)}, {text}\n"
+        if kind == 'mov_imm':
+            imm = rng.getrandbits(64 if wide and rng.random() < 0.2 else 16)
+            if live:
+                regs[d] = imm & mask
+            return f"    MOV  {_reg(d, wide)}, #{imm:#x}\n"
+        if kind == 'mov_reg':
+            m = rng.choice(DATA_REGS)
+            if live:
+                regs[d] = regs[m] & mask
+            return f"    MOV  {_reg(d, wide)}, {_reg(m, wide)}\n"
+        # Loads and stores inside the frame: 8 bytes through X registers, 1 through W
+        if kind in ('str', 'ldr'):
+            offset = 8 * rng.randrange(self.footprint // 8)
+            size, name = 8, _reg(d, True)
+        else:
+            offset = rng.randrange(self.footprint)
+            size, name = 1, _reg(d, False)
+        address = regs[SP] + offset
+        if live:
+            if kind in ('str', 'strb'):
+                memory[address:address + size] = (regs[d] & ((1 << 8 * size) - 1)).to_bytes(size, 'little')
+            else:
+                regs[d] = int.from_bytes(memory[address:address + size], 'little')
+        return f"    {kind.upper():<4} {name}, [SP, #{offset}]\n"
+
+    def _loop(self, rng, block, regs, memory, live):
+        """Lines of a counted loop; applies its closed form to the model when `live`."""
+        n = self.trip_count
+        lines = [f"    MOV  X{COUNTER_REG}, #{n}\n", f"loop_{block}:\n"]
+        kinds = [k for k in _LOOP_KINDS if self.footprint or k not in ('str_counter', 'ldr')]
+        stored = set()
+        for d in rng.sample(LOOP_REGS, self.loop_body):
+            kind = rng.choice(kinds)
+            wide = rng.random() < 0.75
+            mask = MASK64 if wide else MASK32
+            name = _reg(d, wide)
+            if kind == 'add_imm':
+                c = rng.randrange(1, 4096)
+                lines.append(f"    ADD  {name}, {name}, #{c}\n")
+                value = (regs[d] & mask) + n * c
+            elif kind == 'add_counter':
+                # Reads the counter before its update: n, n - 1, ..., 1
+                lines.append(f"    ADD  {name}, {name}, {_reg(COUNTER_REG, wide)}\n")
+                value = (regs[d] & mask) + n * (n + 1) // 2
+            elif kind == 'eor_imm':
+                c = rng.randrange(1, 4096)
+                lines.append(f"    EOR  {name}, {name}, #{c}\n")
+                value = (regs[d] & mask) ^ (c if n % 2 else 0)
+            elif kind == 'mul_imm':
+                c = rng.randrange(2, 16)
+                lines.append(f"    MUL  {name}, {name}, #{c}\n")
+                value = (regs[d] & mask) * pow(c, n, mask + 1)
+            elif kind == 'str_counter':
+                # The last iteration stores 1; the register is left alone. Only
+                # doublewords no load in this loop reads, or the load would see
+                # the previous iteration's counter from the second one on
+                free = [o for o in range(0, self.footprint, 8) if o not in stored]
+                if not free:
+                    lines.append("    NOP\n")
+                    continue
+                offset = rng.choice(free)
+                stored.add(offset)
+                lines.append(f"    STR  X{COUNTER_REG}, [SP, #{offset}]\n")
+                if live:
+                    address = regs[SP] + offset
+                    memory[address:address + 8] = (1).to_bytes(8, 'little')
+                continue
+            else:
+                # Loads from a doubleword this loop doesn't store to
+                free = [o for o in range(0, self.footprint, 8) if o not in stored]
+                offset = rng.choice(free) if free else 0
+                if offset in stored:
+                    lines.append("    NOP\n")
+                    continue
+                stored.add(offset)   # keep later stores off it
+                lines.append(f"    LDR  X{d}, [SP, #{offset}]\n")
+                if live:
+                    address = regs[SP] + offset
+                    regs[d] = int.from_bytes(memory[address:address + 8], 'little')
+                continue
+            if live:
+                regs[d] = value & mask
+        lines += [f"    SUB  X{COUNTER_REG}, X{COUNTER_REG}, #1\n",
+                  f"    CMP  X{COUNTER_REG}, #0\n",
+                  f"    B.GT loop_{block}\n"]
+        if live:
+            regs[COUNTER_REG] = 0
+        return lines
+
+    def _final_state(self, regs, memory, count, slots):
+        stack_base = ARM64Emulator(stack_size=self.stack_size).stack_base_addr
+        layout = PagedMemory()
+        layout.map_region('stack', stack_base, self.stack_size)
+        layout.write_block(stack_base, memory)
+        registers = {f'X{i}': regs[i] for i in range(31)}
+        registers['SP'] = stack_base + regs[SP]
+        return {
+            'registers': registers,
+            'pc': slots * 4,     # just past the final RET
+            'flags': {'N': int(regs[0] >= 1 << 63), 'Z': int(regs[0] == 0)},
+            'instruction_count': count,
+            'memory_sha256': memory_hash(layout),
+            'static_instructions': slots,
+            'labels': self.blocks + self.loops + 1,
+        }
+
+
+def compare(expected, result):
+    """(field, expected, actual) for every field of a batch_runner result that differs."""
+    differences = []
+    for name, value in expected['registers'].items():
+        if result.get('registers', {}).get(name) != value:
+            differences.append((name, value, result.get('registers', {}).get(name)))
+    for field in ('pc', 'flags', 'instruction_count', 'memory_sha256'):
+        if result.get(field) != expected[field]:
+            differences.append((field, expected[field], result.get(field)))
+    return differences
+
+
+def self_check(programs=400, seed=0):
+    """
+    Generates `programs` small programs with random settings from `seed`,
+    runs each through batch_runner and compares it with its expected state.
+    Returns [(settings, differences)] for the programs that disagree.
+    """
+    rng = random.Random(seed)
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'program.s')
+        for _ in range(programs):
+            settings = {'instructions': rng.randrange(1, 200), 'loops': rng.randrange(4),
+                        'trip_count': rng.randrange(1, 200), 'loop_body': rng.randrange(1, len(LOOP_REGS) + 1),
+                        'footprint': rng.choice((0, 16, 32, 64, 256)), 'jump_distance': rng.randrange(1, 5),
+                        'seed': rng.randrange(1 << 16)}
+            program = SyntheticProgram(**settings)
+            expected = program.write(path)
+            differences = compare(expected, run_job(program.job(path), time_budget=float('inf')))
+            if differences:
+                failures.append((settings, differences))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a large ARM64 test program with a known final state.")
+    parser.add_argument('-n', '--instructions', type=int, default=1000, metavar='N',
+                        help="approximate number of static instructions (default: 1000)")
+    parser.add_argument('--blocks', type=int, default=None, metavar='N',
+                        help="number of labelled blocks (default: instructions / 20)")
+    parser.add_argument('--loops', type=int, default=0, metavar='N', help="number of counted loops (default: 0)")
+    parser.add_argument('--trip-count', type=int, default=100, metavar='N',
+                        help="iterations of each loop (default: 100)")
+    parser.add_argument('--loop-body', type=int, default=4, metavar='N',
+                        help=f"instructions in each loop body, 1-{len(LOOP_REGS)} (default: 4)")
+    parser.add_argument('--footprint', type=int, default=256, metavar='BYTES',
+                        help="stack frame used by loads and stores; 0 for none (default: 256)")
+    parser.add_argument('--jump-distance', type=int, default=8, metavar='N',
+                        help="how many blocks a branch may skip (default: 8)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', metavar='FILE', help="write the program here instead of stdout")
+    parser.add_argument('--manifest', metavar='FILE',
+                        help="write a batch_runner job line for the program, with its expected state")
+    parser.add_argument('--check', action='store_true',
+                        help="run the written program on the emulator and compare its final state")
+    parser.add_argument('--self-check', type=int, default=None, metavar='N',
+                        help="instead of writing a program, check N small random ones (from --seed) "
+                             "against the emulator")
+    args = parser.parse_args(argv)
+    if args.self_check is not None:
+        failures = self_check(args.self_check, args.seed)
+        for settings, differences in failures:
+            print(f"MISMATCH {settings}: " + ", ".join(f"{field} expected {want}, got {got}"
+                                                      for field, want, got in differences), file=sys.stderr)
+        print(f"{args.self_check - len(failures)} of {args.self_check} programs match", file=sys.stderr)
+        sys.exit(1 if failures else 0)
+    if args.check and not args.output:
+        parser.error("--check needs --output")
+
+    program = SyntheticProgram(args.instructions, args.blocks, args.loops, args.trip_count,
+                               args.loop_body, args.footprint, args.jump_distance, args.seed)
+    if not args.output:
+        sys.stdout.writelines(program.lines())
+        return
+    expected = program.write(args.output)
+    print(f"{args.output}: {expected['static_instructions']} instructions, {expected['labels']} labels, "
+          f"{expected['instruction_count']} executed, stack {program.stack_size} bytes", file=sys.stderr)
+    job = program.job(args.output)
+    if args.manifest:
+        with open(args.manifest, 'w') as f:
+            f.write(json.dumps(dict(job, expected=expected)) + '\n')
+    if args.check:
+        result = run_job(job, time_budget=float('inf'))
+        differences = compare(expected, result)
+        print(f"{result['status']} after {result['wall_time']:.3f} s", file=sys.stderr)
+        for field, want, got in differences:
+            print(f"MISMATCH {field}: expected {want}, got {got}", file=sys.stderr)
+        sys.exit(1 if differences else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Parallel batch runner for the ARM64 emulator (emulator.py).
+
+Runs a whole corpus of assembly programs across a ProcessPoolExecutor and
+writes one JSON object per program (JSON lines): final registers, flags,
+a hash of memory, the instruction count, wall time and why the run
+stopped. Each job gets its own instruction and wall-clock budget.
+
+Input is either a directory (every *.s file in it, sorted by name) or a
+manifest. A manifest is a .jsonl file with one job per line, or a .json
+file holding a list of jobs. A job is an object with:
+    name              label for the result (defaults to the path)
+    path | source     a .s file (relative to the manifest) or inline assembly
+    registers         optional initial registers, e.g. {"X0": 5, "SP": "0x7ff..."}
+    max_instructions  optional, overrides --max-instructions
+    time_budget       optional seconds, overrides --time-budget
+    stack_size, data_size, heap_size   optional ARM64Emulator sizes
+
+With --shared-memory each distinct program is decoded once, here, and
+handed to the workers in a shared-memory segment (see shared_program.py)
+instead of being sent and parsed once per job.
+
+Usage:
+    python batch_runner.py corpus/ -j 8 -o results.jsonl
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from emulator import ARM64Emulator, INSTRUCTION_LIMIT, REG_SP
+from program_cache import ProgramCache
+from shared_program import SharedImage, SharedProgram
+
+# Default per-job wall-clock budget in seconds
+TIME_BUDGET = 10.0
+
+
+def load_jobs(target):
+    """Returns the job dicts for a directory of .s files or a manifest file."""
+    if os.path.isdir(target):
+        return [{'name': name, 'path': os.path.join(target, name)}
+                for name in sorted(os.listdir(target)) if name.endswith('.s')]
+    with open(target, 'r') as f:
+        if target.endswith('.jsonl'):
+            jobs = [json.loads(line) for line in f if line.strip()]
+        else:
+            jobs = json.load(f)
+    base = os.path.dirname(os.path.abspath(target))
+    for i, job in enumerate(jobs):
+        if 'path' in job:
+            job['path'] = os.path.join(base, job['path'])
+            job.setdefault('name', job['path'])
+        elif 'source' in job:
+            job.setdefault('name', f'job{i}')
+        else:
+            raise ValueError(f"Job {i} needs a 'path' or a 'source'")
+    return jobs
+
+
+def memory_hash(memory):
+    """SHA-256 over every page holding a non-zero byte, so untouched and zeroed pages hash alike."""
+    h = hashlib.sha256()
+    for page_number in sorted(memory.pages):
+        page = memory.pages[page_number]
+        if any(page):
+            h.update(page_number.to_bytes(8, 'little'))
+            h.update(page)
+    return h.hexdigest()
+
+
+def _register_value(value):
+    return int(value, 0) if isinstance(value, str) else int(value)
+
+
+def _read_program(job):
+    if 'path' in job:
+        with open(job['path'], 'r') as f:
+            return f.readlines()
+    return job['source'].splitlines(keepends=True)
+
+
+def run_job(job, max_instructions=INSTRUCTION_LIMIT, time_budget=TIME_BUDGET, cache_dir=None):
+    """
+    Runs one job in this process and returns its result dict. Besides a
+    path or source, a job may name a shared_program (and a shared_image
+    to start its memory from) by their shared_program.py handles.
+    """
+    result = {'name': job.get('name')}
+    start = time.perf_counter()
+    emulator = None
+    try:
+        program = None if 'shared_program' in job else _read_program(job)
+        emulator = ARM64Emulator(stack_size=job.get('stack_size', 256),
+                                 data_size=job.get('data_size', 0),
+                                 heap_size=job.get('heap_size', 0),
+                                 program_cache=ProgramCache(cache_dir) if cache_dir else None)
+        if program is None:
+            decoded = SharedProgram.attach(job['shared_program']).decode_into(emulator)
+        else:
+            decoded = emulator.decode(program)
+        if 'shared_image' in job:
+            SharedImage.attach(job['shared_image']).map_into(emulator.memory)
+        for name, value in job.get('registers', {}).items():
+            emulator._set_reg(name.upper(), _register_value(value))
+        result['status'] = emulator.run_decoded_budgeted(
+            decoded, job.get('max_instructions', max_instructions),
+            job.get('time_budget', time_budget))
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['wall_time'] = time.perf_counter() - start
+    if emulator is None:
+        return result
+    regs = emulator.regs
+    result['registers'] = {f'X{i}': regs[i] for i in range(31)}
+    result['registers']['SP'] = regs[REG_SP]
+    result['pc'] = emulator.pc
+    result['flags'] = {'N': emulator.n_flag, 'Z': emulator.z_flag}
+    result['instruction_count'] = emulator.instruction_count
+    result['memory_sha256'] = memory_hash(emulator.memory)
+    return result
+
+
+def _run_job_args(args):
+    return run_job(*args)
+
+
+def share_programs(jobs, cache_dir=None):
+    """
+    Jobs that name a SharedProgram instead of their path or source, one
+    per distinct program text, and the SharedPrograms (unlink them when
+    the jobs are done). Jobs whose file can't be read, or whose program
+    can't be shared, are left as they are.
+    """
+    programs = {}
+    shared_jobs = []
+    for job in jobs:
+        try:
+            text = ''.join(_read_program(job))
+            if text not in programs:
+                emulator = ARM64Emulator(program_cache=ProgramCache(cache_dir) if cache_dir else None)
+                programs[text] = SharedProgram.create(emulator, text.splitlines(keepends=True))
+        except (OSError, ValueError):
+            shared_jobs.append(job)
+            continue
+        job = {key: value for key, value in job.items() if key not in ('path', 'source')}
+        job['shared_program'] = programs[text].handle
+        shared_jobs.append(job)
+    return shared_jobs, list(programs.values())
+
+
+def run_batch(jobs, workers=None, max_instructions=INSTRUCTION_LIMIT,
+              time_budget=TIME_BUDGET, cache_dir=None, shared_memory=False):
+    """
+    Yields one result per job, in job order, running them on `workers`
+    processes. With shared_memory, programs reach the workers through
+    share_programs().
+    """
+    segments = []
+    if shared_memory:
+        jobs, segments = share_programs(jobs, cache_dir)
+    tasks = [(job, max_instructions, time_budget, cache_dir) for job in jobs]
+    try:
+        if workers == 1:
+            yield from map(_run_job_args, tasks)
+            return
+        workers = workers or os.cpu_count() or 1
+        chunksize = max(1, len(tasks) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            yield from pool.map(_run_job_args, tasks, chunksize=chunksize)
+    finally:
+        for segment in segments:
+            segment.unlink()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run many assembly programs in parallel.")
+    parser.add_argument('target', help="directory of .s files, or a .json/.jsonl manifest")
+    parser.add_argument('-j', '--jobs', type=int, default=None, metavar='N',
+                        help="worker processes (default: all cores)")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="write JSON lines here instead of stdout")
+    parser.add_argument('--max-instructions', type=int, default=INSTRUCTION_LIMIT, metavar='N',
+                        help=f"per-job instruction budget (default: {INSTRUCTION_LIMIT})")
+    parser.add_argument('--time-budget', type=float, default=TIME_BUDGET, metavar='SECONDS',
+                        help=f"per-job wall-clock budget (default: {TIME_BUDGET})")
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help="program cache directory (default: $ARM64EMU_CACHE_DIR "
+                             "or ~/.cache/arm64emu)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="parse every program instead of using the program cache")
+    parser.add_argument('--shared-memory', action='store_true',
+                        help="decode each distinct program once and share it with the workers")
+    args = parser.parse_args(argv)
+
+    jobs = load_jobs(args.target)
+    cache_dir = None if args.no_cache else (args.cache_dir or ProgramCache().directory)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    counts = {}
+    try:
+        for result in run_batch(jobs, args.jobs, args.max_instructions, args.time_budget, cache_dir,
+                                args.shared_memory):
+            out.write(json.dumps(result) + '\n')
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    summary = ', '.join(f"{status}: {n}" for status, n in sorted(counts.items()))
+    print(f"{len(jobs)} jobs ({summary})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
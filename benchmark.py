@@ -0,0 +1,464 @@
+"""
+Benchmark suite for the three emulator cores: emulator.py ARM64Emulator,
+Rough.py CPU/Emulator and Task_7.py ARM64Emulator.
+
+Every backend runs the same workloads, each generated at a given size:
+arithmetic loops, load/store loops, branch-heavy code and scaled-up
+versions of test.s, BRC_TEST.s and MEM_TEST.s. Each (backend, workload)
+pair is measured in a fresh worker process with a wall-clock timeout, so
+a core that hangs or crashes only loses its own results. A measurement
+reports:
+
+    startup_seconds   constructing the emulator and loading the program file
+    run_seconds       executing it (best of --repeats runs)
+    ips               instructions per second; the instruction count is that
+                      of the same program on emulator.py, which also supplies
+                      the expected final registers
+    peak_bytes        peak Python allocations while loading and running it
+                      (a separate run under tracemalloc)
+    status            'ok', 'mismatch' (wrong final registers), 'error' or 'timeout'
+
+Results are written as JSON with --output, and --baseline compares a run
+against stored results, flagging any measurement that got slower, bigger
+or stopped passing:
+
+    python benchmark.py -o baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from emulator import ARM64Emulator
+
+# Workloads stop well before this; it only guards against runaway loops
+MAX_INSTRUCTIONS = 10 ** 9
+
+# Default per-measurement wall-clock timeout in seconds
+TIMEOUT = 120.0
+
+# Relative change that counts as a regression in compare()
+TOLERANCE = 0.10
+
+
+# --- Workloads ---
+# Each returns the program text for `n` iterations; WORKLOADS also lists
+# the registers that hold its results and the default size.
+def arith_loop(n):
+    return f"""
+    MOV  X0, #{n}
+    MOV  X1, #0
+    MOV  X2, #1
+loop:
+    ADD  X1, X1, X0
+    EOR  X3, X1, X0
+    AND  X4, X3, #255
+    MUL  X2, X2, #3
+    SUB  X0, X0, #1
+    CMP  X0, #0
+    B.GT loop
+    RET
+"""
+
+
+def mem_loop(n):
+    return f"""
+    SUB  SP, SP, #32
+    MOV  X0, #{n}
+    MOV  X1, #0
+loop:
+    STR  X0, [SP, #0]
+    LDR  X2, [SP, #0]
+    STRB W2, [SP, #8]
+    LDRB W3, [SP, #8]
+    ADD  X1, X1, X3
+    SUB  X0, X0, #1
+    CMP  X0, #0
+    B.GT loop
+    ADD  SP, SP, #32
+    RET
+"""
+
+
+def branchy(n):
+    return f"""
+    MOV  X0, #{n}
+    MOV  X1, #0
+    MOV  X5, #0
+loop:
+    AND  X2, X0, #3
+    CMP  X2, #1
+    B.LE low
+    CMP  X2, #2
+    B.LE two
+    ADD  X1, X1, #3
+    B    next
+two:
+    ADD  X1, X1, #2
+    B    next
+low:
+    ADD  X5, X5, #1
+next:
+    SUB  X0, X0, #1
+    CMP  X0, #0
+    B.GT loop
+    RET
+"""
+
+
+def factorial(n):
+    # test.s, run n times
+    return f"""
+    MOV  X9, #{n}
+outer:
+    MOV  W0, #1
+    MOV  W1, #5
+loop:
+    CMP  W1, #1
+    B.LE end_loop
+    MUL  W0, W0, W1
+    SUB  W1, W1, #1
+    B    loop
+end_loop:
+    NOP
+    SUB  X9, X9, #1
+    CMP  X9, #0
+    B.GT outer
+    RET
+"""
+
+
+def branch_sum(n):
+    # BRC_TEST.s, counting down from n instead of 5
+    return f"""
+    MOV  W0, #{n}
+    MOV  W1, #0
+    B    check
+loop:
+    ADD  W1, W1, W0
+    SUB  W0, W0, #1
+check:
+    CMP  W0, #0
+    B.GT loop
+    RET
+"""
+
+
+def mem_test(n):
+    # MEM_TEST.s, run n times (#65 is its #'A')
+    return f"""
+    MOV  X9, #{n}
+outer:
+    SUB  SP, SP, #16
+    MOV  X0, #0x11223344AABBCCDD
+    STR  X0, [SP, #0]
+    MOV  W1, #65
+    STRB W1, [SP, #15]
+    MOV  X0, #0
+    MOV  W1, #0
+    LDR  X2, [SP, #0]
+    LDRB W3, [SP, #15]
+    LDRB W4, [SP, #2]
+    ADD  SP, SP, #16
+    SUB  X9, X9, #1
+    CMP  X9, #0
+    B.GT outer
+    RET
+"""
+
+
+# name -> (generator, result registers, default size)
+WORKLOADS = {
+    'arith_loop': (arith_loop, ('X0', 'X1', 'X2', 'X3', 'X4'), 2000),
+    'mem_loop': (mem_loop, ('X0', 'X1', 'X2', 'X3'), 2000),
+    'branchy': (branchy, ('X0', 'X1', 'X5'), 2000),
+    'factorial': (factorial, ('X0', 'X1', 'X9'), 500),
+    'branch_sum': (branch_sum, ('X0', 'X1'), 4000),
+    'mem_test': (mem_test, ('X0', 'X1', 'X2', 'X3', 'X4', 'X9'), 1000),
+}
+
+
+# --- Backends ---
+# Each backend loads a program file into a fresh emulator (the startup
+# cost), runs it and reads registers back.
+class EmulatorBackend:
+    """emulator.py ARM64Emulator, through run() or run_translated()."""
+    def __init__(self, translated=False):
+        self.translated = translated
+
+    def load(self, path):
+        self.emulator = ARM64Emulator()
+        with open(path, 'r') as f:
+            self.program = f.readlines()
+        self.decoded = self.emulator.decode(self.program)
+
+    def run(self):
+        if self.translated:
+            self.emulator.run_translated(self.program, verbosity='silent',
+                                         max_instructions=MAX_INSTRUCTIONS)
+        else:
+            self.emulator.run_decoded(self.decoded, verbosity='silent',
+                                      max_instructions=MAX_INSTRUCTIONS)
+
+    def register(self, name):
+        return self.emulator._get_reg(name)
+
+
+class RoughBackend:
+    """Rough.py CPU and Emulator, through execute() or execute_translated()."""
+    def __init__(self, translated=False):
+        import Rough
+        self.rough = Rough
+        self.translated = translated
+        Rough.STEP_LIMIT = MAX_INSTRUCTIONS
+
+    def load(self, path):
+        entries, labels = self.rough.decode_asm_file(path)
+        self.cpu = self.rough.CPU(stack_size=256, stack_base=0x0)
+        self.emulator = self.rough.Emulator(self.cpu)
+        self.emulator.load_decoded(entries, labels)
+        self.cpu.regs['PC'] = 0
+
+    def run(self):
+        if self.translated:
+            self.emulator.execute_translated()
+        else:
+            self.emulator.execute()
+
+    def register(self, name):
+        return self.cpu.read_reg(name)
+
+
+class Task7Backend:
+    """Task_7.py ARM64Emulator (the final version of the class)."""
+    def __init__(self):
+        import Task_7
+        self.task7 = Task_7
+
+    def load(self, path):
+        self.emulator = self.task7.ARM64Emulator()
+        self.program = self.emulator.load_program(path)
+
+    def run(self):
+        self.emulator.run(self.program)
+
+    def register(self, name):
+        return self.emulator.get_register(name)
+
+
+BACKENDS = {
+    'emulator': lambda: EmulatorBackend(),
+    'emulator-translated': lambda: EmulatorBackend(translated=True),
+    'rough': lambda: RoughBackend(),
+    'rough-translated': lambda: RoughBackend(translated=True),
+    'task7': lambda: Task7Backend(),
+}
+
+
+# --- Measurement ---
+def reference(workload, size):
+    """(instruction count, {register: value}) of the workload on emulator.py."""
+    generator, registers, _ = WORKLOADS[workload]
+    emulator = ARM64Emulator()
+    emulator.run(generator(size).splitlines(True), verbosity='silent',
+                 max_instructions=MAX_INSTRUCTIONS)
+    return emulator.instruction_count, {name: emulator._get_reg(name) for name in registers}
+
+
+def measure(backend_name, path, registers, repeats):
+    """Measures one backend on one program file in this process; returns a result dict."""
+    result = {}
+    startup = run_time = None
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(repeats):
+            backend = BACKENDS[backend_name]()
+            start = time.perf_counter()
+            backend.load(path)
+            loaded = time.perf_counter()
+            backend.run()
+            done = time.perf_counter()
+            startup = min(startup or loaded - start, loaded - start)
+            run_time = min(run_time or done - loaded, done - loaded)
+
+        backend = BACKENDS[backend_name]()
+        tracemalloc.start()
+        try:
+            backend.load(path)
+            backend.run()
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    result['startup_seconds'] = startup
+    result['run_seconds'] = run_time
+    result['registers'] = {name: backend.register(name) for name in registers}
+    return result
+
+
+def _worker(conn, backend_name, path, registers, repeats):
+    try:
+        conn.send(('ok', measure(backend_name, path, registers, repeats)))
+    except BaseException as e:
+        conn.send(('error', f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def run_isolated(backend_name, path, registers, repeats, timeout=TIMEOUT):
+    """measure() in a worker process; returns (status, result dict or error message)."""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_worker,
+                                      args=(sender, backend_name, path, registers, repeats))
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout):
+            return 'timeout', f"no result within {timeout:g} s"
+        try:
+            return receiver.recv()
+        except EOFError:
+            return 'error', f"worker exited with code {process.exitcode}"
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        receiver.close()
+
+
+def run_suite(backends, workloads, scale=1.0, repeats=3, timeout=TIMEOUT, log=None):
+    """Runs every backend on every workload; returns the results document."""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for workload in workloads:
+            generator, registers, default_size = WORKLOADS[workload]
+            size = max(1, int(default_size * scale))
+            path = os.path.join(directory, f'{workload}.s')
+            with open(path, 'w') as f:
+                f.write(generator(size))
+            instructions, expected = reference(workload, size)
+            for backend_name in backends:
+                status, measured = run_isolated(backend_name, path, registers, repeats, timeout)
+                entry = {'backend': backend_name, 'workload': workload, 'size': size,
+                         'instructions': instructions, 'status': status}
+                if status == 'ok':
+                    got = measured.pop('registers')
+                    entry.update(measured)
+                    if got == expected:
+                        entry['ips'] = instructions / max(measured['run_seconds'], 1e-9)
+                    else:
+                        # A wrong answer usually means the run stopped early, so no ips
+                        entry['status'] = 'mismatch'
+                        entry['error'] = ', '.join(f"{name}={got[name]:#x} (expected {expected[name]:#x})"
+                                                   for name in registers if got[name] != expected[name])
+                else:
+                    entry['error'] = measured
+                results.append(entry)
+                if log is not None:
+                    log(format_entry(entry))
+    return {
+        'suite': 'arm64-emulators',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': scale,
+        'repeats': repeats,
+        'results': results,
+    }
+
+
+# --- Reports ---
+def format_entry(entry):
+    head = f"{entry['backend']:<20} {entry['workload']:<12} {entry['size']:>7}"
+    if entry['status'] != 'ok':
+        return f"{head}  {entry['status']}: {entry['error']}"
+    return (f"{head}  {entry['ips'] / 1e3:>10.1f} k instr/s  startup {entry['startup_seconds'] * 1e3:>8.2f} ms"
+            f"  peak {entry['peak_bytes'] / 1024:>9.1f} KiB")
+
+
+def compare(document, baseline, tolerance=TOLERANCE):
+    """
+    Lines comparing `document` with `baseline` (both from run_suite) and the
+    number of regressions: a measurement whose ips dropped, or whose startup
+    time or peak memory grew, by more than `tolerance`, that passed in the
+    baseline and doesn't now, or that the baseline has and `document` lacks.
+    """
+    old = {(e['backend'], e['workload'], e['size']): e for e in baseline['results']}
+    lines = []
+    regressions = 0
+    for entry in document['results']:
+        key = (entry['backend'], entry['workload'], entry['size'])
+        before = old.get(key)
+        name = f"{key[0]:<20} {key[1]:<12} {key[2]:>7}"
+        if before is None:
+            lines.append(f"{name}  new")
+            continue
+        problems = []
+        if before['status'] == 'ok' and entry['status'] != 'ok':
+            problems.append(f"now {entry['status']}")
+        changes = []
+        if before.get('ips') and entry.get('ips'):
+            for field, label, worse in (('ips', 'ips', -1), ('startup_seconds', 'startup', 1),
+                                        ('peak_bytes', 'peak', 1)):
+                ratio = entry[field] / before[field] if before[field] else 1.0
+                changes.append(f"{label} {ratio:6.2f}x")
+                if (ratio - 1) * worse > tolerance:
+                    problems.append(f"{label} {'down' if worse < 0 else 'up'} {abs(ratio - 1):.0%}")
+        if not changes:
+            # No ratios without a passing run on both sides
+            changes.append(f"{before['status']} -> {entry['status']}")
+        regressions += bool(problems)
+        lines.append(f"{name}  {'  '.join(changes)}" + (f"  REGRESSION: {', '.join(problems)}" if problems else ''))
+    current = {(e['backend'], e['workload'], e['size']) for e in document['results']}
+    for key in old:
+        if key not in current:
+            lines.append(f"{key[0]:<20} {key[1]:<12} {key[2]:>7}  missing  REGRESSION: not measured")
+            regressions += 1
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ARM64 emulator cores on a common workload set.")
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS),
+                        metavar='NAME', help=f"backends to run (default: all of {', '.join(BACKENDS)})")
+    parser.add_argument('--workloads', nargs='+', choices=list(WORKLOADS), default=list(WORKLOADS),
+                        metavar='NAME', help=f"workloads to run (default: all of {', '.join(WORKLOADS)})")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="multiply every workload's default size by this (default: 1)")
+    parser.add_argument('--repeats', type=int, default=3, metavar='N',
+                        help="timed runs per measurement; the best one counts (default: 3)")
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, metavar='SECONDS',
+                        help=f"per-measurement wall-clock limit (default: {TIMEOUT:g})")
+    parser.add_argument('-o', '--output', metavar='FILE', help="write the results as JSON to FILE")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="compare with results stored by an earlier --output run; "
+                             "exits with status 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help=f"relative change that counts as a regression (default: {TOLERANCE})")
+    args = parser.parse_args(argv)
+
+    document = run_suite(args.backends, args.workloads, args.scale, args.repeats, args.timeout,
+                         log=print)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=1)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        lines, regressions = compare(document, baseline, args.tolerance)
+        print(f"\nAgainst {args.baseline}:")
+        for line in lines:
+            print(line)
+        if regressions:
+            print(f"{regressions} regression(s)")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
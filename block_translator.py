@@ -0,0 +1,265 @@
+"""
+Basic-block translator shared by the ARM64 emulators (emulator.py, Rough.py).
+
+Each emulator lowers its decoded program to a small tuple IR, one entry per
+4-byte instruction slot. The translator splits the program into basic blocks
+at labels and branches, generates Python source for each block and compiles
+it with compile() into a single function. A block function takes the state
+object (the emulator or CPU), updates its registers and flags, and returns
+the PC of the next block.
+
+IR entries (None marks a slot that is skipped, e.g. a comment-only line):
+    ('alu', op, dst, src1, src2, set_flags)  op is one of + - * & ^
+    ('mov', dst, src)
+    ('cmp', src1, src2)
+    ('load', dst, base, offset, num_bytes)
+    ('store', src, base, offset, num_bytes)
+    ('b', cond, target, label)               cond is None, 'GT' or 'LE'
+    ('nop',)
+    ('ret',)
+    ('call', func, args)                     interpreter fallback, ends the block
+A source operand is ('reg', key, mask) or ('imm', value), a destination is
+(key, mask) or None for writes that are discarded, and a memory base is
+always ('reg', key, mask). Flags are N and Z of the 64-bit result.
+"""
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+# Upper bound on instructions per block, so huge straight-line programs
+# do not turn into one enormous function.
+MAX_BLOCK_LEN = 256
+
+# IR ops that end a basic block
+_TERMINATORS = ('b', 'ret', 'call')
+
+
+class Block:
+    """A compiled basic block plus what the driver needs to account for it."""
+    __slots__ = ('func', 'length', 'pcs', 'texts', 'source')
+
+    def __init__(self, func, length, pcs, texts, source):
+        self.func = func        # func(state) -> next PC
+        self.length = length    # instructions executed when the block completes
+        self.pcs = pcs          # PC of every executed instruction, in order
+        self.texts = texts      # source text of every executed instruction
+        self.source = source    # generated Python source, for debugging
+
+
+class BlockTranslator:
+    """
+    Translates and caches basic blocks for one program.
+
+    `loads`/`stores` map an access size to a source template for the
+    backend's memory helpers, `call_setup` is a template run before an
+    interpreter fallback and `call_next` is the expression for the PC
+    that follows it. Backends with lazy flags name the attribute holding
+    the last flag-setting result (and optionally its width) so blocks store
+    that instead of N and Z.
+    """
+    def __init__(self, ir, texts, leaders, loads, stores, call_setup, call_next,
+                 regs_attr='regs', n_attr='n_flag', z_attr='z_flag',
+                 flag_result_attr=None, flag_width_attr=None):
+        self.ir = ir
+        self.texts = texts
+        self.leaders = set(leaders)
+        self.loads = loads
+        self.stores = stores
+        self.call_setup = call_setup
+        self.call_next = call_next
+        self.regs_attr = regs_attr
+        self.n_attr = n_attr
+        self.z_attr = z_attr
+        self.flag_result_attr = flag_result_attr
+        self.flag_width_attr = flag_width_attr
+        self.blocks = {}
+        self.fault_offset = 0
+
+    def block_at(self, pc):
+        """Returns the compiled block starting at `pc`, translating it on first use."""
+        block = self.blocks.get(pc)
+        if block is None:
+            block = self.blocks[pc] = self._translate(pc // 4)
+        return block
+
+    # --- Block Formation ---
+    def _collect(self, start):
+        """Returns the slots of the block starting at `start` and its fallthrough PC."""
+        slots = []
+        i = start
+        while i < len(self.ir):
+            if i != start and i in self.leaders:
+                break
+            entry = self.ir[i]
+            i += 1
+            if entry is None:
+                continue
+            slots.append(i - 1)
+            if entry[0] in _TERMINATORS or len(slots) >= MAX_BLOCK_LEN:
+                break
+        return slots, i * 4
+
+    # --- Code Generation ---
+    def _translate(self, start):
+        slots, fallthrough = self._collect(start)
+        gen = _BlockSource(self)
+        for offset, slot in enumerate(slots):
+            gen.emit_instruction(offset, slot * 4, self.ir[slot])
+        source, namespace = gen.finish(fallthrough)
+        namespace['T'] = self
+        code = compile(source, f'<block {start * 4:#x}>', 'exec')
+        exec(code, namespace)
+        return Block(namespace['block'], len(slots), tuple(s * 4 for s in slots),
+                     tuple(self.texts[s] for s in slots), source)
+
+
+class _BlockSource:
+    """Accumulates the generated source of one block."""
+    def __init__(self, translator):
+        self.t = translator
+        self.body = []
+        self.reg_locals = {}   # register key -> local variable name
+        self.written = []      # register keys written in this block, in order
+        self.flags_set = False # whether the f_ local holds the last flag result
+        self.consts = {}       # extra names for the block namespace
+        self.returned = False
+
+    def local(self, key):
+        name = self.reg_locals.get(key)
+        if name is None:
+            name = self.reg_locals[key] = f'r{len(self.reg_locals)}'
+        return name
+
+    def src(self, operand):
+        if operand[0] == 'imm':
+            return f'({operand[1]!r})'
+        _, key, mask = operand
+        name = self.local(key)
+        return name if mask == MASK64 else f'({name} & {mask:#x})'
+
+    def write(self, dst, expr, in_range=False):
+        """Assigns `expr` to a register; `in_range` means it already fits in 64 bits."""
+        if dst is None:
+            return
+        key, mask = dst
+        name = self.local(key)
+        if key not in self.written:
+            self.written.append(key)
+        if in_range and mask == MASK64:
+            self.line(f'{name} = {expr}')
+        else:
+            self.line(f'{name} = ({expr}) & {mask:#x}')
+
+    def line(self, text):
+        self.body.append('        ' + text)
+
+    def flush_lines(self, indent, guard_flags=False):
+        lines = [f'R[{key!r}] = {self.reg_locals[key]}' for key in self.written]
+        if self.flags_set:
+            if self.t.flag_result_attr:
+                flags = [f'S.{self.t.flag_result_attr} = f_']
+                if self.t.flag_width_attr:
+                    flags.append(f'S.{self.t.flag_width_attr} = 64')
+            else:
+                flags = [f'S.{self.t.z_attr} = 1 if f_ == 0 else 0',
+                         f'S.{self.t.n_attr} = f_ >> 63']
+            if guard_flags:
+                # On a fault the flag result may not have been computed yet
+                lines.append('if f_ is not None:')
+                lines += ['    ' + text for text in flags]
+            else:
+                lines += flags
+        return [indent + text for text in lines]
+
+    def cond_expr(self, cond):
+        if self.flags_set:
+            if cond == 'GT':
+                return 'f_ and f_ < 0x8000000000000000'
+            return 'not (f_ and f_ < 0x8000000000000000)'
+        n, z = f'S.{self.t.n_attr}', f'S.{self.t.z_attr}'
+        if cond == 'GT':
+            return f'{z} == 0 and {n} == 0'
+        return f'{z} == 1 or {n} == 1'
+
+    def emit_instruction(self, offset, pc, entry):
+        op = entry[0]
+        if op == 'alu':
+            _, sym, dst, src1, src2, set_flags = entry
+            expr = f'{self.src(src1)} {sym} {self.src(src2)}'
+            if set_flags:
+                self.line(f'f_ = ({expr}) & 0xffffffffffffffff')
+                self.flags_set = True
+                self.write(dst, 'f_', in_range=True)
+            else:
+                self.write(dst, expr)
+        elif op == 'mov':
+            _, dst, src = entry
+            if src[0] == 'imm':
+                self.write(dst, repr(src[1] & MASK64), in_range=True)
+            else:
+                self.write(dst, self.src(src), in_range=True)
+        elif op == 'cmp':
+            _, src1, src2 = entry
+            self.line(f'f_ = ({self.src(src1)} - {self.src(src2)}) & 0xffffffffffffffff')
+            self.flags_set = True
+        elif op == 'load':
+            _, dst, base, offset_imm, num_bytes = entry
+            self.line(f'at = {offset}')
+            addr = f'{self.src(base)} + {offset_imm!r}'
+            load = self.t.loads[num_bytes].format(addr=addr)
+            if dst is None:
+                self.line(load)  # still performed for its bounds check
+            else:
+                self.write(dst, load, in_range=True)
+        elif op == 'store':
+            _, src, base, offset_imm, num_bytes = entry
+            self.line(f'at = {offset}')
+            addr = f'{self.src(base)} + {offset_imm!r}'
+            self.line(self.t.stores[num_bytes].format(addr=addr, value=self.src(src)))
+        elif op == 'b':
+            _, cond, target, label = entry
+            if target is None:
+                self.line(f'at = {offset}')
+                taken = f'raise ValueError({"Undefined label: " + label!r})'
+            else:
+                taken = f'return {target!r}'
+            if cond is None:
+                self.body.extend(self.flush_lines('        '))
+                self.line(taken)
+            else:
+                taken_if = self.cond_expr(cond)
+                self.body.extend(self.flush_lines('        '))
+                self.line(f'if {taken_if}:')
+                self.line('    ' + taken)
+                self.line(f'return {pc + 4!r}')
+            self.returned = True
+        elif op == 'ret':
+            self.body.extend(self.flush_lines('        '))
+            self.line('S.running = False')
+            self.line(f'return {pc + 4!r}')
+            self.returned = True
+        elif op == 'call':
+            _, func, args = entry
+            name = f'CALL{offset}'
+            self.consts[name] = func
+            self.consts[name + '_ARGS'] = args
+            self.line(f'at = {offset}')
+            self.body.extend(self.flush_lines('        '))
+            self.line('synced = True')
+            self.line(self.t.call_setup.format(pc=pc, next=pc + 4))
+            self.line(f'{name}(*{name}_ARGS)')
+            self.line(f'return {self.t.call_next}')
+            self.returned = True
+        # 'nop' generates no code
+
+    def finish(self, fallthrough):
+        if not self.returned:
+            self.body.extend(self.flush_lines('        '))
+            self.line(f'return {fallthrough!r}')
+        head = ['def block(S):', f'    R = S.{self.t.regs_attr}']
+        head += [f'    {name} = R[{key!r}]' for key, name in self.reg_locals.items()]
+        head += ['    f_ = None', '    at = 0', '    synced = False', '    try:']
+        tail = ['    except BaseException:', '        if not synced:']
+        tail += self.flush_lines('            ', guard_flags=True) or ['            pass']
+        tail += ['        T.fault_offset = at', '        raise']
+        source = '\n'.join(head + self.body + tail) + '\n'
+        return source, dict(self.consts)
@@ -0,0 +1,635 @@
+"""
+Differential co-simulation of the ARM64 emulator backends.
+
+Runs one program on several backends in lockstep: emulator.py's threaded
+interpreter and block translator, Rough.py's interpreter and block
+translator, and Task_7.py. Every backend runs the same number of
+instructions, and after every --every instructions their architectural
+states are compared:
+
+    X0-X30, SP, PC, N, Z   registers (as 64-bit values) and flags
+    status                 'running', 'ret', 'end' (PC left the program) or 'error'
+    memory                 the stack's contents
+
+Memory goes into the state as a digest, the sum of one hash per non-zero
+page. Each checkpoint only rehashes the pages written since the last one
+(PagedMemory pages are frozen by snapshot(), so a written page is a new
+object; Rough's flat stack is compared page by page against a copy), so
+a checkpoint costs about the same however big memory is, and a run costs
+little more than the backends running on their own.
+
+When the states disagree, the backends are rebuilt and run to the last
+checkpoint where they agreed, then step one instruction at a time to the
+first instruction after which they disagree. The report names it and
+lists only the fields (and stack bytes) that differ:
+
+    $ python cosim.py arithmetic_test.s --ignore none
+    arithmetic_test.s: diverged after instruction 3 (PC 0x8: ADD  X2, X0, X1)
+        field   emulator   rough   task7
+        Z       0          1       0
+
+States are compared before the first instruction too. Backends agree on
+a common layout: a stack of --stack-size bytes at address 0, with SP at
+its top, and N=0, Z=1 (Rough's own reset flags are N=0, Z=0). PCs are
+compared as 4 * the index of the instruction in the program, so
+comment-only lines, which take a slot in emulator.py, don't shift them.
+
+The flags are left out by default (DEFAULT_IGNORE), since Rough's ALU
+instructions don't set them and the other cores' do. A flag difference
+that matters still shows up, as a different PC after the next B.GT or
+B.LE. --ignore replaces the default ('none' compares every field).
+--samples adds the repository's sample programs, which the default
+backends must agree on:
+
+    $ python cosim.py --samples
+    5 agreed, 0 diverged (5 programs)
+
+A new backend is a Backend subclass added to BACKENDS.
+
+Usage:
+    python cosim.py prog.s [--backends emulator,rough,task7] [--every N]
+    python cosim.py corpus_dir/ -j 8 --fail-fast
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from emulator import ARM64Emulator, REG_SP
+from paged_memory import PAGE_SIZE, PagedMemory
+
+# Instructions between state comparisons
+DEFAULT_EVERY = 1000
+
+# Instructions per program; corpus programs run far past emulator.py's default limit
+MAX_INSTRUCTIONS = 10_000_000
+
+DEFAULT_BACKENDS = ('emulator', 'rough', 'task7')
+
+# Fields left out unless --ignore says otherwise. Rough's ALU instructions
+# don't set the flags (as on real hardware) while the other cores' do; a
+# flag difference that changes behaviour still shows up as a different PC
+# after the next conditional branch
+DEFAULT_IGNORE = ('flags',)
+
+# The repository's sample programs, which the defaults must agree on (--samples)
+SAMPLE_PROGRAMS = ('test.s', 'BRC_TEST.s', 'arithmetic_test.s', 'test_program.s', 'MEM_TEST.s')
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+# Compared fields, in state() order; the memory digest comes last
+FIELDS = tuple(f"X{i}" for i in range(31)) + ('SP', 'PC', 'N', 'Z', 'status', 'memory')
+
+# --ignore names for groups of fields
+FIELD_GROUPS = {'flags': ('N', 'Z'), 'registers': FIELDS[:31]}
+
+# Differing stack byte ranges shown in a report
+MAX_MEMORY_DIFFS = 8
+
+_ZERO_PAGE = bytes(PAGE_SIZE)
+
+
+def _page_hash(number, page):
+    if page == _ZERO_PAGE:
+        return 0
+    digest = hashlib.blake2b(page, digest_size=8, salt=number.to_bytes(16, 'little')).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class PagedDigest:
+    """Incremental digest of a PagedMemory: only pages written since the last digest() are hashed."""
+    def __init__(self, memory):
+        self.memory = memory
+        self.hashes = {}   # page number -> (page object, hash)
+
+    def digest(self):
+        hashes = {}
+        total = 0
+        # snapshot() freezes every page, so a write after it replaces the page object
+        for number, page in self.memory.snapshot().items():
+            cached = self.hashes.get(number)
+            if cached is None or cached[0] is not page:
+                cached = (page, _page_hash(number, page))
+            hashes[number] = cached
+            total += cached[1]
+        self.hashes = hashes
+        return total & MASK64
+
+
+class FlatDigest:
+    """Incremental digest of a bytearray mapped at address 0, a page at a time."""
+    def __init__(self, data):
+        self.data = data
+        self.pages = {}    # page number -> (contents, hash)
+
+    def digest(self):
+        view = memoryview(self.data)
+        total = 0
+        for number in range(-(-len(view) // PAGE_SIZE)):
+            chunk = view[number * PAGE_SIZE:(number + 1) * PAGE_SIZE]
+            cached = self.pages.get(number)
+            if cached is None or cached[0] != chunk:
+                page = bytes(chunk).ljust(PAGE_SIZE, b'\0')
+                cached = self.pages[number] = (page[:len(chunk)], _page_hash(number, page))
+            total += cached[1]
+        view.release()
+        return total & MASK64
+
+
+# --- Backends ---
+# A backend loads a program file into a fresh emulator with the common
+# stack layout. advance(total) runs it until it has executed `total`
+# instructions in all, or stops; status, executed and error record where
+# it is. registers() returns X0-X30, SP, PC (as 4 * instruction index)
+# and N, Z; the PC of an instruction that raised is its own.
+class Backend:
+    name = None
+
+    def __init__(self, path, stack_size):
+        self.stack_size = stack_size
+        self.status = 'running'
+        self.executed = 0
+        self.error = None
+
+    def state(self, memory=True):
+        """Tuple of every FIELDS value, the memory digest 0 unless `memory`."""
+        x, sp, pc, n, z = self.registers()
+        return tuple(value & MASK64 for value in x) + (sp & MASK64, pc, n, z, self.status,
+                                                       self.digest.digest() if memory else 0)
+
+    def fields(self):
+        """FIELDS name -> value, with the stack's bytes as 'memory'."""
+        state = self.state(memory=False)[:-1]
+        return dict(zip(FIELDS, state + (self.stack(),)))
+
+    def _stop(self, status, error=None):
+        self.status = status
+        self.error = error
+
+
+class EmulatorBackend(Backend):
+    """emulator.py ARM64Emulator: threaded interpreter with superinstructions, or block translator."""
+    name = 'emulator'
+    fuse = True
+    translated = False
+
+    def __init__(self, path, stack_size):
+        super().__init__(path, stack_size)
+        emulator = self.emulator = ARM64Emulator(stack_size)
+        emulator.memory = PagedMemory()
+        emulator.memory.map_region('stack', 0, stack_size)
+        emulator.stack_base_addr = 0
+        emulator.regs[REG_SP] = stack_size
+        emulator.fuse_pairs = self.fuse
+        with open(path, 'r') as f:
+            self.decoded = emulator.decode(f.readlines())
+        self.threaded = None if self.translated else emulator.thread(self.decoded)
+        self.translator = emulator._make_translator(self.decoded) if self.translated else None
+        # Instruction index of each slot; comment-only slots share the next instruction's
+        self.index = []
+        self.texts = []
+        for record in self.decoded:
+            self.index.append(len(self.texts))
+            if record is not None:
+                self.texts.append(record[2])
+        self.index.append(len(self.texts))
+        emulator.pc = 0
+        emulator.running = True
+        self.digest = PagedDigest(emulator.memory)
+
+    def advance(self, total):
+        emulator = self.emulator
+        if self.status != 'running' or self.executed >= total:
+            return
+        try:
+            # Both loops stop once the count passes their limit
+            if self.translated:
+                emulator._run_blocks(self.translator, self.decoded, total - 1, None, True)
+            else:
+                emulator.run_until(self.decoded, total - 1, self.threaded)
+        except Exception as e:
+            self._stop('error', f"{type(e).__name__}: {e}")
+        self.executed = emulator.instruction_count
+        if self.status == 'running':
+            if not emulator.running:
+                self._stop('ret')
+            elif not (0 <= emulator.pc < len(self.decoded) * 4):
+                self._stop('end')
+
+    def registers(self):
+        emulator = self.emulator
+        slot = emulator.pc // 4
+        pc = self.index[slot] * 4 if 0 <= slot < len(self.index) else emulator.pc
+        return emulator.regs[:31], emulator.regs[REG_SP], pc, emulator.n_flag, emulator.z_flag
+
+    def instruction(self, pc):
+        return self.texts[pc // 4] if pc // 4 < len(self.texts) else None
+
+    def stack(self):
+        return self.emulator.memory.peek(0, self.stack_size)
+
+
+class UnfusedEmulatorBackend(EmulatorBackend):
+    name = 'emulator-unfused'
+    fuse = False
+
+
+class TranslatedEmulatorBackend(EmulatorBackend):
+    name = 'emulator-translated'
+    translated = True
+
+
+class RoughBackend(Backend):
+    """Rough.py CPU and Emulator, one _step() at a time or through its block translator."""
+    name = 'rough'
+    translated = False
+
+    def __init__(self, path, stack_size):
+        super().__init__(path, stack_size)
+        import Rough
+        entries, labels = Rough.decode_asm_file(path)
+        self.cpu = Rough.CPU(stack_size=stack_size, stack_base=0)
+        # Rough resets to N=0, Z=0; start from the others' N=0, Z=1
+        self.cpu.N, self.cpu.Z = 0, 1
+        self.emulator = Rough.Emulator(self.cpu)
+        self.emulator.load_decoded(entries, labels)
+        self.cpu.regs['PC'] = 0
+        self.translator = self.emulator._make_translator() if self.translated else None
+        self.digest = FlatDigest(self.cpu.stack)
+
+    def advance(self, total):
+        if self.status != 'running' or self.executed >= total:
+            return
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            if self.translated:
+                self._run_blocks(total)
+            else:
+                self._run_steps(total)
+        # The trace isn't state; don't let it grow with the run
+        self.cpu.trace.clear()
+        if self.status == 'error' and self.error is None:
+            self.error = out.getvalue().strip().splitlines()[-1]
+
+    def _run_steps(self, total):
+        cpu = self.cpu
+        step = self.emulator._step
+        while self.executed < total:
+            if cpu.regs['PC'] not in cpu.addr_to_idx:
+                self._stop('end')
+                return
+            if not step():
+                cpu.regs['PC'] -= 4
+                self._stop('error')
+                return
+            self.executed += 1
+            if not cpu.running:
+                self._stop('ret')
+                return
+
+    def _run_blocks(self, total):
+        # execute_translated()'s loop, stopping after `total` instructions
+        cpu = self.cpu
+        translator = self.translator
+        while self.executed < total:
+            pc = cpu.regs['PC']
+            if pc not in cpu.addr_to_idx:
+                self._stop('end')
+                return
+            block = translator.block_at(pc)
+            if self.executed + block.length > total:
+                self._run_steps(self.executed + 1)
+                if self.status != 'running':
+                    return
+                continue
+            try:
+                cpu.regs['PC'] = block.func(cpu)
+            except Exception as e:
+                self.executed += translator.fault_offset
+                cpu.regs['PC'] = block.pcs[translator.fault_offset]
+                self._stop('error', f"{type(e).__name__}: {e}")
+                return
+            self.executed += block.length
+            if not cpu.running:
+                self._stop('ret')
+                return
+
+    def registers(self):
+        cpu = self.cpu
+        regs = cpu.regs
+        pc = regs['PC']
+        idx = cpu.addr_to_idx.get(pc)
+        return ([regs[f"X{i}"] for i in range(31)], regs['SP'],
+                pc if idx is None else idx * 4, cpu.N, cpu.Z)
+
+    def instruction(self, pc):
+        instructions = self.cpu.instructions
+        return instructions[pc // 4]['text'] if pc // 4 < len(instructions) else None
+
+    def stack(self):
+        return bytes(self.cpu.stack)
+
+
+class TranslatedRoughBackend(RoughBackend):
+    name = 'rough-translated'
+    translated = True
+
+
+class Task7Backend(Backend):
+    """Task_7.py ARM64Emulator (the final version of the class), one step() at a time."""
+    name = 'task7'
+
+    def __init__(self, path, stack_size):
+        super().__init__(path, stack_size)
+        import Task_7
+        self.emulator = Task_7.ARM64Emulator(stack_size)
+        self.program = self.emulator.load_program(path)
+        self.digest = PagedDigest(self.emulator.memory)
+
+    def advance(self, total):
+        if self.status != 'running' or self.executed >= total:
+            return
+        emulator = self.emulator
+        program = self.program
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            while self.executed < total:
+                if emulator.pc // 4 >= len(program):
+                    self._stop('end')
+                    return
+                try:
+                    if not emulator.step(program):
+                        emulator.pc -= 4
+                        self._stop('error', out.getvalue().strip())
+                        return
+                except Exception as e:
+                    emulator.pc -= 4
+                    self._stop('error', f"{type(e).__name__}: {e}")
+                    return
+                self.executed += 1
+                if emulator.emulation_finished:
+                    self._stop('ret')
+                    return
+
+    def registers(self):
+        emulator = self.emulator
+        pstate = emulator.pstate
+        return emulator.x[:31], emulator.sp, emulator.pc, pstate['N'], pstate['Z']
+
+    def instruction(self, pc):
+        return self.program[pc // 4] if pc // 4 < len(self.program) else None
+
+    def stack(self):
+        return self.emulator.memory.peek(0, self.stack_size)
+
+
+BACKENDS = {backend.name: backend for backend in (
+    EmulatorBackend, UnfusedEmulatorBackend, TranslatedEmulatorBackend,
+    RoughBackend, TranslatedRoughBackend, Task7Backend)}
+
+
+# --- Lockstep ---
+def compared_fields(ignore=()):
+    """Indices into state() of the fields left after `ignore` (field or FIELD_GROUPS names, or 'none')."""
+    ignored = set()
+    for name in ignore:
+        if name == 'none':
+            continue
+        if name in FIELD_GROUPS:
+            ignored.update(FIELD_GROUPS[name])
+        elif name.upper() in FIELDS or name in FIELDS:
+            ignored.add(name if name in FIELDS else name.upper())
+        else:
+            raise ValueError(f"unknown field: {name}")
+    return tuple(i for i, field in enumerate(FIELDS) if field not in ignored)
+
+
+class Divergence:
+    """
+    The first point where the backends disagree: after `count`
+    instructions, the last of them at `pc`, or before the first one
+    (count 0). `fields` maps each differing field to every backend's value.
+    """
+    def __init__(self, names, count, pc, text, fields, errors):
+        self.names = names
+        self.count = count
+        self.pc = pc
+        self.text = text
+        self.fields = fields
+        self.errors = errors
+
+    def format(self):
+        if self.count == 0:
+            lines = ["diverged before the first instruction"]
+        elif self.pc is None:
+            lines = [f"diverged by instruction {self.count}, but not when replayed"]
+        else:
+            lines = [f"diverged after instruction {self.count} (PC {self.pc:#x}: {self.text})"]
+        rows = [['field'] + list(self.names)]
+        for field, values in self.fields.items():
+            if field == 'memory':
+                rows.extend(_memory_rows(values))
+            else:
+                rows.append([field] + [str(value) if field in ('N', 'Z', 'status') else hex(value)
+                                       for value in values])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            lines.append("    " + "   ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+        for name, error in zip(self.names, self.errors):
+            if error:
+                lines.append(f"    {name}: {error}")
+        return "\n".join(lines)
+
+
+def _memory_rows(stacks):
+    """Rows for the byte ranges where the stacks differ, in runs of up to 16 bytes."""
+    rows = []
+    size = min(len(stack) for stack in stacks)
+    start = None
+    for addr in range(size + 1):
+        differs = addr < size and any(stack[addr] != stacks[0][addr] for stack in stacks)
+        if differs and start is None:
+            start = addr
+        if start is not None and (not differs or addr - start == 16):
+            rows.append([f"[{start:#x}:{addr:#x}]"] + [stack[start:addr].hex(' ') for stack in stacks])
+            if len(rows) == MAX_MEMORY_DIFFS:
+                break
+            start = addr if differs else None
+    return rows
+
+
+def _start(path, backends, stack_size):
+    return [BACKENDS[name](path, stack_size) for name in backends]
+
+
+def _compared(sim, keep, memory):
+    state = sim.state(memory)
+    return [state[i] for i in keep]
+
+
+def _divergence(sims, keep, count, pc, text):
+    names = [sim.name for sim in sims]
+    fields = {}
+    values = [sim.fields() for sim in sims]
+    for i in keep:
+        field = FIELDS[i]
+        column = [v[field] for v in values]
+        if any(value != column[0] for value in column):
+            fields[field] = column
+    return Divergence(names, count, pc, text, fields, [sim.error for sim in sims])
+
+
+def _locate(path, backends, stack_size, keep, start, end):
+    """Replays from the agreed checkpoint at `start` to find the first diverging instruction before `end`."""
+    sims = _start(path, backends, stack_size)
+    memory = FIELDS.index('memory') in keep
+    for sim in sims:
+        sim.advance(start)
+    for count in range(start + 1, end + 1):
+        pc = sims[0].registers()[2]
+        text = sims[0].instruction(pc)
+        for sim in sims:
+            sim.advance(count)
+        states = [_compared(sim, keep, memory) for sim in sims]
+        if any(state != states[0] for state in states[1:]):
+            return _divergence(sims, keep, count, pc, text)
+    return _divergence(sims, keep, end, None, None)
+
+
+def cosimulate(path, backends=DEFAULT_BACKENDS, every=DEFAULT_EVERY,
+               max_instructions=MAX_INSTRUCTIONS, stack_size=256, ignore=DEFAULT_IGNORE):
+    """
+    Runs the program file `path` on `backends` (BACKENDS names) in
+    lockstep, comparing their states before the first instruction and
+    every `every` instructions, leaving out the `ignore`d fields. Returns
+    (instructions run, Divergence or None if they agreed throughout).
+    """
+    if len(backends) < 2:
+        raise ValueError("co-simulation needs at least two backends")
+    keep = compared_fields(ignore)
+    memory = FIELDS.index('memory') in keep
+    sims = _start(path, backends, stack_size)
+    done = 0
+    while True:
+        states = [_compared(sim, keep, memory) for sim in sims]
+        if any(state != states[0] for state in states[1:]):
+            if done == 0:
+                return 0, _divergence(sims, keep, 0, None, None)
+            divergence = _locate(path, backends, stack_size, keep, max(0, done - every), done)
+            return divergence.count, divergence
+        if done >= max_instructions or all(sim.status != 'running' for sim in sims):
+            return max(sim.executed for sim in sims), None
+        done = min(done + every, max_instructions)
+        for sim in sims:
+            sim.advance(done)
+
+
+# --- Corpus runs ---
+def _check(path, options):
+    try:
+        count, divergence = cosimulate(path, **options)
+    except Exception as e:
+        return path, None, f"error: {type(e).__name__}: {e}"
+    return path, count, divergence.format() if divergence else None
+
+
+def program_files(paths):
+    """The given files, plus every .s file under the given directories, in order."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith('.s'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def run_corpus(paths, options, jobs=1, fail_fast=False, verbose=False, out=None):
+    """Co-simulates every program, printing a line (or report) each; returns (agreed, diverged)."""
+    out = out or sys.stdout
+    agreed = diverged = 0
+    if jobs > 1:
+        pool = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'))
+        results = pool.map(_check, paths, [options] * len(paths))
+    else:
+        pool = None
+        results = (_check(path, options) for path in paths)
+    try:
+        for path, count, report in results:
+            if report is None:
+                agreed += 1
+                if verbose:
+                    print(f"{path}: agreed over {count} instructions", file=out)
+                continue
+            diverged += 1
+            print(f"{path}: {report}", file=out)
+            if fail_fast:
+                break
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return agreed, diverged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run ARM64 assembly on several emulator backends in lockstep.")
+    parser.add_argument('paths', nargs='*', metavar='PATH', help="program files, or directories of .s files")
+    parser.add_argument('--samples', action='store_true',
+                        help="co-simulate the repository's sample programs too (a check that the "
+                             "default backends agree)")
+    parser.add_argument('--backends', default=','.join(DEFAULT_BACKENDS),
+                        help=f"comma-separated backends, the first being the reference "
+                             f"(default: {','.join(DEFAULT_BACKENDS)}; available: {', '.join(BACKENDS)})")
+    parser.add_argument('--every', type=int, default=DEFAULT_EVERY, metavar='N',
+                        help=f"instructions between state comparisons (default: {DEFAULT_EVERY})")
+    parser.add_argument('--max-instructions', type=int, default=MAX_INSTRUCTIONS, metavar='N',
+                        help=f"instructions per program (default: {MAX_INSTRUCTIONS})")
+    parser.add_argument('--stack-size', type=int, default=256, metavar='BYTES')
+    parser.add_argument('--ignore', action='append', default=None, metavar='FIELD',
+                        help="leave a field out of the comparison: a register, PC, N, Z, status, memory, "
+                             f"or flags/registers (repeatable; default: {', '.join(DEFAULT_IGNORE)}; "
+                             "'none' compares every field)")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help="programs co-simulated at once (default: 1)")
+    parser.add_argument('--fail-fast', action='store_true', help="stop at the first program that diverges")
+    parser.add_argument('-v', '--verbose', action='store_true', help="list the programs that agree too")
+    args = parser.parse_args(argv)
+    if not args.paths and not args.samples:
+        parser.error("give program paths or --samples")
+    if args.ignore is None:
+        args.ignore = list(DEFAULT_IGNORE)
+
+    backends = [name.strip() for name in args.backends.split(',') if name.strip()]
+    unknown = [name for name in backends if name not in BACKENDS]
+    if unknown:
+        parser.error(f"unknown backend: {', '.join(unknown)}")
+    if len(backends) < 2:
+        parser.error("co-simulation needs at least two backends")
+    if args.every < 1:
+        parser.error("--every must be at least 1")
+    try:
+        compared_fields(args.ignore)
+    except ValueError as e:
+        parser.error(str(e))
+
+    paths = list(program_files(args.paths))
+    if args.samples:
+        here = os.path.dirname(os.path.abspath(__file__))
+        paths += [os.path.join(here, name) for name in SAMPLE_PROGRAMS]
+    options = {'backends': backends, 'every': args.every, 'max_instructions': args.max_instructions,
+               'stack_size': args.stack_size, 'ignore': args.ignore}
+    agreed, diverged = run_corpus(paths, options, args.jobs, args.fail_fast, args.verbose or len(paths) == 1)
+    if len(paths) > 1:
+        print(f"{agreed} agreed, {diverged} diverged ({len(paths)} programs)")
+    sys.exit(1 if diverged else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+"""
+Compact binary execution traces with random-access replay.
+
+A trace holds one record per executed instruction with only what that
+instruction changed: the PC (omitted when it just moved on by 4), each
+register whose value changed and every memory write. Register values are
+stored as zigzag LEB128 varints of the difference from the old value, so
+a typical step is 3-5 bytes. Every `keyframe_interval` steps a keyframe
+stores the full state (PC, all registers, flags and every non-zero memory
+page). An index of keyframes is appended when the writer is closed, so
+TraceReader.state_at(n) decodes one keyframe and at most
+keyframe_interval - 1 records to rebuild the state after step n. A trace
+without an index (the writer never closed) is scanned once to rebuild it.
+
+File layout (integers little-endian):
+    header     b'A64D', u8 version, u8 page shift, u16 slots, u32 keyframe interval
+    step       u8 tag: bits 0-5 changed slots, bit 6 memory writes, bit 7 explicit PC
+               [varint zigzag PC delta] {u8 slot, varint zigzag value delta}*
+               [varint writes {varint address, u8 size, bytes}*]
+    keyframe   u8 0xFF, varint step, varint PC, varint value * slots,
+               varint pages {varint page number, page bytes}*
+    index      {u64 step, u64 offset}* u64 keyframes, u64 steps, u64 final PC,
+               u64 index offset, b'A64I'
+
+Slots 0-30 are X0-X30, slot 31 is SP and slot 32 holds the flags as
+N << 1 | Z.
+
+Recording a run of the ARM64 emulator:
+    with TraceWriter('run.trace') as trace:
+        emulator.trace_writer = trace
+        emulator.run(program, verbosity='silent')
+
+Inspecting it later:
+    python delta_trace.py run.trace --step 1000000
+"""
+
+import argparse
+import bisect
+import mmap
+import struct
+
+MAGIC = b'A64D'
+INDEX_MAGIC = b'A64I'
+VERSION = 1
+KEYFRAME = 0xFF
+DEFAULT_KEYFRAME_INTERVAL = 10000
+
+NUM_SLOTS = 33
+FLAGS_SLOT = 32
+SLOT_NAMES = [f'X{i}' for i in range(31)] + ['SP', 'FLAGS']
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+SIGN64 = 1 << 63
+
+_HEADER = struct.Struct('<4sBBHI')
+_INDEX_ENTRY = struct.Struct('<QQ')
+_FOOTER = struct.Struct('<QQQQ4s')
+
+# Buffered output is flushed to the file in chunks of this size
+FLUSH_SIZE = 1 << 20
+
+
+def _put_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(delta):
+    # 64-bit wrapped difference -> small unsigned for small +/- deltas
+    delta &= MASK64
+    if delta >= SIGN64:
+        delta -= 1 << 64
+    return (delta << 1) if delta >= 0 else ((-delta << 1) - 1)
+
+
+def _unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+class TraceWriter:
+    """Writes a delta trace; feed it step() per instruction and keyframe() when keyframe_due."""
+    def __init__(self, path, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, page_shift=12):
+        if keyframe_interval < 1:
+            raise ValueError("keyframe_interval must be at least 1")
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.page_shift = page_shift
+        self.steps = 0
+        self.keyframes = []    # (step, file offset)
+        self._file = open(path, 'wb')
+        self._buffer = bytearray(_HEADER.pack(MAGIC, VERSION, page_shift, NUM_SLOTS, keyframe_interval))
+        self._offset = 0       # file offset of self._buffer[0]
+        self._pc = 0
+        self._slots = [0] * NUM_SLOTS
+
+    @property
+    def keyframe_due(self):
+        """True when the state after the latest step should be written as a keyframe."""
+        return self.steps % self.keyframe_interval == 0 and (
+            not self.keyframes or self.keyframes[-1][0] != self.steps)
+
+    def keyframe(self, pc, slots, pages):
+        """
+        Full state after the latest step: `slots` holds the NUM_SLOTS values
+        and `pages` maps page numbers to page contents. Also written when the
+        state changed between steps (e.g. at the start of another run); the
+        last keyframe of a step wins.
+        """
+        out = self._buffer
+        self.keyframes.append((self.steps, self._offset + len(out)))
+        out.append(KEYFRAME)
+        _put_varint(out, self.steps)
+        _put_varint(out, pc)
+        for value in slots:
+            _put_varint(out, value)
+        nonzero = [(number, page) for number, page in sorted(pages.items()) if any(page)]
+        _put_varint(out, len(nonzero))
+        for number, page in nonzero:
+            _put_varint(out, number)
+            out += page
+        self._pc = pc
+        self._slots = list(slots)
+        if len(out) >= FLUSH_SIZE:
+            self.flush()
+
+    def step(self, pc, changes, writes):
+        """
+        One executed instruction: `pc` after it, the (slot, value) pairs it
+        changed and the (address, bytes) it wrote to memory.
+        """
+        out = self._buffer
+        tag = len(changes)
+        if writes:
+            tag |= 0x40
+        if pc != self._pc + 4:
+            tag |= 0x80
+        out.append(tag)
+        if tag & 0x80:
+            _put_varint(out, _zigzag(pc - self._pc))
+        self._pc = pc
+        slots = self._slots
+        for slot, value in changes:
+            out.append(slot)
+            _put_varint(out, _zigzag(value - slots[slot]))
+            slots[slot] = value
+        if writes:
+            if any(len(data) > 0xFF for _, data in writes):
+                writes = [(address + i, data[i:i + 0xFF]) for address, data in writes
+                          for i in range(0, len(data), 0xFF)]
+            _put_varint(out, len(writes))
+            for address, data in writes:
+                _put_varint(out, address)
+                out.append(len(data))
+                out += data
+        self.steps += 1
+        if len(out) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self._file.write(self._buffer)
+        self._offset += len(self._buffer)
+        self._buffer = bytearray()
+
+    def close(self):
+        """Writes the keyframe index and closes the file."""
+        if self._file.closed:
+            return
+        out = self._buffer
+        index_offset = self._offset + len(out)
+        for step, offset in self.keyframes:
+            out += _INDEX_ENTRY.pack(step, offset)
+        out += _FOOTER.pack(len(self.keyframes), self.steps, self._pc, index_offset, INDEX_MAGIC)
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TraceState:
+    """Machine state after one step of a trace."""
+    def __init__(self, step, pc, slots, pages, page_shift):
+        self.step = step
+        self.pc = pc
+        self.slots = slots
+        self.pages = pages
+        self.page_shift = page_shift
+
+    @property
+    def registers(self):
+        return {name: value for name, value in zip(SLOT_NAMES[:FLAGS_SLOT], self.slots)}
+
+    @property
+    def n_flag(self):
+        return self.slots[FLAGS_SLOT] >> 1
+
+    @property
+    def z_flag(self):
+        return self.slots[FLAGS_SLOT] & 1
+
+    def read(self, address, size):
+        """`size` bytes of memory at `address` (unwritten memory reads as zero)."""
+        out = bytearray()
+        page_size = 1 << self.page_shift
+        while len(out) < size:
+            offset = address & (page_size - 1)
+            chunk = min(size - len(out), page_size - offset)
+            page = self.pages.get(address >> self.page_shift)
+            out += page[offset:offset + chunk] if page is not None else bytes(chunk)
+            address += chunk
+        return bytes(out)
+
+    def _write(self, address, data):
+        page_size = 1 << self.page_shift
+        pos = 0
+        while pos < len(data):
+            offset = address & (page_size - 1)
+            chunk = min(len(data) - pos, page_size - offset)
+            page = self.pages.get(address >> self.page_shift)
+            if page is None:
+                page = self.pages[address >> self.page_shift] = bytearray(page_size)
+            page[offset:offset + chunk] = data[pos:pos + chunk]
+            address += chunk
+            pos += chunk
+
+    def format(self):
+        lines = [f"Step {self.step}  PC: {self.pc:#018x}  N: {self.n_flag}  Z: {self.z_flag}"]
+        for i in range(0, 32, 4):
+            lines.append('  '.join(f"{SLOT_NAMES[j]:>3}: {self.slots[j]:#018x}" for j in range(i, i + 4)))
+        return '\n'.join(lines) + '\n'
+
+
+class TraceReader:
+    """Random access to a trace written by TraceWriter."""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.page_shift, slots, self.keyframe_interval = _HEADER.unpack_from(self._data, 0)
+        if magic != MAGIC or version != VERSION or slots != NUM_SLOTS:
+            raise ValueError(f"{path} is not a version {VERSION} delta trace")
+        self._end = len(self._data)
+        if self._end >= _HEADER.size + _FOOTER.size and self._data[-4:] == INDEX_MAGIC:
+            count, self.steps, self.final_pc, index_offset, _ = _FOOTER.unpack_from(
+                self._data, self._end - _FOOTER.size)
+            self.keyframes = [_INDEX_ENTRY.unpack_from(self._data, index_offset + i * _INDEX_ENTRY.size)
+                              for i in range(count)]
+            self._end = index_offset
+        else:
+            self._scan()
+        if not self.keyframes:
+            raise ValueError(f"{path} has no keyframes")
+        self._keyframe_steps = [step for step, _ in self.keyframes]
+
+    def _scan(self):
+        # Rebuilds the index of a trace whose writer never closed it
+        self.keyframes = []
+        self.steps = 0
+        self.final_pc = 0
+        pos = _HEADER.size
+        pc = 0
+        while pos < self._end:
+            try:
+                if self._data[pos] == KEYFRAME:
+                    state, next_pos = self._read_keyframe(pos)
+                    self.keyframes.append((state.step, pos))
+                    pc = state.pc
+                else:
+                    pc, next_pos = self._skip_step(pos, pc)
+                    self.steps += 1
+            except IndexError:
+                break   # truncated final record
+            pos = next_pos
+            self.final_pc = pc
+
+    def __len__(self):
+        """Number of steps in the trace."""
+        return self.steps
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- Decoding ---
+    def _read_keyframe(self, pos):
+        data = self._data
+        step, pos = _get_varint(data, pos + 1)
+        pc, pos = _get_varint(data, pos)
+        slots = []
+        for _ in range(NUM_SLOTS):
+            value, pos = _get_varint(data, pos)
+            slots.append(value)
+        count, pos = _get_varint(data, pos)
+        page_size = 1 << self.page_shift
+        pages = {}
+        for _ in range(count):
+            number, pos = _get_varint(data, pos)
+            pages[number] = bytearray(data[pos:pos + page_size])
+            pos += page_size
+        return TraceState(step, pc, slots, pages, self.page_shift), pos
+
+    def _read_step(self, pos, pc, slots):
+        # Returns (pc, changes, writes, next position), updating `slots`
+        data = self._data
+        tag = data[pos]
+        pos += 1
+        if tag & 0x80:
+            delta, pos = _get_varint(data, pos)
+            pc += _unzigzag(delta)
+        else:
+            pc += 4
+        changes = []
+        for _ in range(tag & 0x3F):
+            slot = data[pos]
+            delta, pos = _get_varint(data, pos + 1)
+            value = (slots[slot] + _unzigzag(delta)) & MASK64
+            slots[slot] = value
+            changes.append((slot, value))
+        writes = []
+        if tag & 0x40:
+            count, pos = _get_varint(data, pos)
+            for _ in range(count):
+                address, pos = _get_varint(data, pos)
+                size = data[pos]
+                writes.append((address, data[pos + 1:pos + 1 + size]))
+                pos += 1 + size
+        return pc, changes, writes, pos
+
+    def _skip_step(self, pos, pc):
+        pc, _, _, pos = self._read_step(pos, pc, [0] * NUM_SLOTS)
+        return pc, pos
+
+    # --- Random Access ---
+    def state_at(self, step):
+        """The state after `step` instructions (0 is the state the trace started from)."""
+        if not 0 <= step <= self.steps:
+            raise IndexError(f"Step {step} is outside the trace (0..{self.steps})")
+        i = bisect.bisect_right(self._keyframe_steps, step) - 1
+        state, pos = self._read_keyframe(self.keyframes[i][1])
+        current = state.step
+        while current < step:
+            if self._data[pos] == KEYFRAME:
+                _, pos = self._read_keyframe(pos)
+                continue
+            state.pc, _, writes, pos = self._read_step(pos, state.pc, state.slots)
+            for address, data in writes:
+                state._write(address, data)
+            current += 1
+        state.step = step
+        return state
+
+    def records(self, start=0, stop=None):
+        """Yields (step, pc, changes, writes) for steps start+1 .. stop; pc is the PC after the step."""
+        stop = self.steps if stop is None else min(stop, self.steps)
+        state = self.state_at(start)
+        pos = self._position_after(start)
+        pc, slots = state.pc, state.slots
+        for step in range(start + 1, stop + 1):
+            while self._data[pos] == KEYFRAME:
+                _, pos = self._read_keyframe(pos)
+            pc, changes, writes, pos = self._read_step(pos, pc, slots)
+            yield step, pc, changes, [(address, bytes(data)) for address, data in writes]
+
+    def _position_after(self, step):
+        # File position of the record of step + 1
+        i = bisect.bisect_right(self._keyframe_steps, step) - 1
+        _, pos = self._read_keyframe(self.keyframes[i][1])
+        current = self.keyframes[i][0]
+        while current < step:
+            if self._data[pos] == KEYFRAME:
+                _, pos = self._read_keyframe(pos)
+                continue
+            _, pos = self._skip_step(pos, 0)
+            current += 1
+        return pos
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect a binary delta trace.")
+    parser.add_argument('trace', help="trace file written with --trace")
+    parser.add_argument('--step', type=int, metavar='N', help="print the state after step N")
+    parser.add_argument('--records', nargs=2, type=int, metavar=('START', 'STOP'),
+                        help="print the changes made by steps START+1 .. STOP")
+    args = parser.parse_args(argv)
+
+    with TraceReader(args.trace) as reader:
+        print(f"{args.trace}: {len(reader)} steps, {len(reader.keyframes)} keyframes "
+              f"(every {reader.keyframe_interval} steps), final PC {reader.final_pc:#x}")
+        if args.step is not None:
+            print(reader.state_at(args.step).format(), end='')
+        if args.records:
+            for step, pc, changes, writes in reader.records(*args.records):
+                parts = [f"NZ={value:02b}" if slot == FLAGS_SLOT else f"{SLOT_NAMES[slot]}={value:#x}"
+                         for slot, value in changes]
+                parts += [f"[{address:#x}]={data.hex()}" for address, data in writes]
+                print(f"{step:>10}  pc={pc:#x}  {' '.join(parts)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Asyncio emulation service for the ARM64 emulator (emulator.py).
+
+Keeps a pool of worker processes alive and feeds them jobs, so a run
+costs a pipe round trip instead of an interpreter start, and repeated
+programs come out of the ProgramCache instead of being parsed again.
+Requests and results are JSON lines, read from stdin and written to
+stdout, or exchanged over TCP with --port (one session per connection,
+all sharing the pool):
+
+    {"op": "load", "source": "MOV X0, #1\\nRET\\n"}
+        -> {"op": "load", "program": "<id>", "lines": 2}
+    {"id": 1, "program": "<id>", "registers": {"X1": 5}, "max_instructions": 100000}
+    {"id": 2, "source": "...", "time_budget": 2.5}
+        -> {"id": 1, "status": "ret", "registers": {...}, ...}   as each job finishes
+    {"op": "cancel", "id": 2}
+        -> {"id": 2, "status": "cancelled"}
+
+"op" defaults to "run". A run request is a batch_runner job (source,
+registers, max_instructions, time_budget, stack_size, data_size,
+heap_size) that may name a loaded program instead of its source, and its
+result is batch_runner's result with the request's id. Results are
+written in completion order, not request order. A run request without an
+id gets the next free integer.
+
+Backpressure: a session holds at most --max-pending unfinished jobs. At
+that point it stops reading requests (so a TCP client's sends block)
+until a job finishes and its result has been written. Cancelling a job
+that is still queued drops it; cancelling a running one kills its worker
+process, which is replaced.
+
+Usage:
+    python emu_service.py -j 4 < jobs.jsonl > results.jsonl
+    python emu_service.py --port 7777
+"""
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_runner import TIME_BUDGET, run_job
+from emulator import INSTRUCTION_LIMIT
+from program_cache import ProgramCache
+
+# Loaded programs kept for "program" references (least recently used go first)
+MAX_PROGRAMS = 1024
+
+# Request keys passed through to batch_runner.run_job
+JOB_KEYS = ('registers', 'max_instructions', 'time_budget', 'stack_size', 'data_size', 'heap_size')
+
+
+def _worker_main(conn, max_instructions, time_budget, cache_dir):
+    # Results only go back through the pipe; stdout may be the service's output
+    sys.stdout = open(os.devnull, 'w')
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        conn.send(run_job(job, max_instructions, time_budget, cache_dir))
+
+
+def _call(conn, job):
+    conn.send(job)
+    return conn.recv()
+
+
+class WorkerPool:
+    """A fixed number of emulator worker processes; run() hands a job to an idle one."""
+    def __init__(self, workers=None, max_instructions=INSTRUCTION_LIMIT,
+                 time_budget=TIME_BUDGET, cache_dir=None):
+        self.size = workers or os.cpu_count() or 1
+        self.settings = (max_instructions, time_budget, cache_dir)
+        self._context = multiprocessing.get_context('spawn')
+        # One thread per worker waits on its pipe
+        self._threads = ThreadPoolExecutor(max_workers=self.size)
+        self._idle = asyncio.Queue()
+        self._workers = set()
+
+    def start(self):
+        for _ in range(self.size):
+            self._idle.put_nowait(self._spawn())
+
+    def _spawn(self):
+        conn, child = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child,) + self.settings, daemon=True)
+        process.start()
+        child.close()
+        worker = (process, conn)
+        self._workers.add(worker)
+        return worker
+
+    def _replace(self, worker):
+        # The pipe is left to the thread still waiting on it, which sees EOF
+        process = worker[0]
+        self._workers.discard(worker)
+        process.kill()
+        process.join()
+        return self._spawn()
+
+    async def run(self, job):
+        """Runs a batch_runner job on the next idle worker and returns its result."""
+        worker = await self._idle.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._threads, _call, worker[1], job)
+        except asyncio.CancelledError:
+            # The worker is still busy with the job; only killing it stops the run
+            worker = self._replace(worker)
+            raise
+        except (EOFError, OSError) as e:
+            worker = self._replace(worker)
+            return {'name': job.get('name'), 'status': 'error',
+                    'error': f"worker process died: {type(e).__name__}: {e}"}
+        finally:
+            self._idle.put_nowait(worker)
+
+    def close(self):
+        for process, conn in self._workers:
+            process.kill()
+            process.join()
+            conn.close()
+        self._workers.clear()
+        self._threads.shutdown(wait=False, cancel_futures=True)
+
+
+class Service:
+    """The worker pool and loaded programs shared by every session."""
+    def __init__(self, pool, max_pending=None):
+        self.pool = pool
+        self.max_pending = max_pending or 2 * pool.size
+        self.programs = collections.OrderedDict()   # id -> source
+
+    def load(self, source):
+        program_id = hashlib.sha256(source.encode('utf-8', 'surrogatepass')).hexdigest()[:16]
+        self.programs[program_id] = source
+        self.programs.move_to_end(program_id)
+        while len(self.programs) > MAX_PROGRAMS:
+            self.programs.popitem(last=False)
+        return program_id
+
+    async def serve(self, reader, writer):
+        try:
+            await Session(self, reader, writer).serve()
+        finally:
+            writer.close()
+
+
+class Session:
+    """One client: reads requests, runs their jobs and writes the results."""
+    def __init__(self, service, reader, writer):
+        self.service = service
+        self.reader = reader
+        self.writer = writer
+        self.jobs = {}   # id -> (execution task, reporting task)
+        self.slots = asyncio.Semaphore(service.max_pending)
+        self.write_lock = asyncio.Lock()
+        self.next_id = 0
+
+    async def send(self, message):
+        async with self.write_lock:
+            self.writer.write(json.dumps(message).encode() + b'\n')
+            await self.writer.drain()
+
+    async def serve(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    await self.handle(line)
+            # End of input: let the outstanding jobs finish
+            while self.jobs:
+                await asyncio.gather(*(reporter for _, reporter in self.jobs.values()),
+                                     return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            for execution, reporter in list(self.jobs.values()):
+                execution.cancel()
+                reporter.cancel()
+
+    async def handle(self, line):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("a request must be a JSON object")
+        except ValueError as e:
+            await self.send({'status': 'error', 'error': f"bad request: {e}"})
+            return
+        op = request.get('op', 'run')
+        if op == 'run':
+            await self.submit(request)
+        elif op == 'load':
+            if not isinstance(request.get('source'), str):
+                await self.send({'op': 'load', 'status': 'error', 'error': "load needs a 'source'"})
+                return
+            source = request['source']
+            await self.send({'op': 'load', 'program': self.service.load(source),
+                             'lines': len(source.splitlines())})
+        elif op == 'cancel':
+            entry = self.jobs.get(request.get('id')) if isinstance(request.get('id'), (int, str)) else None
+            if entry is None:
+                await self.send({'op': 'cancel', 'id': request.get('id'), 'status': 'error',
+                                 'error': "no such job"})
+            else:
+                entry[0].cancel()
+        else:
+            await self.send({'id': request.get('id'), 'status': 'error', 'error': f"unknown op: {op}"})
+
+    async def submit(self, request):
+        job_id = request.get('id')
+        if job_id is None:
+            while self.next_id in self.jobs:
+                self.next_id += 1
+            job_id = self.next_id
+            self.next_id += 1
+        try:
+            if not isinstance(job_id, (int, str)):
+                raise ValueError("a job id must be an integer or a string")
+            if job_id in self.jobs:
+                raise ValueError(f"job {job_id!r} is already running")
+            job = self.job(request)
+        except (ValueError, TypeError) as e:
+            await self.send({'id': job_id, 'status': 'error', 'error': str(e)})
+            return
+        await self.slots.acquire()
+        execution = asyncio.ensure_future(self.service.pool.run(job))
+        self.jobs[job_id] = (execution, asyncio.ensure_future(self.report(job_id, job, execution)))
+
+    def job(self, request):
+        """The batch_runner job for a run request."""
+        job = {key: request[key] for key in JOB_KEYS if key in request}
+        if 'program' in request:
+            source = self.service.programs.get(request['program'])
+            if source is None:
+                raise ValueError(f"unknown program: {request['program']}")
+            self.service.programs.move_to_end(request['program'])
+            job['program'] = request['program']
+        elif isinstance(request.get('source'), str):
+            source = request['source']
+            job['program'] = self.service.load(source)
+        else:
+            raise ValueError("a run request needs a 'source' or a loaded 'program'")
+        job['source'] = source
+        job['name'] = request.get('name')
+        return job
+
+    async def report(self, job_id, job, execution):
+        # Kept apart from the execution so that cancelling a job, even one
+        # that hasn't started, still reports it and frees its slot
+        try:
+            try:
+                result = await execution
+            except asyncio.CancelledError:
+                if not execution.cancelled():
+                    raise   # the session is closing
+                result = {'status': 'cancelled'}
+            await self.send(dict(result, id=job_id, program=job['program']))
+        finally:
+            del self.jobs[job_id]
+            self.slots.release()
+
+
+class _StdinReader:
+    """Line reader over stdin that only reads when asked (any file type, no read-ahead)."""
+    async def readline(self):
+        return await asyncio.get_running_loop().run_in_executor(None, sys.stdin.buffer.readline)
+
+
+class _StdoutWriter:
+    def write(self, data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+async def serve(args):
+    cache_dir = None if args.no_cache else (args.cache_dir or ProgramCache().directory)
+    pool = WorkerPool(args.jobs, args.max_instructions, args.time_budget, cache_dir)
+    pool.start()
+    service = Service(pool, args.max_pending)
+    try:
+        if args.port is None:
+            await service.serve(_StdinReader(), _StdoutWriter())
+            return
+        server = await asyncio.start_server(service.serve, args.host, args.port)
+        addresses = ', '.join(str(sock.getsockname()) for sock in server.sockets)
+        print(f"Serving on {addresses} with {pool.size} workers", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+    finally:
+        pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve ARM64 emulator runs as JSON lines.")
+    parser.add_argument('-j', '--jobs', type=int, default=None, metavar='N',
+                        help="worker processes (default: all cores)")
+    parser.add_argument('--max-pending', type=int, default=None, metavar='N',
+                        help="unfinished jobs per session before reading pauses (default: 2 per worker)")
+    parser.add_argument('--port', type=int, default=None,
+                        help="listen on this TCP port instead of using stdin/stdout")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--max-instructions', type=int, default=INSTRUCTION_LIMIT, metavar='N',
+                        help=f"default per-job instruction budget (default: {INSTRUCTION_LIMIT})")
+    parser.add_argument('--time-budget', type=float, default=TIME_BUDGET, metavar='SECONDS',
+                        help=f"default per-job wall-clock budget (default: {TIME_BUDGET})")
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help="program cache directory (default: $ARM64EMU_CACHE_DIR "
+                             "or ~/.cache/arm64emu)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="parse every program instead of using the program cache")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,128 @@
+import argparse
+import bisect
+import builtins
+import itertools
+import operator
 import re
 import sys
+import time
+
+from block_translator import BlockTranslator
+from delta_trace import DEFAULT_KEYFRAME_INTERVAL, TraceWriter
+from loop_accel import find_counted_loops
+import optimizer
+from paged_memory import PagedMemory
+from profiler import Profiler
+from program_cache import ProgramCache
+
+MASK32 = 0xFFFFFFFF
+MASK64 = 0xFFFFFFFFFFFFFFFF
+SIGN64 = 1 << 63
+
+# Decode tables: mnemonic -> ALU function / (is_store, num_bytes) / branch handler
+ALU_OPS = {
+    'ADD': operator.add, 'SUB': operator.sub, 'EOR': operator.xor,
+    'AND': operator.and_, 'MUL': operator.mul,
+}
+MEM_OPS = {
+    'STR': (True, 8), 'STRB': (True, 1),
+    'LDR': (False, 8), 'LDRB': (False, 1),
+}
+BRANCH_OPS = {'B': '_exec_b', 'B.GT': '_exec_b_gt', 'B.LE': '_exec_b_le'}
+ALU_SYMBOLS = {
+    operator.add: '+', operator.sub: '-', operator.xor: '^',
+    operator.and_: '&', operator.mul: '*',
+}
+ALU_NAMES = {func: name for name, func in ALU_OPS.items()}
+# Branch handler -> the threaded-code version, which returns the next slot
+_THREADED_BRANCHES = {'_exec_b': '_thread_b', '_exec_b_gt': '_thread_b_gt', '_exec_b_le': '_thread_b_le'}
+# Negative returns from threaded-code ops that end a run
+_RETURNED = -1
+_LEFT_PROGRAM = -2
+
+# Bump whenever decode() output changes, so stale program cache entries miss
+DECODER_VERSION = 2
+
+# Runs halt once more than this many instructions have executed
+INSTRUCTION_LIMIT = 1000
+
+# Default bases for the optional data and heap regions (the stack sits just
+# below stack_base_addr + stack_size)
+DATA_BASE_ADDR = 0x1000_0000
+HEAP_BASE_ADDR = 0x1_0000_0000
+
+# Output levels accepted by ARM64Emulator.run and the --verbosity option
+VERBOSITY_LEVELS = ('silent', 'final', 'steps', 'full')
+
+# Register file layout: X0-X30 at their own index, then SP, then XZR (always
+# reads 0) and a sink slot that absorbs writes to XZR/WZR.
+REG_SP = 31
+REG_ZR = 32
+REG_ZR_SINK = 33
+NUM_REG_SLOTS = 34
+
+# Register name -> (index, read mask). W names read the low 32 bits and
+# zero-extend on write.
+REG_TABLE = {'SP': (REG_SP, MASK64), 'WSP': (REG_SP, MASK32),
+             'XZR': (REG_ZR, MASK64), 'WZR': (REG_ZR, MASK32)}
+for _i in range(31):
+    REG_TABLE[f'X{_i}'] = (_i, MASK64)
+    REG_TABLE[f'W{_i}'] = (_i, MASK32)
+del _i
 
 class ARM64Emulator:
     """
     A simplified ARM64 emulator that handles a subset of instructions,
-    registers, and a small stack memory.
+    registers, and a small stack memory. Optional data and heap regions of
+    any size can be mapped too; memory is paged, so only touched pages
+    cost host memory. With a ProgramCache, decoded programs are reused
+    across runs instead of being parsed again.
     """
-    def __init__(self, stack_size=256):
-        # Task 2: Create ARM64 registers
-        self.regs = {f'X{i}': 0 for i in range(31)}
-        self.regs['XZR'] = 0 # Zero register
+    def __init__(self, stack_size=256, data_size=0, heap_size=0, program_cache=None):
+        # Task 2: Create ARM64 registers (indexed as in REG_TABLE)
+        self.regs = [0] * NUM_REG_SLOTS
         self.pc = 0
         
-        # Processor state register bits
-        self.n_flag = 0  # Negative flag
-        self.z_flag = 1  # Zero flag (initialized to 1 as regs are 0)
+        # Processor state register bits are computed lazily from the last
+        # flag-setting result (0 -> N=0, Z=1 as regs are 0)
+        self._flag_result = 0
         
-        # Task 3: Prepare stack memory
+        # Task 3: Prepare stack memory (plus optional data/heap regions)
         self.stack_base_addr = 0x7FFF_FFFF_E00  # Arbitrary high memory address
         self.stack_size = stack_size
-        self.memory = bytearray(stack_size)
-        self.regs['SP'] = self.stack_base_addr + self.stack_size
+        self.memory = PagedMemory()
+        self.memory.map_region('stack', self.stack_base_addr, stack_size)
+        if data_size:
+            self.memory.map_region('data', DATA_BASE_ADDR, data_size)
+        if heap_size:
+            self.memory.map_region('heap', HEAP_BASE_ADDR, heap_size)
+        self.regs[REG_SP] = self.stack_base_addr + self.stack_size
 
-        # For mapping instruction mnemonics to handler functions
-        self.handlers = self._get_handlers()
         self.labels = {}
         self.running = False
         self.instruction_count = 0
+        self.program_cache = program_cache
+        self.profiler = None   # a profiler.Profiler, used by silent/final runs
+        self.trace_writer = None  # a delta_trace.TraceWriter, used by silent/final runs
+        self.fuse_pairs = True  # silent/final runs use superinstructions (see fuse())
+        self.fusions = 0
+        # Counted loops run in closed form (see loop_accel); their iterations
+        # are counted but don't use up max_instructions
+        self.accelerate_loops = False
+        self.loop_instructions = 0
+        # Instructions that loops without a closed form may still run in this run
+        self._loop_budget = None
+        # run() passes programs through optimizer.optimize() first
+        self.optimize_program = False
+        self.optimizer_stats = None
+
+        # Debug hooks; runs without any use the plain dispatch loops
+        self.breakpoints = {}  # id -> (address, label or None for any PC, condition)
+        self.watchpoints = {}  # id -> (start, end, access)
+        self.stop_reason = None
+        self._next_hook_id = 1
+        self._decoded = None
+        self.history = None    # reverse-execution log, see enable_history()
 
     # =========================================================================
     # NEW METHOD TO PRINT INITIAL SETUP FOR TASKS 1, 2, AND 3
@@ -66,80 +162,52 @@ class ARM64Emulator:
         self.print_registers()
         self.print_stack()
 
-    def _get_handlers(self):
-        # Task 5: Map instructions to their implementation
-        return {
-            'ADD': self._handle_add, 'SUB': self._handle_sub,
-            'EOR': self._handle_eor, 'AND': self._handle_and,
-            'MUL': self._handle_mul, 'MOV': self._handle_mov,
-            'STR': self._handle_str, 'STRB': self._handle_strb,
-            'LDR': self._handle_ldr, 'LDRB': self._handle_ldrb,
-            'NOP': self._handle_nop, 'B': self._handle_b,
-            'B.GT': self._handle_b_gt, 'B.LE': self._handle_b_le,
-            'CMP': self._handle_cmp, 'RET': self._handle_ret,
-        }
-
     # --- Register and Flag Helpers (Task 2 & 6) ---
-    def _is_w_reg(self, reg_name):
-        return reg_name.startswith('W')
-
-    def _to_x_reg(self, reg_name):
-        if self._is_w_reg(reg_name):
-            if reg_name == 'WSP': return 'SP'
-            if reg_name == 'WZR': return 'XZR'
-            return 'X' + reg_name[1:]
-        return reg_name
-
     def _get_reg(self, name):
-        if name == 'XZR' or name == 'WZR':
-            return 0
-        
-        x_reg = self._to_x_reg(name)
-        val = self.regs.get(x_reg)
-        if val is None:
+        entry = REG_TABLE.get(name)
+        if entry is None:
             raise ValueError(f"Unknown register: {name}")
-
         # Task 6: For 32-bit registers, only return the lower 32 bits
-        if self._is_w_reg(name):
-            return val & 0xFFFFFFFF
-        return val
+        index, mask = entry
+        return self.regs[index] & mask
 
     def _set_reg(self, name, value):
-        if name == 'XZR' or name == 'WZR':
-            return # Cannot write to the zero register
-
-        x_reg = self._to_x_reg(name)
-        if x_reg not in self.regs:
-            raise ValueError(f"Unknown register: {name}")
-
+        index, mask = self._decode_dest(name)
         # Task 6: For 32-bit registers, zero-extend to 64 bits
-        if self._is_w_reg(name):
-            self.regs[x_reg] = value & 0xFFFFFFFF
-        else:
-            self.regs[x_reg] = value & 0xFFFFFFFFFFFFFFFF
+        self.regs[index] = value & mask
 
     def _update_flags(self, result):
-        result_64 = result & 0xFFFFFFFFFFFFFFFF
-        self.z_flag = 1 if result_64 == 0 else 0
-        self.n_flag = (result_64 >> 63) & 1
+        # N and Z are only derived when a branch or a state dump reads them
+        self._flag_result = result
+
+    @property
+    def n_flag(self):
+        """Negative flag, derived from the last flag-setting result."""
+        return (self._flag_result & MASK64) >> 63
+
+    @n_flag.setter
+    def n_flag(self, value):
+        self._set_flags(value, self.z_flag)
+
+    @property
+    def z_flag(self):
+        """Zero flag, derived from the last flag-setting result."""
+        return 1 if self._flag_result & MASK64 == 0 else 0
+
+    @z_flag.setter
+    def z_flag(self, value):
+        self._set_flags(self.n_flag, value)
+
+    def _set_flags(self, n, z):
+        # Pick a result that reproduces N and Z (N=1, Z=1 cannot come from a result)
+        self._flag_result = (SIGN64 if n else 0) | (0 if z else 1)
 
     # --- Memory Helpers (Task 3) ---
     def _mem_op(self, address, num_bytes, value=None, write=False):
-        if not (self.stack_base_addr <= address < self.stack_base_addr + self.stack_size):
-            raise MemoryError(f"Memory access violation at address {address:#x}")
-        
-        offset = address - self.stack_base_addr
-        if offset + num_bytes > self.stack_size:
-             raise MemoryError(f"Memory access out of bounds at address {address:#x}")
-
         if write:
-            for i in range(num_bytes):
-                self.memory[offset + i] = (value >> (i * 8)) & 0xFF
+            self.memory.write(address, num_bytes, value)
         else:
-            read_val = 0
-            for i in range(num_bytes):
-                read_val |= self.memory[offset + i] << (i * 8)
-            return read_val
+            return self.memory.read(address, num_bytes)
             
     # --- Parser and Operand Helpers (Task 1) ---
     def _parse_mem_operand(self, op_str):
@@ -171,178 +239,1302 @@ class ARM64Emulator:
         operands = [op.strip() for op in re.split(r',\s*(?![^[]*\])', operands_str)]
         return mnemonic, operands
 
-    # --- Instruction Handlers (Task 5) ---
-    def _handle_arithmetic(self, operands, op_func):
-        dest_reg, src_reg1, op2_str = operands
-        val1 = self._get_reg(src_reg1)
-        op2 = self._parse_operand(op2_str)
-        val2 = self._get_reg(op2) if isinstance(op2, str) else op2
-        
-        result = op_func(val1, val2)
-        self._set_reg(dest_reg, result)
-        self._update_flags(result)
-
-    def _handle_add(self, operands): self._handle_arithmetic(operands, lambda a, b: a + b)
-    def _handle_sub(self, operands): self._handle_arithmetic(operands, lambda a, b: a - b)
-    def _handle_eor(self, operands): self._handle_arithmetic(operands, lambda a, b: a ^ b)
-    def _handle_and(self, operands): self._handle_arithmetic(operands, lambda a, b: a & b)
-    def _handle_mul(self, operands): self._handle_arithmetic(operands, lambda a, b: a * b)
-    
-    def _handle_mov(self, operands):
-        dest_reg, op2_str = operands
-        op2 = self._parse_operand(op2_str)
-        val2 = self._get_reg(op2) if isinstance(op2, str) else op2
-        self._set_reg(dest_reg, val2)
-
-    def _handle_cmp(self, operands):
-        src_reg1, op2_str = operands
-        val1 = self._get_reg(src_reg1)
-        op2 = self._parse_operand(op2_str)
-        val2 = self._get_reg(op2) if isinstance(op2, str) else op2
-        result = val1 - val2
-        self._update_flags(result)
-        
-    def _handle_mem_access(self, operands, is_store, is_byte):
-        reg, mem_op_str = operands
-        base_reg, offset = self._parse_mem_operand(mem_op_str)
-        address = self._get_reg(base_reg) + offset
-        num_bytes = 1 if is_byte else 8
-        
-        if is_store:
-            value = self._get_reg(reg)
-            self._mem_op(address, num_bytes, value, write=True)
-        else: # Load
-            value = self._mem_op(address, num_bytes, write=False)
-            self._set_reg(reg, value)
-            
-    def _handle_ldr(self, operands): self._handle_mem_access(operands, is_store=False, is_byte=False)
-    def _handle_ldrb(self, operands): self._handle_mem_access(operands, is_store=False, is_byte=True)
-    def _handle_str(self, operands): self._handle_mem_access(operands, is_store=True, is_byte=False)
-    def _handle_strb(self, operands): self._handle_mem_access(operands, is_store=True, is_byte=True)
+    # --- Decoder (Task 1 & 5) ---
+    def _decode_reg(self, name):
+        """Resolves a register operand to its register file index and read mask."""
+        entry = REG_TABLE.get(name)
+        if entry is None:
+            raise ValueError(f"Unknown register: {name}")
+        return entry
 
-    def _handle_nop(self, operands): pass
-    def _handle_ret(self, operands): self.running = False
-    
-    def _handle_b(self, operands):
-        label = operands[0]
-        if label in self.labels:
-            self.pc = self.labels[label] - 4
-        else:
+    def _decode_dest(self, name):
+        """Like _decode_reg, but writes to the zero register go to the sink slot."""
+        index, mask = self._decode_reg(name)
+        if index == REG_ZR:
+            return REG_ZR_SINK, mask
+        return index, mask
+
+    def _decode_op2(self, op_str):
+        """Decodes a register-or-immediate operand to (key, mask, imm)."""
+        op2 = self._parse_operand(op_str)
+        if isinstance(op2, str):
+            return self._decode_reg(op2) + (None,)
+        return None, 0, op2
+
+    def _decode_instruction(self, mnemonic, operands):
+        """Turns one parsed instruction into a (handler, args) pair."""
+        if mnemonic in ALU_OPS:
+            dest_reg, src_reg1, op2_str = operands
+            d, dmask = self._decode_dest(dest_reg)
+            n, nmask = self._decode_reg(src_reg1)
+            m, mmask, imm = self._decode_op2(op2_str)
+            if m is None:
+                return self._exec_alu_imm, (ALU_OPS[mnemonic], d, dmask, n, nmask, imm)
+            return self._exec_alu_reg, (ALU_OPS[mnemonic], d, dmask, n, nmask, m, mmask)
+        if mnemonic == 'MOV':
+            dest_reg, op2_str = operands
+            d, dmask = self._decode_dest(dest_reg)
+            m, mmask, imm = self._decode_op2(op2_str)
+            if m is None:
+                return self._exec_mov_imm, (d, dmask, imm)
+            return self._exec_mov_reg, (d, dmask, m, mmask)
+        if mnemonic == 'CMP':
+            src_reg1, op2_str = operands
+            n, nmask = self._decode_reg(src_reg1)
+            m, mmask, imm = self._decode_op2(op2_str)
+            if m is None:
+                return self._exec_cmp_imm, (n, nmask, imm)
+            return self._exec_cmp_reg, (n, nmask, m, mmask)
+        if mnemonic in MEM_OPS:
+            reg, mem_op_str = operands
+            base_reg, offset = self._parse_mem_operand(mem_op_str)
+            base, base_mask = self._decode_reg(base_reg)
+            is_store, num_bytes = MEM_OPS[mnemonic]
+            if is_store:
+                t, tmask = self._decode_reg(reg)
+                return self._exec_store, (t, tmask, base, base_mask, offset, num_bytes)
+            t, tmask = self._decode_dest(reg)
+            return self._exec_load, (t, tmask, base, base_mask, offset, num_bytes)
+        if mnemonic in BRANCH_OPS:
+            label = operands[0]
+            target = self.labels.get(label)
+            return getattr(self, BRANCH_OPS[mnemonic]), (target, label)
+        if mnemonic == 'NOP':
+            return self._exec_nop, ()
+        if mnemonic == 'RET':
+            return self._exec_ret, ()
+        raise NotImplementedError(f"Instruction '{mnemonic}' not implemented.")
+
+    def decode(self, program):
+        """
+        Decodes a program once into a list of (handler, args, text) records,
+        one per line of the label-free program. Comment-only lines decode to
+        None. Decode errors are deferred until the faulting line executes.
+        Goes through self.program_cache when one is set.
+        """
+        cache = self.program_cache
+        if cache is None or self.labels:
+            # Labels left over from an earlier program affect decoding
+            return self._decode(program)
+        key = cache.key('emulator', DECODER_VERSION, '\n'.join(program))
+        entry = cache.load(key)
+        if entry is not None:
+            return self.unpack_program(entry)
+        decoded = self._decode(program)
+        entry = self.pack_program(decoded)
+        if entry is not None:
+            cache.store(key, entry)
+        return decoded
+
+    def pack_program(self, decoded):
+        """
+        Plain-data (labels, records) form of decoded records, as stored in
+        the program cache and shared memory, or None if a record has none.
+        """
+        records = [self._pack_record(record) for record in decoded]
+        if any(record is False for record in records):
+            return None
+        return dict(self.labels), records
+
+    def unpack_program(self, entry):
+        """Decoded records from pack_program() output; adds its labels to this emulator's."""
+        labels, records = entry
+        self.labels.update(labels)
+        return [self._unpack_record(record) for record in records]
+
+    def _decode(self, program):
+        self._pre_scan_for_labels(program)
+        decoded = []
+        for line in program:
+            if not line.strip() or line.strip().endswith(':'):
+                continue
+            try:
+                mnemonic, operands = self._parse_line(line)
+                if not mnemonic:
+                    decoded.append(None)
+                    continue
+                handler, args = self._decode_instruction(mnemonic, operands)
+            except Exception as e:
+                handler, args = self._exec_raise, (e,)
+            decoded.append((handler, args, line.strip()))
+        return decoded
+
+    def _pack_record(self, record):
+        """Plain-data form of a decoded record for the program cache (False if it has none)."""
+        if record is None:
+            return None
+        handler, args, text = record
+        name = handler.__name__
+        if name in ('_exec_alu_reg', '_exec_alu_imm'):
+            args = (ALU_NAMES[args[0]],) + args[1:]
+        elif name == '_exec_raise':
+            error = args[0]
+            if getattr(builtins, type(error).__name__, None) is not type(error):
+                return False
+            args = (type(error).__name__, error.args)
+        return (name, args, text)
+
+    def _unpack_record(self, record):
+        if record is None:
+            return None
+        name, args, text = record
+        if name in ('_exec_alu_reg', '_exec_alu_imm'):
+            args = (ALU_OPS[args[0]],) + args[1:]
+        elif name == '_exec_raise':
+            error_type, error_args = args
+            args = (getattr(builtins, error_type)(*error_args),)
+        return (getattr(self, name), args, text)
+
+    # --- Decoded Instruction Handlers (Task 5) ---
+    def _exec_alu_reg(self, op_func, d, dmask, n, nmask, m, mmask):
+        regs = self.regs
+        result = op_func(regs[n] & nmask, regs[m] & mmask)
+        regs[d] = result & dmask
+        self._flag_result = result
+
+    def _exec_alu_imm(self, op_func, d, dmask, n, nmask, imm):
+        regs = self.regs
+        result = op_func(regs[n] & nmask, imm)
+        regs[d] = result & dmask
+        self._flag_result = result
+
+    def _exec_mov_reg(self, d, dmask, m, mmask):
+        self.regs[d] = self.regs[m] & mmask & dmask
+
+    def _exec_mov_imm(self, d, dmask, imm):
+        self.regs[d] = imm & dmask
+
+    def _exec_cmp_reg(self, n, nmask, m, mmask):
+        self._flag_result = (self.regs[n] & nmask) - (self.regs[m] & mmask)
+
+    def _exec_cmp_imm(self, n, nmask, imm):
+        self._flag_result = (self.regs[n] & nmask) - imm
+
+    def _exec_store(self, t, tmask, base, base_mask, offset, num_bytes):
+        address = (self.regs[base] & base_mask) + offset
+        self.memory.write(address, num_bytes, self.regs[t] & tmask)
+
+    def _exec_load(self, t, tmask, base, base_mask, offset, num_bytes):
+        address = (self.regs[base] & base_mask) + offset
+        self.regs[t] = self.memory.read(address, num_bytes) & tmask
+
+    def _exec_b(self, target, label):
+        if target is None:
             raise ValueError(f"Undefined label: {label}")
+        self.pc = target - 4
 
-    def _handle_b_gt(self, operands):
-        if self.z_flag == 0 and self.n_flag == 0:
-            self._handle_b(operands)
-            
-    def _handle_b_le(self, operands):
-        if self.z_flag == 1 or self.n_flag == 1:
-            self._handle_b(operands)
+    def _exec_b_gt(self, target, label):
+        # GT: Z == 0 and N == 0
+        if 0 < self._flag_result & MASK64 < SIGN64:
+            self._exec_b(target, label)
+
+    def _exec_b_le(self, target, label):
+        # LE: Z == 1 or N == 1
+        if not 0 < self._flag_result & MASK64 < SIGN64:
+            self._exec_b(target, label)
+
+    def _exec_nop(self): pass
+    def _exec_ret(self): self.running = False
+
+    def _exec_raise(self, error):
+        raise error
 
     # --- Main Execution Loop (Task 4 & 7) ---
     def _pre_scan_for_labels(self, program):
-        for i, line in enumerate(program):
+        # A label is the address of the next slot that _decode produces, so
+        # blank and label lines don't move it
+        slot = 0
+        for line in program:
             line = line.strip()
             if line.endswith(':'):
-                label = line[:-1]
-                self.labels[label] = i * 4
+                self.labels[line[:-1]] = slot * 4
+            elif line:
+                slot += 1
+
+    def run(self, program, verbosity='full', dump_every=1,
+            max_instructions=INSTRUCTION_LIMIT, out=None):
+        """
+        Runs the program. `verbosity` is one of VERBOSITY_LEVELS:
+          'silent' - no output at all
+          'final'  - only the final state
+          'steps'  - one line per executed instruction, then the final state
+          'full'   - a header per instruction and a full state dump every
+                     `dump_every` instructions (every one by default)
+        Output goes to `out` (sys.stdout by default) through an OutputBuffer.
+        The run halts once more than `max_instructions` have executed.
+        """
+        if verbosity not in VERBOSITY_LEVELS:
+            raise ValueError(f"Unknown verbosity: {verbosity}")
+        self.run_decoded(self._prepare(program), verbosity, dump_every, max_instructions, out)
+
+    def _prepare(self, program):
+        """decode(program), optimized when self.optimize_program is set."""
+        decoded = self.decode(program)
+        if self.optimize_program:
+            decoded, self.optimizer_stats = optimizer.optimize(self, decoded)
+        return decoded
+
+    def run_decoded(self, decoded, verbosity='full', dump_every=1,
+                    max_instructions=INSTRUCTION_LIMIT, out=None):
+        """Like run(), for records that are already decoded (see decode())."""
+        if verbosity not in VERBOSITY_LEVELS:
+            raise ValueError(f"Unknown verbosity: {verbosity}")
+        writer = OutputBuffer(out or sys.stdout)
 
-    def run(self, program):
-        clean_program = [line for line in program if line.strip() and not line.strip().endswith(':')]
-        self._pre_scan_for_labels(program)
-        
         self.pc = 0
         self.running = True
 
-        print("\n" + "="*120)
-        print("STARTING EMULATION RUN".center(120))
-        print("="*120 + "\n")
+        self.stop_reason = None
 
-        while self.running:
-            if not (0 <= self.pc < len(clean_program) * 4):
-                print("\nPC out of bounds. Halting.")
+        try:
+            if self.breakpoints or self.watchpoints or self.history is not None:
+                if verbosity not in ('silent', 'final'):
+                    raise ValueError("Breakpoints, watchpoints and history need verbosity 'silent' or 'final'")
+                self._decoded = decoded
+                if self.history is not None:
+                    self.history.reset(self)
+                if self._run_debug(decoded, max_instructions, writer, verbosity == 'silent', False):
+                    return
+            elif self.profiler is not None:
+                if verbosity not in ('silent', 'final'):
+                    raise ValueError("Profiling needs verbosity 'silent' or 'final'")
+                self._start_profile(decoded)
+                self._run_profiled(decoded, max_instructions, writer, verbosity == 'silent')
+            elif self.trace_writer is not None:
+                if verbosity not in ('silent', 'final'):
+                    raise ValueError("Trace recording needs verbosity 'silent' or 'final'")
+                self._run_recorded(decoded, max_instructions, writer, verbosity == 'silent')
+            elif verbosity in ('silent', 'final'):
+                self._run_quiet(decoded, max_instructions, writer, verbosity == 'silent')
+            else:
+                self._run_traced(decoded, max_instructions, writer, verbosity == 'full', dump_every)
+            if verbosity != 'silent':
+                writer.write("\n--- Emulation Finished ---\n")
+                writer.write(self.format_state())
+        finally:
+            writer.flush()
+
+    # --- Breakpoints and Watchpoints ---
+    def add_breakpoint(self, where=None, condition=None):
+        """
+        Stops runs just before the instruction at `where` (a byte address or
+        a label) executes, if `condition` holds. where=None checks before
+        every instruction. `condition` is None (always), a callable taking
+        the emulator, or a dict of register values that must all match, e.g.
+        {'X1': 0}. Returns an id for remove_breakpoint().
+        """
+        if isinstance(condition, dict):
+            wanted = dict(condition)
+            condition = lambda emu: all(emu._get_reg(name) == value for name, value in wanted.items())
+        hook_id = self._next_hook_id
+        self._next_hook_id += 1
+        self.breakpoints[hook_id] = (where, condition)
+        return hook_id
+
+    def remove_breakpoint(self, hook_id):
+        del self.breakpoints[hook_id]
+
+    def add_watchpoint(self, address, size=8, access='w'):
+        """
+        Stops runs right after an instruction that reads ('r'), writes ('w')
+        or does either ('rw') any byte of [address, address + size).
+        Returns an id for remove_watchpoint().
+        """
+        if access not in ('r', 'w', 'rw'):
+            raise ValueError(f"Unknown watchpoint access: {access}")
+        hook_id = self._next_hook_id
+        self._next_hook_id += 1
+        self.watchpoints[hook_id] = (address, address + size, access)
+        return hook_id
+
+    def remove_watchpoint(self, hook_id):
+        del self.watchpoints[hook_id]
+
+    def resume(self, verbosity='final', max_instructions=INSTRUCTION_LIMIT, out=None):
+        """
+        Continues a run that stopped at a breakpoint or watchpoint, from the
+        current PC. `max_instructions` counts from the start of the run.
+        """
+        if self._decoded is None:
+            raise RuntimeError("Nothing to resume")
+        if verbosity not in ('silent', 'final'):
+            raise ValueError("Breakpoints, watchpoints and history need verbosity 'silent' or 'final'")
+        at_breakpoint = self.stop_reason is not None and self.stop_reason['kind'] == 'breakpoint'
+        self.stop_reason = None
+        self.running = True
+        writer = OutputBuffer(out or sys.stdout)
+        try:
+            if self._run_debug(self._decoded, max_instructions, writer, verbosity == 'silent',
+                               at_breakpoint):
+                return
+            if verbosity != 'silent':
+                writer.write("\n--- Emulation Finished ---\n")
+                writer.write(self.format_state())
+        finally:
+            writer.flush()
+
+    def _breakpoint_table(self):
+        """PC -> [(id, condition)] plus the breakpoints checked at every PC."""
+        at_pc, anywhere = {}, []
+        for hook_id, (where, condition) in self.breakpoints.items():
+            if where is None:
+                anywhere.append((hook_id, condition))
+                continue
+            if isinstance(where, str):
+                if where not in self.labels:
+                    raise ValueError(f"Undefined label: {where}")
+                where = self.labels[where]
+            at_pc[where] = at_pc.get(where, ()) + ((hook_id, condition),)
+        return at_pc, tuple(anywhere)
+
+    def _run_debug(self, decoded, max_instructions, writer, silent, skip_first):
+        """
+        _run_quiet with breakpoint and watchpoint checks. Returns True if a
+        hook stopped the run (stop_reason says which), after reporting it.
+        """
+        at_pc, anywhere = self._breakpoint_table()
+        hits = []
+        memory = self.memory
+        if self.watchpoints:
+            self.memory = _WatchedMemory(memory, self.watchpoints, hits)
+        history = self.history
+        if history is not None:
+            old_bytes = []
+            self.memory = _UndoMemory(self.memory, old_bytes)
+        end_pc = len(decoded) * 4
+        try:
+            while self.running:
+                if not (0 <= self.pc < end_pc):
+                    if not silent:
+                        writer.write("\nPC out of bounds. Halting.\n")
+                    break
+
+                if skip_first:
+                    skip_first = False
+                else:
+                    candidates = at_pc.get(self.pc, ()) + anywhere
+                    if candidates:
+                        for hook_id, condition in candidates:
+                            if condition is None or condition(self):
+                                self.stop_reason = {'kind': 'breakpoint', 'id': hook_id, 'pc': self.pc}
+                                break
+                        if self.stop_reason is not None:
+                            break
+
+                pc = self.pc
+                record = decoded[pc // 4]
+                if record is not None:
+                    if history is not None:
+                        old_regs = self.regs[:]
+                        old_flags = self._flag_result
+                    record[0](*record[1])
+                    self.instruction_count += 1
+                    self.pc += 4
+                    if history is not None:
+                        self._record_undo(history, pc, old_regs, old_flags, old_bytes)
+                    if self.instruction_count > max_instructions:
+                        if not silent:
+                            writer.write("Instruction limit reached. Halting.\n")
+                        break
+                else:
+                    self.pc += 4
+                if hits:
+                    hook_id, address, num_bytes, access = hits[0]
+                    self.stop_reason = {'kind': 'watchpoint', 'id': hook_id, 'pc': pc,
+                                        'address': address, 'size': num_bytes, 'access': access}
+                    break
+        finally:
+            self.memory = memory
+
+        if self.stop_reason is None:
+            return False
+        if not silent:
+            stop = self.stop_reason
+            text = decoded[stop['pc'] // 4][2] if decoded[stop['pc'] // 4] else ''
+            if stop['kind'] == 'breakpoint':
+                writer.write(f"\nBreakpoint {stop['id']} hit at {stop['pc']:#x} ({text}).\n")
+            else:
+                verb = 'read' if stop['access'] == 'r' else 'write'
+                writer.write(f"\nWatchpoint {stop['id']} hit: {verb} of {stop['size']} bytes at "
+                             f"{stop['address']:#x} by {stop['pc']:#x} ({text}).\n")
+            writer.write(self.format_state())
+        return True
+
+    # --- Reverse Execution ---
+    def enable_history(self, snapshot_interval=1000):
+        """
+        Makes silent/final runs keep an undo record per instruction (the
+        registers, flags and memory bytes it overwrote) and a full snapshot
+        every `snapshot_interval` instructions, so step_back(),
+        run_back_to_breakpoint() and goto() can move backwards through the
+        run. Each run starts a new history.
+        """
+        if snapshot_interval < 1:
+            raise ValueError("snapshot_interval must be at least 1")
+        self.history = _History(snapshot_interval)
+
+    def _record_undo(self, history, pc, old_regs, old_flags, old_bytes):
+        regs = self.regs
+        changed = [(i, old_regs[i]) for i in itertools.compress(range(NUM_REG_SLOTS), map(operator.ne, regs, old_regs))]
+        history.undo.append((history.resume_pc, pc, changed, old_flags, tuple(old_bytes)))
+        old_bytes.clear()
+        history.resume_pc = self.pc
+        if self.instruction_count % history.interval == 0:
+            history.add_snapshot(self.instruction_count, self.snapshot())
+
+    def _undo_step(self):
+        """Reverts the last recorded instruction; returns its PC and the memory it wrote."""
+        resume_pc, pc, changed, flags, old_bytes = self.history.undo.pop()
+        regs = self.regs
+        for index, value in changed:
+            regs[index] = value
+        self._flag_result = flags
+        for address, data in reversed(old_bytes):
+            self.memory.poke(address, data)
+        self.pc = resume_pc
+        self.running = True
+        self.instruction_count -= 1
+        self.history.resume_pc = resume_pc
+        return pc, old_bytes
+
+    def _require_history(self):
+        if self.history is None or self._decoded is None:
+            raise RuntimeError("No execution history; call enable_history() before run()")
+        return self.history
+
+    def step_back(self, count=1):
+        """Undoes up to `count` instructions. Returns how many were undone."""
+        history = self._require_history()
+        done = 0
+        while done < count and history.undo:
+            self._undo_step()
+            done += 1
+        history.drop_snapshots_after(self.instruction_count)
+        self.stop_reason = None
+        return done
+
+    def run_back_to_breakpoint(self):
+        """
+        Runs backwards until the state just before an instruction where a
+        breakpoint fires, or just before an instruction that wrote to a
+        write watchpoint. Returns True if one stopped it (see stop_reason),
+        False if it reached the start of the history.
+        """
+        history = self._require_history()
+        at_pc, anywhere = self._breakpoint_table()
+        watched = [(hook_id, start, end) for hook_id, (start, end, kinds) in self.watchpoints.items()
+                   if 'w' in kinds]
+        self.stop_reason = None
+        while history.undo:
+            pc, old_bytes = self._undo_step()
+            for hook_id, start, end in watched:
+                for address, data in old_bytes:
+                    if address < end and start < address + len(data):
+                        self.stop_reason = {'kind': 'watchpoint', 'id': hook_id, 'pc': pc,
+                                            'address': address, 'size': len(data), 'access': 'w'}
+                        break
+                if self.stop_reason is not None:
+                    break
+            if self.stop_reason is None:
+                for hook_id, condition in at_pc.get(pc, ()) + anywhere:
+                    if condition is None or condition(self):
+                        self.stop_reason = {'kind': 'breakpoint', 'id': hook_id, 'pc': pc}
+                        break
+            if self.stop_reason is not None:
                 break
-                
-            line_idx = self.pc // 4
-            line = clean_program[line_idx]
-            
-            mnemonic, operands = self._parse_line(line)
-            if not mnemonic:
-                self.pc += 4
+        history.drop_snapshots_after(self.instruction_count)
+        return self.stop_reason is not None
+
+    def goto(self, step):
+        """
+        Moves to the state after `step` instructions of the current run
+        (instruction_count == step). Going back more than one snapshot
+        interval restores the closest snapshot and re-executes at most one
+        interval; going forward executes, ignoring breakpoints and
+        watchpoints, and stops early if the program ends.
+        """
+        history = self._require_history()
+        if step < history.base:
+            raise ValueError(f"Step {step} is before the start of the history ({history.base})")
+        self.stop_reason = None
+        if step < self.instruction_count:
+            if self.instruction_count - step > history.interval:
+                snapshot_step, snapshot = history.snapshot_at(step)
+                self.restore(snapshot)
+                del history.undo[snapshot_step - history.base:]
+                history.resume_pc = self.pc
+            while self.instruction_count > step:
+                self._undo_step()
+            history.drop_snapshots_after(self.instruction_count)
+        if step > self.instruction_count and self.running:
+            hooks = self.breakpoints, self.watchpoints
+            self.breakpoints, self.watchpoints = {}, {}
+            try:
+                self._run_debug(self._decoded, step - 1, OutputBuffer(sys.stdout), True, False)
+            finally:
+                self.breakpoints, self.watchpoints = hooks
+        return self.instruction_count
+
+    # --- Snapshots ---
+    def snapshot(self):
+        """
+        Captures registers, flags, PC, instruction count and memory. Memory
+        pages are shared copy-on-write with the running emulator, so this
+        only copies the pages written since the previous snapshot.
+        """
+        return EmulatorSnapshot(self.pc, self.running, self.instruction_count, self.regs[:],
+                                self._flag_result, self.memory.snapshot())
+
+    def restore(self, snapshot):
+        """Returns to the state a snapshot() captured. A snapshot can be restored any number of times."""
+        self.pc = snapshot.pc
+        self.running = snapshot.running
+        self.instruction_count = snapshot.instruction_count
+        self.regs[:] = snapshot.regs
+        self._flag_result = snapshot.flag_result
+        self.memory.restore(snapshot.pages)
+        self.stop_reason = None
+
+    def run_budgeted(self, program, max_instructions=INSTRUCTION_LIMIT, time_budget=None,
+                     slice_size=10000):
+        """
+        Runs the program silently, giving up once more than `max_instructions`
+        have executed or `time_budget` seconds have passed (checked every
+        `slice_size` instructions). Returns why the run stopped: 'ret',
+        'pc_out_of_bounds', 'instruction_limit' or 'timeout'.
+        """
+        return self.run_decoded_budgeted(self._prepare(program), max_instructions, time_budget, slice_size)
+
+    def run_decoded_budgeted(self, decoded, max_instructions=INSTRUCTION_LIMIT, time_budget=None,
+                             slice_size=10000):
+        """Like run_budgeted(), for records that are already decoded (see decode())."""
+        threaded = self.thread(decoded)
+        deadline = None if time_budget is None else time.perf_counter() + time_budget
+        self.pc = 0
+        self.running = True
+        limit = self.instruction_count
+        while True:
+            limit = min(limit + slice_size, max_instructions)
+            stopped = self.run_until(decoded, limit, threaded)
+            if stopped:
+                return stopped
+            if limit >= max_instructions:
+                return 'instruction_limit'
+            if deadline is not None and time.perf_counter() > deadline:
+                return 'timeout'
+
+    def run_until(self, decoded, max_instructions, threaded=None):
+        """
+        Runs decoded records silently from the current PC until the program
+        stops or `max_instructions` (a total, like instruction_count) have
+        executed; `threaded` is thread(decoded), built if not given. Returns
+        'ret' or 'pc_out_of_bounds' once the program has stopped, else None.
+        """
+        self._run_quiet(decoded, max_instructions + self.loop_instructions, OutputBuffer(sys.stdout),
+                        True, threaded)
+        if not self.running:
+            return 'ret'
+        if not (0 <= self.pc < len(decoded) * 4):
+            return 'pc_out_of_bounds'
+        return None
+
+    def _run_quiet(self, decoded, max_instructions, writer, silent, threaded=None):
+        """
+        Threaded-code dispatch loop without any per-instruction output.
+        `threaded` is thread(decoded), built here if not given. Each op
+        names the slot to run next, so there is no PC arithmetic, bounds
+        check or label lookup between instructions; self.pc is only worked
+        out when the run stops.
+        """
+        if not self.running:
+            return
+        if not (0 <= self.pc < len(decoded) * 4):
+            if not silent:
+                writer.write("\nPC out of bounds. Halting.\n")
+            return
+        if threaded is None:
+            threaded = self.thread(decoded)
+        count = self.instruction_count
+        loop_instructions = self.loop_instructions
+        self._loop_budget = max_instructions - count
+        i = self.pc // 4
+        op = threaded[1][i]
+        r = None
+        try:
+            # Superinstructions run two instructions, so they stop two short of
+            # the limit; a run that starts past it still executes one instruction
+            for ops, limit in ((threaded[0], max_instructions - 2),
+                               (threaded[1], max(max_instructions, count))):
+                while count <= limit:
+                    op = ops[i]
+                    r = op[0](*op[1])
+                    count += op[3]
+                    if r is None:
+                        i = op[2]
+                    elif r >= 0:
+                        i = r
+                    else:
+                        break
+                if r is not None and r < 0:
+                    break
+            else:
+                self.pc = i * 4
+            if r == _LEFT_PROGRAM:
+                if not silent:
+                    writer.write("\nPC out of bounds. Halting.\n")
+            elif count > max_instructions and not silent:
+                writer.write("Instruction limit reached. Halting.\n")
+        except BaseException:
+            self.pc = (op[2] - op[3]) * 4   # the first slot of the op that raised
+            raise
+        finally:
+            self.instruction_count = count + self.loop_instructions - loop_instructions
+
+    # --- Threaded Code ---
+    def thread(self, decoded):
+        """
+        Threads decoded records for _run_quiet. Returns (ops, plain_ops):
+        lists indexed by slot whose entries are (handler, args, successor
+        slot, instructions). Branch targets are resolved to slots here.
+        Handlers return None to go on at the successor, or the slot to go on
+        at; a negative value ends the run (RET, or leaving the program
+        through one of the exit ops after the last slot). Comment-only slots
+        share the op of the next instruction. `ops` also holds the
+        superinstructions from fuse() and, with self.accelerate_loops,
+        counted loops; `plain_ops` runs one instruction per op.
+        """
+        n = len(decoded)
+        plain = [None] * n + [(self._thread_exit, (n * 4,), n, 0)]
+        exits = {}
+
+        def slot(target):
+            if target % 4 == 0 and 0 <= target <= n * 4:
+                return target // 4
+            if target not in exits:
+                # Branches to outside the program leave it, with PC at the target
+                exits[target] = len(plain)
+                plain.append((self._thread_exit, (target,), n, 0))
+            return exits[target]
+
+        for i, record in enumerate(decoded):
+            if record is None:
+                continue
+            handler, args = record[0], record[1]
+            name = handler.__name__
+            if name in _THREADED_BRANCHES and args[0] is not None:
+                plain[i] = (getattr(self, _THREADED_BRANCHES[name]), (slot(args[0]), i + 1), i + 1, 1)
+            elif name == '_exec_ret':
+                plain[i] = (self._thread_ret, ((i + 1) * 4,), i + 1, 1)
+            else:
+                plain[i] = (handler, args, i + 1, 1)
+
+        ops = list(plain)
+        if self.fuse_pairs:
+            for i, pair in enumerate(self.fuse(decoded)):
+                if pair is not None:
+                    ops[i] = pair + (i + 2, 2)
+        if self.accelerate_loops:
+            ir = [self._lower_record(record) for record in decoded]
+            for loop in find_counted_loops(ir, decoded):
+                name, args = decoded[loop.head][0].__name__, decoded[loop.head][1]
+                fallback = self._cmp_operands(name, args) + (loop.on_gt, loop.start, loop.head + 2)
+                ops[loop.head] = (self._exec_counted_loop, (loop, fallback), loop.head + 2, 2)
+                ops[loop.head - 1] = plain[loop.head - 1]   # a fused ALU + CMP would step over the loop's CMP
+
+        for table in (plain, ops):
+            for i in range(n - 1, -1, -1):
+                if decoded[i] is None:
+                    table[i] = table[i + 1]
+        return ops, plain
+
+    def _thread_b(self, target, next_slot):
+        return target
+
+    def _thread_b_gt(self, target, next_slot):
+        return target if 0 < self._flag_result & MASK64 < SIGN64 else next_slot
+
+    def _thread_b_le(self, target, next_slot):
+        return next_slot if 0 < self._flag_result & MASK64 < SIGN64 else target
+
+    def _thread_ret(self, pc):
+        self.running = False
+        self.pc = pc
+        return _RETURNED
+
+    def _thread_exit(self, pc):
+        self.pc = pc
+        return _LEFT_PROGRAM
+
+    def _exec_counted_loop(self, loop, fallback):
+        """Runs a counted loop from its CMP; returns the slot after its branch (see thread())."""
+        steps = loop.run(self, self._loop_budget)
+        if steps is None:
+            return self._exec_cmp_bcond(*fallback)
+        if not loop.closed_form:
+            # Iterations that ran one by one use up the run's budget
+            self._loop_budget -= steps
+        self.loop_instructions += steps
+        return loop.head + 2
+
+    def fuse(self, decoded):
+        """
+        Peephole pass that finds CMP + B.GT/B.LE and ALU op + CMP pairs in
+        adjacent slots. Returns a list parallel to `decoded` holding a
+        (handler, args) superinstruction at the first slot of each pair, or
+        None, for thread(); `decoded` itself is untouched, so branches into
+        the second slot still run it alone. The second instruction of a pair can never
+        fault, and a pair only runs when both instructions fit in the
+        instruction budget, so the state after it is exactly the state after
+        the two separate instructions. Sets self.fusions to the number of
+        pairs found.
+        """
+        pairs = [None] * len(decoded)
+        for i in range(len(decoded) - 1):
+            first, second = decoded[i], decoded[i + 1]
+            if first is None or second is None:
                 continue
+            name, next_name = first[0].__name__, second[0].__name__
+            if name in ('_exec_cmp_reg', '_exec_cmp_imm') and next_name in ('_exec_b_gt', '_exec_b_le'):
+                target, _ = second[1]
+                if target is None or target % 4 or not 0 <= target < len(decoded) * 4:
+                    continue  # raises or leaves the program, so it keeps its own slot
+                pairs[i] = (self._exec_cmp_bcond,
+                            self._cmp_operands(name, first[1]) + (next_name == '_exec_b_gt', target // 4, i + 2))
+            elif name in ('_exec_alu_reg', '_exec_alu_imm') and next_name in ('_exec_cmp_reg', '_exec_cmp_imm'):
+                op_func, d, dmask, n, nmask = first[1][:5]
+                m, mmask, imm = (first[1][5], first[1][6], 0) if name == '_exec_alu_reg' else (REG_ZR, 0, first[1][5])
+                pairs[i] = (self._exec_alu_cmp,
+                            (op_func, d, dmask, n, nmask, m, mmask, imm) + self._cmp_operands(next_name, second[1]))
+        self.fusions = sum(pair is not None for pair in pairs)
+        return pairs
+
+    def _cmp_operands(self, name, args):
+        # CMP args as (n, nmask, m, mmask, imm); an immediate reads the zero register
+        if name == '_exec_cmp_reg':
+            return args + (0,)
+        n, nmask, imm = args
+        return (n, nmask, REG_ZR, 0, imm)
+
+    def _exec_cmp_bcond(self, n, nmask, m, mmask, imm, on_gt, target, next_slot):
+        """CMP followed by B.GT (on_gt) or B.LE; returns the slot to go on at."""
+        regs = self.regs
+        result = (regs[n] & nmask) - (regs[m] & mmask) - imm
+        self._flag_result = result
+        return target if (0 < result & MASK64 < SIGN64) == on_gt else next_slot
+
+    def _exec_alu_cmp(self, op_func, d, dmask, n, nmask, m, mmask, imm, cn, cnmask, cm, cmmask, cimm):
+        """ALU op followed by CMP."""
+        regs = self.regs
+        regs[d] = op_func(regs[n] & nmask, (regs[m] & mmask) + imm) & dmask
+        self._flag_result = (regs[cn] & cnmask) - (regs[cm] & cmmask) - cimm
+
+    def _start_profile(self, decoded):
+        branch_handlers = set(BRANCH_OPS.values())
+        self.profiler.reset(
+            [record[2] if record else '' for record in decoded],
+            [record[0].__name__ if record else '' for record in decoded],
+            [record is not None and record[0].__name__ in branch_handlers for record in decoded],
+            self.labels)
+
+    def _run_profiled(self, decoded, max_instructions, writer, silent):
+        """_run_quiet that also records each instruction in self.profiler."""
+        profiler = self.profiler
+        counts, times = profiler.counts, profiler.times
+        taken, not_taken, is_branch = profiler.taken, profiler.not_taken, profiler.is_branch
+        clock = time.perf_counter_ns
+        end_pc = len(decoded) * 4
+        count = self.instruction_count
+        try:
+            while self.running:
+                if not (0 <= self.pc < end_pc):
+                    if not silent:
+                        writer.write("\nPC out of bounds. Halting.\n")
+                    break
+
+                index = self.pc // 4
+                record = decoded[index]
+                if record is not None:
+                    start = clock()
+                    record[0](*record[1])
+                    times[index] += clock() - start
+                    counts[index] += 1
+                    if is_branch[index]:
+                        if self.pc != index * 4:
+                            taken[index] += 1
+                        else:
+                            not_taken[index] += 1
+                    count += 1
+                    if count > max_instructions:
+                        self.pc += 4
+                        if not silent:
+                            writer.write("Instruction limit reached. Halting.\n")
+                        break
+                self.pc += 4
+        finally:
+            self.instruction_count = count
 
-            print(f"--- Instruction #{line_idx} ({line.strip()}) ---")
+    def _trace_slots(self):
+        # Register values in delta_trace slot order, then N and Z as N << 1 | Z
+        slots = self.regs[:REG_SP + 1]
+        result = self._flag_result & MASK64
+        slots.append((result >= SIGN64) << 1 | (result == 0))
+        return slots
 
-            handler = self.handlers.get(mnemonic)
-            if handler:
-                pc_before = self.pc
-                handler(operands)
-                if self.pc == pc_before:
+    def _run_recorded(self, decoded, max_instructions, writer, silent):
+        """_run_quiet that writes each instruction's changes to self.trace_writer."""
+        trace = self.trace_writer
+        memory = self.memory
+        writes = []
+        self.memory = _RecordingMemory(memory, writes)
+        end_pc = len(decoded) * 4
+        count = self.instruction_count
+        before = self._trace_slots()
+        slots = range(len(before))
+        trace.keyframe(self.pc, before, memory.pages)
+        try:
+            while self.running:
+                if not (0 <= self.pc < end_pc):
+                    if not silent:
+                        writer.write("\nPC out of bounds. Halting.\n")
+                    break
+
+                record = decoded[self.pc // 4]
+                if record is not None:
+                    record[0](*record[1])
                     self.pc += 4
+                    after = self._trace_slots()
+                    changed = itertools.compress(slots, map(operator.ne, after, before))
+                    trace.step(self.pc, [(slot, after[slot]) for slot in changed], writes)
+                    writes.clear()
+                    before = after
+                    if trace.keyframe_due:
+                        trace.keyframe(self.pc, after, memory.pages)
+                    count += 1
+                    if count > max_instructions:
+                        if not silent:
+                            writer.write("Instruction limit reached. Halting.\n")
+                        break
                 else:
                     self.pc += 4
+        finally:
+            self.memory = memory
+            self.instruction_count = count
+
+    def _run_traced(self, decoded, max_instructions, writer, full, dump_every):
+        """Dispatch loop that reports every instruction."""
+        end_pc = len(decoded) * 4
+        if full:
+            writer.write("\n" + "="*120 + "\n")
+            writer.write("STARTING EMULATION RUN".center(120) + "\n")
+            writer.write("="*120 + "\n\n")
+
+        while self.running:
+            if not (0 <= self.pc < end_pc):
+                writer.write("\nPC out of bounds. Halting.\n")
+                break
+                
+            line_idx = self.pc // 4
+            record = decoded[line_idx]
+            if record is None:
+                self.pc += 4
+                continue
+
+            handler, args, text = record
+            if full:
+                writer.write(f"--- Instruction #{line_idx} ({text}) ---\n")
             else:
-                raise NotImplementedError(f"Instruction '{mnemonic}' not implemented.")
+                writer.write(f"{self.instruction_count:>8} {self.pc:#010x}  {text}\n")
+
+            handler(*args)
+            self.pc += 4
             
             self.instruction_count += 1
-            if self.instruction_count > 1000:
-                print("Instruction limit reached. Halting.")
+            if self.instruction_count > max_instructions:
+                writer.write("Instruction limit reached. Halting.\n")
                 break
 
-            self.print_state()
+            if full and self.instruction_count % dump_every == 0:
+                writer.write(self.format_state())
+
+    # --- Block Translation Engine ---
+    def _lower_src(self, index, mask):
+        return ('imm', 0) if index == REG_ZR else ('reg', index, mask)
+
+    def _lower_dst(self, index, mask):
+        return None if index == REG_ZR_SINK else (index, mask)
+
+    def _lower_record(self, record):
+        """Lowers a decoded record to the block translator's IR."""
+        if record is None:
+            return None
+        handler, args, _ = record
+        name = handler.__name__
+        if name in ('_exec_alu_reg', '_exec_alu_imm'):
+            op_func, d, dmask, n, nmask = args[:5]
+            if name == '_exec_alu_reg':
+                src2 = self._lower_src(*args[5:])
+            else:
+                src2 = ('imm', args[5])
+            return ('alu', ALU_SYMBOLS[op_func], self._lower_dst(d, dmask),
+                    self._lower_src(n, nmask), src2, True)
+        if name in ('_exec_mov_reg', '_exec_mov_imm'):
+            d, dmask = args[:2]
+            src = self._lower_src(*args[2:]) if name == '_exec_mov_reg' else ('imm', args[2])
+            return ('mov', self._lower_dst(d, dmask), src)
+        if name == '_exec_cmp_reg':
+            n, nmask, m, mmask = args
+            return ('cmp', self._lower_src(n, nmask), self._lower_src(m, mmask))
+        if name == '_exec_cmp_imm':
+            n, nmask, imm = args
+            return ('cmp', self._lower_src(n, nmask), ('imm', imm))
+        if name in ('_exec_load', '_exec_store'):
+            t, tmask, base, base_mask, offset, num_bytes = args
+            base_src = ('reg', base, base_mask)
+            if name == '_exec_store':
+                return ('store', self._lower_src(t, tmask), base_src, offset, num_bytes)
+            return ('load', self._lower_dst(t, tmask), base_src, offset, num_bytes)
+        if name in ('_exec_b', '_exec_b_gt', '_exec_b_le'):
+            cond = {'_exec_b': None, '_exec_b_gt': 'GT', '_exec_b_le': 'LE'}[name]
+            return ('b', cond) + args
+        if name == '_exec_nop':
+            return ('nop',)
+        if name == '_exec_ret':
+            return ('ret',)
+        return ('call', handler, args)
+
+    def _make_translator(self, decoded):
+        leaders = {target // 4 for target in self.labels.values()}
+        for i, record in enumerate(decoded):
+            if record is not None and record[0].__name__ in BRANCH_OPS.values():
+                leaders.add(i + 1)
+                if record[1][0] is not None:
+                    leaders.add(record[1][0] // 4)
+        return BlockTranslator(
+            [self._lower_record(record) for record in decoded],
+            [record[2] if record else '' for record in decoded],
+            leaders,
+            loads={8: 'S.memory.read({addr}, 8)', 1: 'S.memory.read({addr}, 1)'},
+            stores={8: 'S.memory.write({addr}, 8, {value})',
+                    1: 'S.memory.write({addr}, 1, {value})'},
+            call_setup='S.pc = {pc}',
+            call_next='S.pc + 4',
+            flag_result_attr='_flag_result',
+        )
+
+    def run_translated(self, program, verbosity='final',
+                       max_instructions=INSTRUCTION_LIMIT, out=None):
+        """
+        Runs the program through the basic-block translator instead of the
+        per-instruction interpreter. The final state matches run(). Only the
+        'silent' and 'final' verbosity levels are available here.
+        """
+        if verbosity not in ('silent', 'final'):
+            raise ValueError(f"run_translated does not support verbosity '{verbosity}'")
+        if (self.breakpoints or self.watchpoints or self.history is not None
+                or self.profiler is not None or self.trace_writer is not None):
+            # Hooks need per-instruction dispatch
+            self.run(program, verbosity, max_instructions=max_instructions, out=out)
+            return
+        decoded = self._prepare(program)
+        translator = self._make_translator(decoded)
+        writer = OutputBuffer(out or sys.stdout)
+        self.pc = 0
+        self.running = True
+        try:
+            self._run_blocks(translator, decoded, max_instructions, writer, verbosity == 'silent')
+            if verbosity != 'silent':
+                writer.write("\n--- Emulation Finished ---\n")
+                writer.write(self.format_state())
+        finally:
+            writer.flush()
+
+    def _run_blocks(self, translator, decoded, max_instructions, writer, silent):
+        # Runs from the current PC, like _run_quiet
+        end_pc = len(decoded) * 4
+        while self.running:
+            if not (0 <= self.pc < end_pc):
+                if not silent:
+                    writer.write("\nPC out of bounds. Halting.\n")
+                break
+
+            block = translator.block_at(self.pc)
+            if self.instruction_count + block.length > max_instructions:
+                # Not enough budget left for the whole block: finish one step at a time
+                record = decoded[self.pc // 4]
+                if record is not None:
+                    record[0](*record[1])
+                    self.instruction_count += 1
+                self.pc += 4
+                if self.instruction_count > max_instructions:
+                    if not silent:
+                        writer.write("Instruction limit reached. Halting.\n")
+                    break
+                continue
 
-        print("\n--- Emulation Finished ---")
-        self.print_state()
+            try:
+                self.pc = block.func(self)
+            except Exception:
+                self.instruction_count += translator.fault_offset
+                self.pc = block.pcs[translator.fault_offset]
+                raise
+            self.instruction_count += block.length
 
     # --- Output Formatting ---
-    def print_state(self):
-        self.print_registers()
-        self.print_stack()
+    def format_state(self):
+        return self.format_registers() + self.format_stack()
 
-    def print_registers(self):
-        print("-" * 120)
-        print("Registers:")
-        print("-" * 120)
+    def format_registers(self):
+        lines = ["-" * 120, "Registers:", "-" * 120]
         for i in range(10):
-            print(f"X{i:<2}: {self._get_reg(f'X{i}'):#018x}\t"
-                  f"X{i+10:<2}: {self._get_reg(f'X{i+10}'):#018x}\t"
-                  f"X{i+20:<2}: {self._get_reg(f'X{i+20}'):#018x}")
-        print(f"X30: {self._get_reg('X30'):#018x}\t"
-              f"SP: {self._get_reg('SP'):#018x}\tPC: {self.pc:#018x}")
-        print(f"Processor State N bit: {self.n_flag}\tProcessor State Z bit: {self.z_flag}")
+            lines.append(f"X{i:<2}: {self._get_reg(f'X{i}'):#018x}\t"
+                         f"X{i+10:<2}: {self._get_reg(f'X{i+10}'):#018x}\t"
+                         f"X{i+20:<2}: {self._get_reg(f'X{i+20}'):#018x}")
+        lines.append(f"X30: {self._get_reg('X30'):#018x}\t"
+                     f"SP: {self._get_reg('SP'):#018x}\tPC: {self.pc:#018x}")
+        lines.append(f"Processor State N bit: {self.n_flag}\tProcessor State Z bit: {self.z_flag}")
+        return "\n".join(lines) + "\n"
 
-    def print_stack(self):
-        print("-" * 120)
-        print("Stack:")
-        print("-" * 120)
+    def format_stack(self):
+        lines = ["-" * 120, "Stack:", "-" * 120]
         for i in range(0, self.stack_size, 16):
             addr = self.stack_base_addr + i
-            chunk = self.memory[i:i+16]
+            chunk = self.memory.peek(addr, min(16, self.stack_size - i))
             hex_part = ' '.join(f'{b:02x}' for b in chunk)
             ascii_part = ''.join(chr(b) if 32 <= b <= 126 else '.' for b in chunk)
-            print(f"{addr:08x}  {hex_part:<48} |{ascii_part}|")
+            lines.append(f"{addr:08x}  {hex_part:<48} |{ascii_part}|")
+        return "\n".join(lines) + "\n"
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print(f"Usage: python {sys.argv[0]} <assembly_file.s>")
-        sys.exit(1)
+    def print_state(self):
+        sys.stdout.write(self.format_state())
+
+    def print_registers(self):
+        sys.stdout.write(self.format_registers())
+
+    def print_stack(self):
+        sys.stdout.write(self.format_stack())
+
+
+class _WatchedMemory:
+    """
+    Stands in for the emulator's PagedMemory while watchpoints are set and
+    records every access that touches a watched range in `hits`.
+    """
+    def __init__(self, memory, watchpoints, hits):
+        self._memory = memory
+        self._watchpoints = list(watchpoints.items())
+        self._hits = hits
+
+    def _check(self, address, num_bytes, access):
+        for hook_id, (start, end, kinds) in self._watchpoints:
+            if access in kinds and address < end and start < address + num_bytes:
+                self._hits.append((hook_id, address, num_bytes, access))
+
+    def read(self, address, num_bytes):
+        value = self._memory.read(address, num_bytes)
+        self._check(address, num_bytes, 'r')
+        return value
+
+    def write(self, address, num_bytes, value):
+        self._memory.write(address, num_bytes, value)
+        self._check(address, num_bytes, 'w')
+
+    def __getattr__(self, name):
+        return getattr(self._memory, name)
+
+
+class EmulatorSnapshot:
+    """ARM64Emulator state captured by snapshot(); memory pages are shared copy-on-write."""
+    __slots__ = ('pc', 'running', 'instruction_count', 'regs', 'flag_result', 'pages')
+
+    def __init__(self, pc, running, instruction_count, regs, flag_result, pages):
+        self.pc = pc
+        self.running = running
+        self.instruction_count = instruction_count
+        self.regs = regs
+        self.flag_result = flag_result
+        self.pages = pages
+
+
+class _History:
+    """Undo records and periodic snapshots of one run, for reverse execution."""
+    def __init__(self, interval):
+        self.interval = interval
+        self.reset(None)
+
+    def reset(self, emulator):
+        # One undo record per instruction since `base`:
+        # (PC before it, its own PC, [(register, old value)], old flag result, ((address, old bytes),))
+        self.undo = []
+        self.snapshot_steps = []
+        self.snapshots = []
+        self.base = 0
+        self.resume_pc = 0
+        if emulator is not None:
+            self.base = emulator.instruction_count
+            self.resume_pc = emulator.pc
+            self.add_snapshot(self.base, emulator.snapshot())
+
+    def add_snapshot(self, step, state):
+        self.snapshot_steps.append(step)
+        self.snapshots.append(state)
+
+    def snapshot_at(self, step):
+        """The latest (snapshot step, EmulatorSnapshot) at or before `step`."""
+        i = bisect.bisect_right(self.snapshot_steps, step) - 1
+        return self.snapshot_steps[i], self.snapshots[i]
+
+    def drop_snapshots_after(self, step):
+        # Snapshots past the current step may not match a changed future
+        i = bisect.bisect_right(self.snapshot_steps, step)
+        del self.snapshot_steps[i:]
+        del self.snapshots[i:]
+
+
+class _UndoMemory:
+    """Stands in for the emulator's PagedMemory while recording history; logs the bytes each write replaces."""
+    def __init__(self, memory, old_bytes):
+        self._memory = memory
+        self._old_bytes = old_bytes
+
+    def write(self, address, num_bytes, value):
+        old = self._memory.peek(address, num_bytes)
+        self._memory.write(address, num_bytes, value)
+        self._old_bytes.append((address, old))
+
+    def write_block(self, address, data):
+        old = self._memory.peek(address, len(data))
+        self._memory.write_block(address, data)
+        self._old_bytes.append((address, old))
+
+    def __getattr__(self, name):
+        return getattr(self._memory, name)
+
+
+class _RecordingMemory:
+    """Stands in for the emulator's PagedMemory while recording a trace and logs every write."""
+    def __init__(self, memory, writes):
+        self._memory = memory
+        self._writes = writes
+
+    def write(self, address, num_bytes, value):
+        self._memory.write(address, num_bytes, value)
+        self._writes.append((address, (value & ((1 << (num_bytes * 8)) - 1)).to_bytes(num_bytes, 'little')))
+
+    def write_block(self, address, data):
+        self._memory.write_block(address, data)
+        self._writes.append((address, bytes(data)))
+
+    def __getattr__(self, name):
+        return getattr(self._memory, name)
+
+
+class OutputBuffer:
+    """Collects emulator output and writes it to a stream in large chunks."""
+    def __init__(self, stream, chunk_size=1 << 16):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.stream.write(''.join(self.parts))
+            self.parts = []
+            self.size = 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run an ARM64 assembly file on the emulator.")
+    parser.add_argument('file', help="assembly file (.s)")
+    parser.add_argument('-v', '--verbosity', choices=VERBOSITY_LEVELS, default='full',
+                        help="output detail (default: full)")
+    parser.add_argument('--dump-every', type=int, default=1, metavar='N',
+                        help="with --verbosity full, dump the whole state every N instructions")
+    parser.add_argument('--max-instructions', type=int, default=INSTRUCTION_LIMIT, metavar='N',
+                        help=f"halt after N instructions (default: {INSTRUCTION_LIMIT})")
+    parser.add_argument('--profile', action='store_true',
+                        help="print a per-instruction profile after the run "
+                             "(needs --verbosity silent or final)")
+    parser.add_argument('--collapsed', metavar='FILE',
+                        help="with --profile, also write flamegraph collapsed stacks to FILE")
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help="where decoded programs are cached (default: $ARM64EMU_CACHE_DIR "
+                             "or ~/.cache/arm64emu)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="always parse the file instead of using the program cache")
+    parser.add_argument('--no-fuse', action='store_true',
+                        help="run CMP+B.cond and ALU+CMP pairs as two instructions")
+    parser.add_argument('--accelerate-loops', action='store_true',
+                        help="run simple counted loops in closed form; their instructions "
+                             "don't count against --max-instructions (needs --verbosity silent or final)")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="record a binary delta trace of the run to FILE "
+                             "(needs --verbosity silent or final; inspect with delta_trace.py)")
+    parser.add_argument('--keyframe-interval', type=int, default=DEFAULT_KEYFRAME_INTERVAL, metavar='N',
+                        help="with --trace, write a full-state keyframe every N instructions "
+                             f"(default: {DEFAULT_KEYFRAME_INTERVAL})")
+    parser.add_argument('--optimize', action='store_true',
+                        help="constant-fold the program and remove dead code before running it")
+    parser.add_argument('--verify-optimizer', action='store_true',
+                        help="run the program with and without --optimize and compare the final "
+                             "states instead of running it once")
+    parser.add_argument('--stats', action='store_true',
+                        help="print the instruction count and number of fused pairs after the run")
+    args = parser.parse_args(argv)
+    if args.accelerate_loops and args.verbosity not in ('silent', 'final'):
+        parser.error("--accelerate-loops needs --verbosity silent or final")
 
-    filepath = "test.s"
     try:
-        with open(filepath, 'r') as f:
+        with open(args.file, 'r') as f:
             program_lines = f.readlines()
     except FileNotFoundError:
-        print(f"Error: File not found at '{filepath}'")
+        print(f"Error: File not found at '{args.file}'")
         sys.exit(1)
 
-    emulator = ARM64Emulator()
-    
-    # ====================================================
-    # =====================
-    # MODIFIED: Call the new setup function first
-    # ====================================================
- 
-    emulator.print_initial_setup(program_lines)
-    
-    # Original call to run the full emulation
+    cache = None if args.no_cache else ProgramCache(args.cache_dir)
+    if args.verify_optimizer:
+        differences, counts = optimizer.verify(
+            program_lines, lambda: ARM64Emulator(program_cache=cache), args.max_instructions)
+        print(f"Instructions executed: {counts[0]} unoptimized, {counts[1]} optimized")
+        for what, plain, optimized in differences:
+            print(f"MISMATCH {what}: {plain!r} unoptimized, {optimized!r} optimized")
+        print("Final states differ" if differences else "Final states match")
+        sys.exit(1 if differences else 0)
+    emulator = ARM64Emulator(program_cache=cache)
+    emulator.optimize_program = args.optimize
+    emulator.fuse_pairs = not args.no_fuse
+    emulator.accelerate_loops = args.accelerate_loops
+    if args.verbosity == 'full':
+        emulator.print_initial_setup(program_lines)
+    if args.profile:
+        emulator.profiler = Profiler(args.file)
+    if args.trace:
+        emulator.trace_writer = TraceWriter(args.trace, args.keyframe_interval)
+    try:
+        emulator.run(program_lines, verbosity=args.verbosity, dump_every=args.dump_every,
+                     max_instructions=args.max_instructions)
+    finally:
+        if emulator.trace_writer is not None:
+            emulator.trace_writer.close()
+    if args.profile:
+        sys.stdout.write(emulator.profiler.report())
+        if args.collapsed:
+            emulator.profiler.write_collapsed(args.collapsed)
+    if args.stats:
+        print(f"Instructions executed: {emulator.instruction_count}")
+        print(f"Fused instruction pairs: {emulator.fusions}")
+        print(f"Instructions in accelerated loops: {emulator.loop_instructions}")
+        if emulator.optimizer_stats is not None:
+            stats = emulator.optimizer_stats
+            print(f"Optimizer: {stats['removed']} removed, {stats['folded']} folded, "
+                  f"{stats['branches']} branches resolved")
+
 
-    emulator.run(program_lines)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Counted-loop acceleration for ARM64Emulator (emulator.py).
+
+A counted loop is a backward conditional branch whose loop test is a CMP
+of a counter register against a bound, with a body that only touches
+registers:
+
+    loop:
+        ADD  W1, W1, W0        ; body: ALU ops, MOVs and NOPs only
+        SUB  W0, W0, #1        ; the counter's single update, by a fixed step
+    check:
+        CMP  W0, #0            ; counter against an immediate or an unchanged register
+        B.GT loop              ; B.GT counting down, or B.LE counting up
+
+find_counted_loops() looks for this shape in the block translator's IR
+(one entry per instruction slot, see block_translator.py). When a run
+reaches the CMP, CountedLoop.run() works out how many more times the
+branch is taken from the counter, step and bound, without running the
+loop. If every body instruction is an ADD/SUB into its own register (of
+an immediate, an unchanged register or the counter) or a MOV of an
+immediate or unchanged register, the final registers are computed in
+closed form. Other register-only bodies run as a tight loop over their
+handlers, with no PC, bounds or limit checks between instructions, as
+long as the iterations fit in the instruction budget the caller passes.
+
+Either way the registers, flags and instruction count afterwards are
+exactly those of running the loop one instruction at a time. Trip counts
+that would wrap the counter, or never end, are left to the interpreter.
+"""
+
+MASK32 = 0xFFFFFFFF
+MASK64 = 0xFFFFFFFFFFFFFFFF
+SIGN64 = 1 << 63
+
+
+class CountedLoop:
+    """One counted loop: the CMP at slot `head`, its branch and its body."""
+    def __init__(self, head, start, on_gt, counter, bound, step, step_sign, body, closed_form, records):
+        self.head = head              # slot of the CMP; the branch is head + 1
+        self.start = start            # first body slot (the branch target)
+        self.on_gt = on_gt            # B.GT (True) or B.LE
+        self.counter = counter        # (index, mask)
+        self.bound = bound            # IR source
+        self.step = step              # IR source added (step_sign 1) or subtracted (-1)
+        self.step_sign = step_sign
+        self.body = body              # [(position relative to the counter update, IR entry)]
+        self.closed_form = closed_form
+        self.records = tuple(records)  # (handler, args) of each body instruction, in order
+        self.body_len = len(records)
+
+    def trip_count(self, value, bound, step):
+        """
+        Number of times the branch is taken from a CMP that sees the counter
+        at `value`, or None if the counter would wrap before the loop ends.
+        """
+        mask = self.counter[1]
+        if mask == MASK64 and value >= SIGN64:
+            value -= 1 << 64   # X counters compare as signed
+        lo, hi = (0, MASK32) if mask == MASK32 else (-SIGN64, SIGN64 - 1)
+        if self.on_gt:
+            if value <= bound:
+                n = 0
+            elif step < 0:
+                n = (value - bound - step - 1) // -step
+            else:
+                return None
+        else:
+            if value > bound:
+                n = 0
+            elif step > 0:
+                n = (bound - value) // step + 1
+            else:
+                return None
+        # The CMP results only order like plain integers while the counter
+        # stays in range; it moves monotonically, so checking the ends is enough
+        for v in (value, value + n * step):
+            if not (lo <= v <= hi and -SIGN64 < v - bound < SIGN64):
+                return None
+        return n
+
+    def run(self, emulator, budget=None):
+        """
+        Runs the loop from its CMP to the fall-through after its branch.
+        Returns the number of instructions in the iterations (the final CMP
+        and branch not included), or None (and changes nothing) when the
+        trip count can't be worked out in advance, or when a body without a
+        closed form would run more than `budget` instructions.
+        """
+        regs = emulator.regs
+        index, mask = self.counter
+        value = regs[index] & mask
+        bound = _read(regs, self.bound)
+        step = self.step_sign * _read(regs, self.step)
+        n = self.trip_count(value, bound, step)
+        if n is None:
+            return None
+        if not self.closed_form and budget is not None and n * (self.body_len + 2) > budget:
+            # Iterations that really run take time; leave them to the interpreter's limits
+            return None
+        if n:
+            if self.closed_form:
+                self._apply(regs, value, step, n)
+            else:
+                records = self.records
+                for _ in range(n):
+                    for handler, args in records:
+                        handler(*args)
+        emulator._flag_result = (regs[index] & mask) - bound
+        return n * (self.body_len + 2)
+
+    def _apply(self, regs, value, step, n):
+        """Closed form of n >= 1 iterations of an ADD/SUB/MOV body."""
+        index, mask = self.counter
+        sums = {}
+        moves = {}
+        for after_update, entry in self.body:
+            if entry[0] == 'mov':
+                _, (d, dmask), src = entry
+                moves[d] = _read(regs, src) & dmask
+                continue
+            _, sym, (d, dmask), _, src, _ = entry
+            if src[0] == 'reg' and src[1] == index:
+                # Reads counter values value + j*step for j in [first, first + n)
+                first = 1 if after_update else 0
+                total = n * value + step * (first * n + n * (n - 1) // 2)
+            else:
+                total = n * _read(regs, src)
+            total = total if sym == '+' else -total
+            sums[d] = (sums.get(d, 0) + total, dmask)
+        for d, (total, dmask) in sums.items():
+            regs[d] = ((regs[d] & dmask) + total) & dmask
+        for d, new_value in moves.items():
+            regs[d] = new_value
+        regs[index] = (value + n * step) & mask
+
+
+def _read(regs, src):
+    if src[0] == 'imm':
+        return src[1]
+    _, index, mask = src
+    return regs[index] & mask
+
+
+def _dst(entry):
+    # Destination of an 'alu' or 'mov' entry
+    return entry[1] if entry[0] == 'mov' else entry[2]
+
+
+def find_counted_loops(ir, records):
+    """
+    CountedLoops in a lowered program. `ir` holds the IR entry of each slot
+    and `records` the matching (handler, args, ...) decoded records.
+    """
+    loops = []
+    for branch, entry in enumerate(ir):
+        if entry is None or entry[0] != 'b' or entry[1] is None or entry[2] is None:
+            continue
+        head, target = branch - 1, entry[2]
+        if target % 4 or not 0 <= target // 4 < head:
+            continue
+        cmp = ir[head]
+        if cmp is None or cmp[0] != 'cmp' or cmp[1][0] != 'reg':
+            continue
+        loop = _analyse(ir, records, target // 4, head, entry[1] == 'GT', cmp)
+        if loop is not None:
+            loops.append(loop)
+    return loops
+
+
+def _analyse(ir, records, start, head, on_gt, cmp):
+    _, (_, counter, cmask), bound = cmp
+    body = [(ir[i], records[i]) for i in range(start, head) if ir[i] is not None]
+    if any(entry[0] not in ('alu', 'mov', 'nop') for entry, _ in body):
+        return None
+    written_regs = {_dst(entry)[0] for entry, _ in body
+                    if entry[0] != 'nop' and _dst(entry) is not None}
+
+    def invariant(src):
+        return src[0] == 'imm' or src[1] not in written_regs
+
+    # Exactly one body instruction writes the counter: counter +/- step
+    updates = [i for i, (entry, _) in enumerate(body)
+               if entry[0] != 'nop' and _dst(entry) is not None and _dst(entry)[0] == counter]
+    if len(updates) != 1 or not invariant(bound):
+        return None
+    update = body[updates[0]][0]
+    if (update[0] != 'alu' or update[1] not in '+-' or update[2] != (counter, cmask)
+            or update[3] != ('reg', counter, cmask) or not invariant(update[4])):
+        return None
+
+    entries = []
+    closed_form = True
+    for i, (entry, _) in enumerate(body):
+        if i == updates[0] or entry[0] == 'nop':
+            continue
+        entries.append((i > updates[0], entry))
+        closed_form = closed_form and _closed_form_ok(entry, body, counter, cmask, invariant)
+    return CountedLoop(head, start, on_gt, (counter, cmask), bound, update[4],
+                       1 if update[1] == '+' else -1, entries, closed_form,
+                       [record[:2] for _, record in body])
+
+
+def _closed_form_ok(entry, body, counter, cmask, invariant):
+    """Whether `entry` has a closed form over n iterations (see CountedLoop._apply)."""
+    dst = _dst(entry)
+    if dst is None:
+        return False   # writes to XZR still land in the sink slot
+    d, dmask = dst
+    # Nothing else may read the destination
+    for other, _ in body:
+        if other is entry or other[0] == 'nop':
+            continue
+        sources = other[2:3] if other[0] == 'mov' else other[3:5]
+        if any(src[0] == 'reg' and src[1] == d for src in sources):
+            return False
+    if entry[0] == 'mov':
+        writers = [o for o, _ in body if o[0] != 'nop' and _dst(o) is not None and _dst(o)[0] == d]
+        return len(writers) == 1 and invariant(entry[2])
+    _, sym, _, src1, src2, _ = entry
+    if sym not in '+-' or src1 != ('reg', d, dmask):
+        return False
+    if invariant(src2):
+        return True
+    if src2[0] == 'reg' and src2[1] == counter:
+        # A 32-bit read of a 64-bit counter only sums correctly into a 32-bit register
+        return not (cmask == MASK64 and src2[2] == MASK32 and dmask == MASK64)
+    return False
@@ -0,0 +1,267 @@
+"""
+Multi-core emulation for the ARM64 emulator (emulator.py).
+
+A MultiCoreEmulator has several cores, each a full ARM64Emulator with its
+own register file, PC, flags and instruction count, all using one
+PagedMemory. The stack region holds a `stack_size` stack per core (core
+i's SP starts at the top of the i-th one), and the data and heap regions
+are shared. Every core starts at the beginning of its program with X0
+set to its core number, so one kernel can be loaded on every core and
+split the work by X0, or each core can get a program of its own.
+
+run() is the deterministic scheduler: the cores take turns in core
+order, each running `quantum` instructions per turn (fewer if it stops),
+so a program and quantum always interleave the cores' memory accesses
+the same way. run_parallel() runs each core in its own process over
+SharedPages (see shared_program.py), so the cores use that many host
+cores; the interleaving is then whatever the host scheduler makes of it.
+The cores start together behind a barrier, and parallel runs are bounded
+by wall-clock time (PARALLEL_TIME_BUDGET) rather than the small default
+instruction limit, since how long a polling core spins is up to the host.
+The instruction subset has no atomic read-modify-write instructions, so
+kernels synchronise through flags that one core stores and another polls.
+
+    machine = MultiCoreEmulator(cores=4, data_size=4096, quantum=50)
+    machine.load(program)
+    machine.run(max_instructions=100000)      # or machine.run_parallel(...)
+    machine.print_summary()
+
+Usage:
+    python multicore.py kernel.s --cores 4 [--quantum N | --parallel]
+    python multicore.py core0.s core1.s       # one program per core
+"""
+
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from emulator import ARM64Emulator, DATA_BASE_ADDR, HEAP_BASE_ADDR, INSTRUCTION_LIMIT, REG_SP
+from paged_memory import PagedMemory
+from shared_program import SharedPages, SharedProgram
+
+# Instructions each core runs per round-robin turn
+DEFAULT_QUANTUM = 100
+
+# Seconds run_parallel() workers wait for each other before giving up
+START_TIMEOUT = 60
+
+# run_parallel() budgets. How many instructions a polling core runs before
+# the others catch up depends on the host's scheduler (all of them, with
+# fewer host cores than cores), so its budget is wall-clock time
+PARALLEL_INSTRUCTION_LIMIT = 1_000_000_000
+PARALLEL_TIME_BUDGET = 10.0
+
+# The start barrier of a run_parallel() worker process
+_barrier = None
+
+
+def _init_core(barrier):
+    global _barrier
+    _barrier = barrier
+
+
+def _run_core(program_handle, pages_handle, regions, regs, flag_result, max_instructions, time_budget):
+    """One core of run_parallel(), in a worker process; returns its final state."""
+    emulator = ARM64Emulator()
+    memory = PagedMemory()
+    for name, start, size in regions:
+        memory.map_region(name, start, size)
+    pages = SharedPages.attach(pages_handle)
+    pages.map_into(memory)
+    emulator.memory = memory
+    program = SharedProgram.attach(program_handle)
+    decoded = program.decode_into(emulator)
+    emulator.regs[:] = regs
+    emulator._flag_result = flag_result
+    error = None
+    try:
+        # Start together: a core that polls for others would otherwise use up
+        # its budget while their processes are still being spawned
+        _barrier.wait(START_TIMEOUT)
+        status = emulator.run_decoded_budgeted(decoded, max_instructions, time_budget)
+    except Exception as e:
+        status = 'error'
+        error = f"{type(e).__name__}: {e}"
+    # Drop the views of the segment before detaching from it
+    memory.pages.clear()
+    pages.close()
+    program.close()
+    return (status, error, emulator.regs, emulator.pc, emulator.running, emulator._flag_result,
+            emulator.instruction_count, emulator.loop_instructions)
+
+
+class MultiCoreEmulator:
+    """`cores` ARM64Emulator cores sharing one memory."""
+    def __init__(self, cores=2, stack_size=256, data_size=0, heap_size=0, quantum=DEFAULT_QUANTUM):
+        if cores < 1:
+            raise ValueError("A machine needs at least one core")
+        if quantum < 1:
+            raise ValueError("The quantum must be at least one instruction")
+        self.quantum = quantum
+        self.stack_size = stack_size
+        self.cores = [ARM64Emulator(stack_size=stack_size) for _ in range(cores)]
+        stack_base = self.cores[0].stack_base_addr
+        self.memory = PagedMemory()
+        self.memory.map_region('stack', stack_base, stack_size * cores)
+        if data_size:
+            self.memory.map_region('data', DATA_BASE_ADDR, data_size)
+        if heap_size:
+            self.memory.map_region('heap', HEAP_BASE_ADDR, heap_size)
+        for i, core in enumerate(self.cores):
+            core.memory = self.memory
+            core.stack_base_addr = stack_base + i * stack_size
+            core.regs[REG_SP] = core.stack_base_addr + stack_size
+            core.regs[0] = i
+        self.programs = [None] * cores
+        self.decoded = [None] * cores
+        self.statuses = [None] * cores   # why each core stopped, as run_budgeted() reports it, or 'error'
+        self.errors = [None] * cores
+
+    def load(self, program, core=None):
+        """Loads `program` (a list of lines) on one core, or on every core."""
+        for i in range(len(self.cores)) if core is None else [core]:
+            self.cores[i].labels = {}
+            self.programs[i] = list(program)
+            self.decoded[i] = self.cores[i].decode(self.programs[i])
+
+    def _start(self):
+        started = [i for i, decoded in enumerate(self.decoded) if decoded is not None]
+        for i in started:
+            self.statuses[i] = self.errors[i] = None
+        return started
+
+    # --- Round-robin scheduler ---
+    def run(self, max_instructions=INSTRUCTION_LIMIT, time_budget=None):
+        """
+        Runs the loaded cores in turns of `quantum` instructions until every
+        one has stopped. Each core gives up after `max_instructions` of its
+        own, and all of them once `time_budget` seconds have passed (checked
+        between rounds). Returns self.statuses.
+        """
+        active = self._start()
+        threaded = {}
+        for i in active:
+            core = self.cores[i]
+            core.pc = 0
+            core.running = True
+            threaded[i] = core.thread(self.decoded[i])
+        deadline = None if time_budget is None else time.perf_counter() + time_budget
+        while active:
+            for i in list(active):
+                core = self.cores[i]
+                limit = min(core.instruction_count - core.loop_instructions + self.quantum, max_instructions)
+                try:
+                    stopped = core.run_until(self.decoded[i], limit, threaded[i])
+                except Exception as e:
+                    stopped = 'error'
+                    self.errors[i] = f"{type(e).__name__}: {e}"
+                if stopped is None and limit >= max_instructions:
+                    stopped = 'instruction_limit'
+                if stopped:
+                    self.statuses[i] = stopped
+                    active.remove(i)
+            if active and deadline is not None and time.perf_counter() > deadline:
+                for i in active:
+                    self.statuses[i] = 'timeout'
+                break
+        return self.statuses
+
+    # --- Parallel mode ---
+    def run_parallel(self, max_instructions=PARALLEL_INSTRUCTION_LIMIT, time_budget=PARALLEL_TIME_BUDGET):
+        """
+        Runs every loaded core at once, each in its own process, over a
+        shared-memory copy of the memory that is copied back afterwards.
+        The cores start together once every process is ready. Limits are
+        per core, as in run(), and the time budget starts then too.
+        Returns self.statuses.
+        """
+        started = self._start()
+        regions = [(region.name, region.start, region.size) for region in self.memory.regions]
+        programs = {}
+        pages = SharedPages.create(self.memory)
+        try:
+            handles = {}
+            for i in started:
+                text = ''.join(self.programs[i])
+                if text not in programs:
+                    programs[text] = SharedProgram.create(ARM64Emulator(), self.programs[i])
+                handles[i] = programs[text].handle
+            context = multiprocessing.get_context('spawn')
+            # Every core needs a process of its own: cores may wait on each other
+            barrier = context.Barrier(len(started))
+            with ProcessPoolExecutor(max_workers=max(1, len(started)), mp_context=context,
+                                     initializer=_init_core, initargs=(barrier,)) as pool:
+                futures = {i: pool.submit(_run_core, handles[i], pages.handle, regions, self.cores[i].regs,
+                                          self.cores[i]._flag_result, max_instructions, time_budget)
+                           for i in started}
+                for i, future in futures.items():
+                    core = self.cores[i]
+                    (self.statuses[i], self.errors[i], regs, core.pc, core.running, core._flag_result,
+                     core.instruction_count, core.loop_instructions) = future.result()
+                    core.regs[:] = regs
+            pages.copy_into(self.memory)
+        finally:
+            pages.unlink()
+            for program in programs.values():
+                program.unlink()
+        return self.statuses
+
+    # --- Reports ---
+    def print_summary(self):
+        for i, core in enumerate(self.cores):
+            if self.decoded[i] is None:
+                continue
+            line = f"Core {i}: {self.statuses[i]} after {core.instruction_count} instructions, PC {core.pc:#x}"
+            if self.errors[i]:
+                line += f" ({self.errors[i]})"
+            print(line)
+            registers = [f"X{r}={core.regs[r]:#x}" for r in range(31) if core.regs[r]]
+            print("  " + (" ".join(registers) or "all X registers 0") + f" SP={core.regs[REG_SP]:#x}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run ARM64 assembly on several cores sharing one memory.")
+    parser.add_argument('programs', nargs='+', metavar='FILE',
+                        help="one program for every core, or one per core")
+    parser.add_argument('--cores', type=int, default=None, metavar='N',
+                        help="number of cores (default: 2, or one per program)")
+    parser.add_argument('--quantum', type=int, default=DEFAULT_QUANTUM, metavar='N',
+                        help=f"instructions per round-robin turn (default: {DEFAULT_QUANTUM})")
+    parser.add_argument('--parallel', action='store_true',
+                        help="run each core in its own process instead of round-robin")
+    parser.add_argument('--max-instructions', type=int, default=None, metavar='N',
+                        help=f"per-core instruction budget (default: {INSTRUCTION_LIMIT}, "
+                             f"or {PARALLEL_INSTRUCTION_LIMIT} with --parallel)")
+    parser.add_argument('--time-budget', type=float, default=None, metavar='SECONDS',
+                        help=f"wall-clock limit for the whole run (default: none, "
+                             f"or {PARALLEL_TIME_BUDGET:g} with --parallel)")
+    parser.add_argument('--stack-size', type=int, default=256, metavar='BYTES', help="stack per core")
+    parser.add_argument('--data-size', type=int, default=0, metavar='BYTES',
+                        help=f"shared data region at {DATA_BASE_ADDR:#x}")
+    parser.add_argument('--heap-size', type=int, default=0, metavar='BYTES',
+                        help=f"shared heap region at {HEAP_BASE_ADDR:#x}")
+    args = parser.parse_args(argv)
+
+    cores = args.cores or (len(args.programs) if len(args.programs) > 1 else 2)
+    if len(args.programs) > 1 and len(args.programs) != cores:
+        parser.error(f"{len(args.programs)} programs for {cores} cores")
+    machine = MultiCoreEmulator(cores, args.stack_size, args.data_size, args.heap_size, args.quantum)
+    for i, path in enumerate(args.programs):
+        with open(path, 'r') as f:
+            machine.load(f.readlines(), core=i if len(args.programs) > 1 else None)
+    start = time.perf_counter()
+    if args.parallel:
+        machine.run_parallel(PARALLEL_INSTRUCTION_LIMIT if args.max_instructions is None else args.max_instructions,
+                             PARALLEL_TIME_BUDGET if args.time_budget is None else args.time_budget)
+    else:
+        machine.run(INSTRUCTION_LIMIT if args.max_instructions is None else args.max_instructions,
+                    args.time_budget)
+    elapsed = time.perf_counter() - start
+    machine.print_summary()
+    total = sum(core.instruction_count for core in machine.cores)
+    print(f"{total} instructions on {cores} cores in {elapsed:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
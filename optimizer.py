@@ -0,0 +1,357 @@
+"""
+Static optimizer for ARM64Emulator programs (emulator.py).
+
+optimize() rewrites a decoded program (see ARM64Emulator.decode) with the
+help of a control-flow graph over its instruction slots, lowered to the
+block translator's IR (see block_translator.py):
+
+  * Constant propagation. Registers set by MOV #imm, and everything
+    computed from them, are tracked along every path from slot 0. MOVs
+    and ALU ops whose sources are known become MOV #imm or take an
+    immediate operand, and conditional branches whose flags are known
+    become a plain B or go away.
+  * Dead-code elimination. MOV, ALU and CMP instructions whose results are
+    overwritten before anything reads them, MOVs of the value a register
+    already holds, branches to the next instruction, NOPs and slots that
+    can't be reached are removed.
+
+Removed instructions become empty slots, like comment-only lines, so the
+remaining instructions keep their addresses and no branch target moves.
+Whenever the program returns, leaves the program or faults, the registers,
+flags, memory and PC are exactly those of the original program; only the
+instruction count changes, and with it where max_instructions stops a
+run. Registers and memory are unknown at slot 0, so the program can still
+be run with any initial state.
+
+verify() runs a program with and without the optimizer and lists the
+differences in the final state:
+
+    differences, counts = verify(program, ARM64Emulator)
+"""
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+SIGN64 = 1 << 63
+
+# Tracked state: X0-X30 and SP by register index (the zero register lowers
+# to #0 and writes to it to no destination), then the flag result
+FLAGS = 32
+ALL_LIVE = (1 << (FLAGS + 1)) - 1
+
+_ALU_FUNCS = {
+    '+': lambda a, b: a + b, '-': lambda a, b: a - b, '^': lambda a, b: a ^ b,
+    '&': lambda a, b: a & b, '*': lambda a, b: a * b,
+}
+
+
+def optimize(emulator, decoded):
+    """
+    Returns (records, stats): an optimized copy of `decoded`, whose handlers
+    are bound to `emulator`, and the number of instructions 'removed',
+    'folded' to constants or immediates and 'branches' resolved.
+    """
+    records = list(decoded)
+    stats = {'removed': 0, 'folded': 0, 'branches': 0}
+    # Folding relies on values that a dead write may have set up, so the two
+    # kinds of rewrite never share one analysis
+    while _fold_pass(emulator, records, stats) or _eliminate_pass(emulator, records, stats):
+        pass
+    return records, stats
+
+
+def _fold_pass(emulator, records, stats):
+    """Rewrites `records` from one constant propagation; returns whether anything changed."""
+    n = len(records)
+    ir = [emulator._lower_record(record) for record in records]
+    states = _propagate(ir, n)
+    live_out = _liveness(ir, n)
+    changed = False
+    for i, entry in enumerate(ir):
+        if entry is None:
+            continue
+        if states[i] is None:
+            new, kind = None, 'removed'   # unreachable
+        else:
+            new, kind = _fold(emulator, records, i, entry, states[i], live_out[i])
+        if kind is not None:
+            records[i] = new
+            stats[kind] += 1
+            changed = True
+    return changed
+
+
+def _eliminate_pass(emulator, records, stats):
+    """Removes dead instructions found by one liveness analysis; returns whether any were."""
+    n = len(records)
+    ir = [emulator._lower_record(record) for record in records]
+    live_out = _liveness(ir, n)
+    changed = False
+    for i, entry in enumerate(ir):
+        if entry is not None and _is_dead(records, i, entry, live_out[i]):
+            records[i] = None
+            stats['removed'] += 1
+            changed = True
+    return changed
+
+
+# --- Control-Flow Graph ---
+def _target_slot(entry, n):
+    # Slot a branch goes to; n (the exit) if it leaves the program
+    target = entry[2]
+    return target // 4 if target % 4 == 0 and 0 <= target < n * 4 else n
+
+
+def _successors(entry, i, n, flags=None):
+    """
+    Slots that can run after slot i; n stands for leaving the program.
+    Conditional branches only go the way they take when `flags` is known.
+    """
+    if entry is None:
+        return (i + 1,)
+    if entry[0] == 'ret':
+        return ()
+    if entry[0] == 'b':
+        _, cond, target, _ = entry
+        taken = cond is None or flags is None or _taken(cond, flags)
+        not_taken = cond is not None and (flags is None or not _taken(cond, flags))
+        # An undefined label raises when the branch is taken
+        return ((_target_slot(entry, n),) if taken and target is not None else ()) + \
+               ((i + 1,) if not_taken else ())
+    return (i + 1,)
+
+
+def _may_fault(entry):
+    return entry is not None and (entry[0] in ('load', 'store', 'call')
+                                  or (entry[0] == 'b' and entry[2] is None))
+
+
+def _taken(cond, flags):
+    return (0 < flags & MASK64 < SIGN64) == (cond == 'GT')
+
+
+# --- Constant Propagation ---
+def _value(src, state):
+    if src[0] == 'imm':
+        return src[1]
+    value = state[src[1]]
+    return None if value is None else value & src[2]
+
+
+def _transfer(entry, state):
+    """State after `entry`: a list of known values (None where unknown)."""
+    kind = entry[0] if entry is not None else None
+    if kind == 'alu':
+        _, sym, dst, src1, src2, _ = entry
+        a, b = _value(src1, state), _value(src2, state)
+        result = None if a is None or b is None else _ALU_FUNCS[sym](a, b)
+        state = list(state)
+        state[FLAGS] = result
+        if dst is not None:
+            state[dst[0]] = None if result is None else result & dst[1]
+    elif kind == 'mov':
+        _, dst, src = entry
+        if dst is not None:
+            value = _value(src, state)
+            state = list(state)
+            state[dst[0]] = None if value is None else value & dst[1]
+    elif kind == 'cmp':
+        a, b = _value(entry[1], state), _value(entry[2], state)
+        state = list(state)
+        state[FLAGS] = None if a is None or b is None else a - b
+    elif kind == 'load' and entry[1] is not None:
+        state = list(state)
+        state[entry[1][0]] = None
+    return state
+
+
+def _propagate(ir, n):
+    """
+    Known values at the start of each slot, or None for slots that can't be
+    reached from slot 0. Branches whose flags are known only follow the
+    side they take.
+    """
+    states = [None] * n
+    if not n:
+        return states
+    states[0] = [None] * (FLAGS + 1)
+    work = [0]
+    while work:
+        i = work.pop()
+        entry = ir[i]
+        out = _transfer(entry, states[i])
+        for s in _successors(entry, i, n, out[FLAGS]):
+            if s == n:
+                continue
+            old = states[s]
+            if old is None:
+                states[s] = list(out)
+                work.append(s)
+                continue
+            changed = False
+            for k, value in enumerate(out):
+                if old[k] is not None and old[k] != value:
+                    old[k] = None
+                    changed = True
+            if changed:
+                work.append(s)
+    return states
+
+
+# --- Liveness ---
+def _bit(src):
+    return 1 << src[1] if src[0] == 'reg' else 0
+
+
+def _uses_defs(entry):
+    """(registers read, registers written) by `entry` as bit sets."""
+    kind = entry[0] if entry is not None else None
+    if kind == 'alu':
+        _, _, dst, src1, src2, _ = entry
+        return _bit(src1) | _bit(src2), (1 << FLAGS) | (1 << dst[0] if dst is not None else 0)
+    if kind == 'mov':
+        _, dst, src = entry
+        return _bit(src), 1 << dst[0] if dst is not None else 0
+    if kind == 'cmp':
+        return _bit(entry[1]) | _bit(entry[2]), 1 << FLAGS
+    if kind == 'b' and entry[1] is not None:
+        return 1 << FLAGS, 0
+    return 0, 0
+
+
+def _liveness(ir, n):
+    """
+    Registers (and FLAGS) live after each slot, as bit sets. Everything is
+    live when the program returns or leaves, and before any instruction
+    that can fault, since the state is visible at all of those points.
+    """
+    successors = [_successors(entry, i, n) for i, entry in enumerate(ir)]
+    uses_defs = [_uses_defs(entry) for entry in ir]
+    live_in = [0] * n + [ALL_LIVE]
+    live_out = [0] * n
+    changed = True
+    while changed:
+        changed = False
+        for i in range(n - 1, -1, -1):
+            entry = ir[i]
+            if entry is not None and entry[0] == 'ret':
+                out = ALL_LIVE
+            else:
+                out = 0
+                for s in successors[i]:
+                    out |= live_in[s]
+            live_out[i] = out
+            if _may_fault(entry):
+                new = ALL_LIVE
+            else:
+                uses, defs = uses_defs[i]
+                new = uses | (out & ~defs)
+            if new != live_in[i]:
+                live_in[i] = new
+                changed = True
+    return live_out
+
+
+# --- Rewriting ---
+def _reg_name(index, mask):
+    prefix = 'X' if mask == MASK64 else 'W'
+    if index == 31:
+        return 'SP' if prefix == 'X' else 'WSP'
+    if index > 31:
+        return prefix + 'ZR'
+    return f'{prefix}{index}'
+
+
+def _mov_imm(emulator, d, dmask, value):
+    return (emulator._exec_mov_imm, (d, dmask, value), f"MOV {_reg_name(d, dmask)}, #{value}")
+
+
+def _fold(emulator, records, i, entry, state, live):
+    """(new record, stats key) for slot i given the values known before it, or (None, None) to keep it."""
+    kind = entry[0]
+    _, args, text = records[i]
+    if kind == 'mov' and entry[1] is not None:
+        _, (d, dmask), src = entry
+        value = _value(src, state)
+        if value is None:
+            return None, None
+        if state[d] == value & dmask:
+            return None, 'removed'
+        if src[0] == 'reg':
+            return _mov_imm(emulator, d, dmask, value & dmask), 'folded'
+    elif kind == 'alu' and entry[2] is not None:
+        _, sym, (d, dmask), src1, src2, _ = entry
+        a, b = _value(src1, state), _value(src2, state)
+        if a is not None and b is not None and not live >> FLAGS & 1:
+            value = _ALU_FUNCS[sym](a, b) & dmask
+            if state[d] == value:
+                return None, 'removed'
+            return _mov_imm(emulator, d, dmask, value), 'folded'
+        if src2[0] == 'reg' and b is not None:
+            # Still sets the flags, with the second operand as an immediate
+            op_func, d, dmask, n, nmask = args[:5]
+            mnemonic = text.split(maxsplit=1)[0].upper()
+            return (emulator._exec_alu_imm, (op_func, d, dmask, n, nmask, b),
+                    f"{mnemonic} {_reg_name(d, dmask)}, {_reg_name(n, nmask)}, #{b}"), 'folded'
+    elif kind == 'b' and entry[1] is not None and entry[2] is not None and state[FLAGS] is not None:
+        _, cond, target, label = entry
+        if not _taken(cond, state[FLAGS]):
+            return None, 'branches'
+        return (emulator._exec_b, (target, label), f"B {label}"), 'branches'
+    return None, None
+
+
+def _is_dead(records, i, entry, live):
+    """Whether slot i can go: a NOP, a branch to the next instruction or a write nothing reads."""
+    kind = entry[0]
+    if kind == 'nop':
+        return True
+    if kind == 'mov':
+        return entry[1] is None or not live >> entry[1][0] & 1
+    if kind == 'alu':
+        dst = entry[2]
+        return not live >> FLAGS & 1 and (dst is None or not live >> dst[0] & 1)
+    if kind == 'cmp':
+        return not live >> FLAGS & 1
+    if kind == 'b' and entry[1] is None and entry[2] is not None:
+        slot = _target_slot(entry, len(records))
+        return slot > i and all(record is None for record in records[i + 1:slot])
+    return False
+
+
+# --- Verification ---
+def verify(program, make_emulator, max_instructions=1000):
+    """
+    Runs `program` silently on two emulators from make_emulator(), the
+    second with optimize_program set. Returns (differences, counts): a list
+    of (what, unoptimized, optimized) for every register, flag, memory
+    page, PC, running flag or error that ended up different, and the two
+    instruction counts.
+    """
+    runs = []
+    for optimized in (False, True):
+        emulator = make_emulator()
+        emulator.optimize_program = optimized
+        error = None
+        try:
+            emulator.run(program, verbosity='silent', max_instructions=max_instructions)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        runs.append((emulator, error))
+    (plain, plain_error), (optimized, optimized_error) = runs
+
+    differences = []
+    for index in range(32):
+        name = _reg_name(index, MASK64)
+        if plain.regs[index] != optimized.regs[index]:
+            differences.append((name, plain.regs[index], optimized.regs[index]))
+    for what in ('n_flag', 'z_flag', 'pc', 'running'):
+        a, b = getattr(plain, what), getattr(optimized, what)
+        if a != b:
+            differences.append((what, a, b))
+    if plain_error != optimized_error:
+        differences.append(('error', plain_error, optimized_error))
+    pages_a, pages_b = plain.memory.pages, optimized.memory.pages
+    for page in sorted(pages_a.keys() | pages_b.keys()):
+        a, b = pages_a.get(page), pages_b.get(page)
+        if bytes(a or bytes(len(b))) != bytes(b or bytes(len(a))):
+            differences.append((f'page {page:#x}', a, b))
+    return differences, (plain.instruction_count, optimized.instruction_count)
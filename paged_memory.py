@@ -0,0 +1,192 @@
+"""
+Sparse paged memory for the ARM64 emulators.
+
+Memory is a page table (dict) keyed by page number, holding 4 KiB
+bytearrays that are only allocated the first time a page is written.
+Reads of pages that were never written return zeros, so a program can map
+megabytes or gigabytes of address space and only pay for the pages it
+touches. Accesses must fall inside one of the mapped regions (stack, data,
+heap, ...); anything else raises MemoryError.
+
+Loads and stores of 1, 2, 4 and 8 bytes go through precompiled struct
+objects, and read_block/write_block copy whole ranges page by page.
+
+snapshot() shares pages copy-on-write: it freezes every page into an
+immutable bytes object that both the memory and the snapshot hold, and
+the first write to a frozen page copies it back into a bytearray. A
+snapshot only copies the pages written since the previous one, and
+restore() just installs the snapshot's page table again. Pages can also
+be read-only memoryviews into a shared-memory image (see
+shared_program.py), copied the same way on their first write, or
+writable ones that several processes update in place.
+"""
+
+import struct
+
+PAGE_SHIFT = 12
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_MASK = PAGE_SIZE - 1
+
+# Access size -> precompiled little-endian unpack_from / pack_into
+_UNPACK_FROM = {n: struct.Struct(fmt).unpack_from for n, fmt in ((1, '<B'), (2, '<H'), (4, '<I'), (8, '<Q'))}
+_PACK_INTO = {n: struct.Struct(fmt).pack_into for n, fmt in ((1, '<B'), (2, '<H'), (4, '<I'), (8, '<Q'))}
+_VALUE_MASK = {n: (1 << (n * 8)) - 1 for n in (1, 2, 4, 8)}
+
+
+class MemoryRegion:
+    """A named, contiguous range of mapped addresses [start, end)."""
+    __slots__ = ('name', 'start', 'end')
+
+    def __init__(self, name, start, size):
+        self.name = name
+        self.start = start
+        self.end = start + size
+
+    @property
+    def size(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return f"MemoryRegion({self.name!r}, {self.start:#x}, {self.size:#x})"
+
+
+class PagedMemory:
+    """Little-endian memory made of lazily allocated 4 KiB pages."""
+    def __init__(self):
+        # page number -> bytearray(PAGE_SIZE), bytes or a read-only memoryview
+        # while shared with a snapshot or a shared-memory image, or a writable
+        # memoryview of memory shared between processes
+        self.pages = {}
+        self.regions = []
+        self._last_region = None
+
+    # --- Regions ---
+    def map_region(self, name, start, size):
+        """Maps [start, start + size) under `name`. Costs nothing until written."""
+        if size <= 0:
+            raise ValueError(f"Region '{name}' must have a positive size")
+        region = MemoryRegion(name, start, size)
+        for other in self.regions:
+            if region.start < other.end and other.start < region.end:
+                raise ValueError(f"Region '{name}' overlaps region '{other.name}'")
+        self.regions.append(region)
+        return region
+
+    def region(self, name):
+        for region in self.regions:
+            if region.name == name:
+                return region
+        raise KeyError(name)
+
+    def _check(self, address, num_bytes):
+        region = self._last_region
+        if region is not None and region.start <= address and address + num_bytes <= region.end:
+            return
+        for region in self.regions:
+            if region.start <= address < region.end:
+                if address + num_bytes > region.end:
+                    raise MemoryError(f"Memory access out of bounds at address {address:#x}")
+                self._last_region = region
+                return
+        raise MemoryError(f"Memory access violation at address {address:#x}")
+
+    # --- Loads and Stores ---
+    def read(self, address, num_bytes):
+        """Reads a little-endian unsigned value of `num_bytes` bytes."""
+        region = self._last_region
+        if region is None or address < region.start or address + num_bytes > region.end:
+            self._check(address, num_bytes)
+        offset = address & PAGE_MASK
+        if offset + num_bytes <= PAGE_SIZE:
+            page = self.pages.get(address >> PAGE_SHIFT)
+            if page is None:
+                return 0
+            unpack_from = _UNPACK_FROM.get(num_bytes)
+            if unpack_from is not None:
+                return unpack_from(page, offset)[0]
+            return int.from_bytes(page[offset:offset + num_bytes], 'little')
+        return int.from_bytes(self.peek(address, num_bytes), 'little')
+
+    def write(self, address, num_bytes, value):
+        """Writes the low `num_bytes` bytes of `value`, little-endian."""
+        region = self._last_region
+        if region is None or address < region.start or address + num_bytes > region.end:
+            self._check(address, num_bytes)
+        offset = address & PAGE_MASK
+        pack_into = _PACK_INTO.get(num_bytes)
+        if pack_into is not None and offset + num_bytes <= PAGE_SIZE:
+            page = self.pages.get(address >> PAGE_SHIFT)
+            if page is None:
+                page = self.pages[address >> PAGE_SHIFT] = bytearray(PAGE_SIZE)
+            try:
+                pack_into(page, offset, value & _VALUE_MASK[num_bytes])
+            except TypeError:
+                # A read-only page shared with a snapshot or image: copy on write
+                page = self.pages[address >> PAGE_SHIFT] = bytearray(page)
+                pack_into(page, offset, value & _VALUE_MASK[num_bytes])
+        else:
+            mask = (1 << (num_bytes * 8)) - 1
+            self.poke(address, (value & mask).to_bytes(num_bytes, 'little'))
+
+    def read_block(self, address, size):
+        """Reads `size` bytes as one bulk copy; the range must lie in one region."""
+        self._check(address, size)
+        return self.peek(address, size)
+
+    def write_block(self, address, data):
+        """Writes `data` as one bulk copy; the range must lie in one region."""
+        self._check(address, len(data))
+        self.poke(address, data)
+
+    # --- Unchecked Access (dumps, loaders) ---
+    def peek(self, address, size):
+        """Returns `size` bytes from `address` without region checks."""
+        out = bytearray(size)
+        view = memoryview(out)
+        pos = 0
+        while pos < size:
+            offset = address & PAGE_MASK
+            chunk = min(size - pos, PAGE_SIZE - offset)
+            page = self.pages.get(address >> PAGE_SHIFT)
+            if page is not None:
+                view[pos:pos + chunk] = memoryview(page)[offset:offset + chunk]
+            address += chunk
+            pos += chunk
+        return bytes(out)
+
+    def poke(self, address, data):
+        """Copies `data` to `address` without region checks, allocating pages."""
+        data = memoryview(data).cast('B')
+        pos = 0
+        while pos < len(data):
+            offset = address & PAGE_MASK
+            chunk = min(len(data) - pos, PAGE_SIZE - offset)
+            page = self.pages.get(address >> PAGE_SHIFT)
+            if page is None:
+                page = self.pages[address >> PAGE_SHIFT] = bytearray(PAGE_SIZE)
+            try:
+                page[offset:offset + chunk] = data[pos:pos + chunk]
+            except TypeError:
+                # A read-only page shared with a snapshot or image: copy on write
+                page = self.pages[address >> PAGE_SHIFT] = bytearray(page)
+                page[offset:offset + chunk] = data[pos:pos + chunk]
+            address += chunk
+            pos += chunk
+
+    # --- Snapshots ---
+    def snapshot(self):
+        """Returns a copy-on-write snapshot of every page for restore()."""
+        pages = self.pages
+        for number, page in pages.items():
+            if type(page) is bytearray:
+                pages[number] = bytes(page)
+        return dict(pages)
+
+    def restore(self, snapshot):
+        """Puts memory back to the state a snapshot() captured; the snapshot stays usable."""
+        self.pages = dict(snapshot)
+
+    @property
+    def resident_bytes(self):
+        """Host memory held by allocated pages."""
+        return len(self.pages) * PAGE_SIZE
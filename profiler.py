@@ -0,0 +1,130 @@
+"""
+Per-PC execution profiler for the ARM64 emulators.
+
+A Profiler keeps flat lists indexed by instruction number (execution
+counts, host time in nanoseconds, taken and not-taken branch counts). The
+lists are allocated once per program in reset(), so recording an
+instruction is a few list updates. Per-mnemonic and per-handler totals
+are derived from those lists when a report is built, not while the
+program runs.
+
+Attach one to an emulator before running:
+
+    emulator.profiler = Profiler()
+    emulator.run(program, verbosity='silent')   # Rough.Emulator: execute()
+    print(emulator.profiler.report())
+    emulator.profiler.write_collapsed('prof.folded')
+
+The collapsed-stack file has one "frame;frame;frame count" line per
+instruction (program, enclosing label, instruction), the input format of
+flamegraph.pl, speedscope and inferno.
+"""
+
+import bisect
+
+
+class Profiler:
+    """Execution counts, branch outcomes and host time per instruction."""
+    def __init__(self, name='program'):
+        self.name = name
+        self.reset([], [], [])
+
+    def reset(self, texts, handlers, branches, labels=None):
+        """
+        Prepares for a program of len(texts) instruction slots. `handlers`
+        names the handler of each slot, `branches` flags the branch slots and
+        `labels` maps label names to byte addresses (slot * 4).
+        """
+        n = len(texts)
+        self.texts = list(texts)
+        self.handlers = list(handlers)
+        self.is_branch = [bool(b) for b in branches]
+        ordered = sorted((pc, name) for name, pc in (labels or {}).items())
+        self.label_pcs = [pc for pc, _ in ordered]
+        self.label_names = [name for _, name in ordered]
+        self.counts = [0] * n
+        self.times = [0] * n        # host nanoseconds
+        self.taken = [0] * n
+        self.not_taken = [0] * n
+
+    # --- Totals ---
+    @property
+    def total_instructions(self):
+        return sum(self.counts)
+
+    @property
+    def total_time(self):
+        """Host seconds spent inside instruction handlers."""
+        return sum(self.times) / 1e9
+
+    def hot_spots(self, top=20):
+        """(slot, count, host ns, text) of the most executed instructions."""
+        ranked = sorted((i for i, c in enumerate(self.counts) if c),
+                        key=lambda i: (-self.counts[i], i))
+        return [(i, self.counts[i], self.times[i], self.texts[i]) for i in ranked[:top]]
+
+    def mnemonic_counts(self):
+        totals = {}
+        for text, count in zip(self.texts, self.counts):
+            if count:
+                mnemonic = text.split(maxsplit=1)[0].upper() if text.strip() else '?'
+                totals[mnemonic] = totals.get(mnemonic, 0) + count
+        return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+    def handler_times(self):
+        """Handler name -> (calls, host ns)."""
+        totals = {}
+        for name, count, ns in zip(self.handlers, self.counts, self.times):
+            if count:
+                calls, total = totals.get(name, (0, 0))
+                totals[name] = (calls + count, total + ns)
+        return dict(sorted(totals.items(), key=lambda item: -item[1][1]))
+
+    def branch_stats(self):
+        """(slot, taken, not taken, text) for every branch that executed."""
+        return [(i, self.taken[i], self.not_taken[i], self.texts[i])
+                for i, is_branch in enumerate(self.is_branch)
+                if is_branch and self.counts[i]]
+
+    def label_at(self, slot):
+        """Name of the closest label at or before `slot`."""
+        i = bisect.bisect_right(self.label_pcs, slot * 4) - 1
+        return self.label_names[i] if i >= 0 else '<entry>'
+
+    # --- Reports ---
+    def report(self, top=20):
+        total = self.total_instructions or 1
+        lines = [f"Profile of {self.name}: {self.total_instructions} instructions, "
+                 f"{self.total_time * 1e3:.3f} ms in handlers", "",
+                 "Hot spots:",
+                 f"  {'pc':>8}  {'count':>10}  {'%':>6}  {'host us':>10}  instruction"]
+        for slot, count, ns, text in self.hot_spots(top):
+            lines.append(f"  {slot * 4:#8x}  {count:>10}  {100 * count / total:>6.2f}  "
+                         f"{ns / 1e3:>10.1f}  {text}")
+        lines += ["", "Mnemonics:"]
+        for mnemonic, count in self.mnemonic_counts().items():
+            lines.append(f"  {mnemonic:<8}  {count:>10}  {100 * count / total:>6.2f}%")
+        branches = self.branch_stats()
+        if branches:
+            lines += ["", "Branches:", f"  {'pc':>8}  {'taken':>10}  {'not taken':>10}  instruction"]
+            for slot, taken, not_taken, text in branches:
+                lines.append(f"  {slot * 4:#8x}  {taken:>10}  {not_taken:>10}  {text}")
+        lines += ["", "Handlers:", f"  {'handler':<20}  {'calls':>10}  {'host us':>10}  {'ns/call':>8}"]
+        for name, (calls, ns) in self.handler_times().items():
+            lines.append(f"  {name:<20}  {calls:>10}  {ns / 1e3:>10.1f}  {ns / calls:>8.0f}")
+        return '\n'.join(lines) + '\n'
+
+    def collapsed_stacks(self, weight='count'):
+        """Collapsed-stack lines weighted by execution 'count' or host 'time' (ns)."""
+        values = self.counts if weight == 'count' else self.times
+        lines = []
+        for slot, value in enumerate(values):
+            if value and self.counts[slot]:
+                frame = f"{slot * 4:#x} {self.texts[slot]}".replace(';', ',')
+                lines.append(f"{self.name};{self.label_at(slot)};{frame} {value}")
+        return lines
+
+    def write_collapsed(self, path, weight='count'):
+        with open(path, 'w') as f:
+            for line in self.collapsed_stacks(weight):
+                f.write(line + '\n')
@@ -0,0 +1,118 @@
+"""
+On-disk cache of decoded programs for the ARM64 emulators.
+
+Parsing a .s file (comment stripping, regex operand splitting, label
+resolution) is a real share of a short run, and batch jobs run the same
+files over and over. Each emulator turns its decoded program into plain
+data (tuples, dicts, strings, ints) and stores it here with marshal. The
+key is a SHA-256 of the emulator's name, its decoder version, the Python
+version (marshal's format is not stable across releases) and the program
+text, so editing the source or bumping the decoder version misses the
+cache and the file is simply parsed again.
+
+Cache files are written atomically. A missing, truncated or corrupt entry
+reads as a miss, and failures to write are ignored: the cache only ever
+saves time, it never changes the result of a run.
+"""
+
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+# Set this to choose where cache files live
+CACHE_DIR_ENV = 'ARM64EMU_CACHE_DIR'
+
+# Bump when the entry layout below changes
+FORMAT_VERSION = 1
+MAGIC = b'A64C'
+
+
+def default_cache_dir():
+    """$ARM64EMU_CACHE_DIR, else ~/.cache/arm64emu."""
+    directory = os.environ.get(CACHE_DIR_ENV)
+    if directory:
+        return directory
+    return os.path.join(os.path.expanduser('~'), '.cache', 'arm64emu')
+
+
+class ProgramCache:
+    """A directory of marshalled decoded programs, one file per key."""
+    def __init__(self, directory=None):
+        self.directory = directory or default_cache_dir()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, namespace, version, text):
+        """Cache key for `text` decoded by emulator `namespace` at decoder `version`."""
+        h = hashlib.sha256()
+        for part in (namespace, str(version), '%d.%d' % sys.version_info[:2]):
+            h.update(part.encode() + b'\0')
+        h.update(text.encode('utf-8', 'surrogatepass'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.bin')
+
+    def load(self, key):
+        """Returns the stored value, or None on a miss."""
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        header = MAGIC + bytes([FORMAT_VERSION])
+        if not data.startswith(header):
+            self.misses += 1
+            return None
+        try:
+            value = marshal.loads(data[len(header):])
+        except (EOFError, ValueError, TypeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def store(self, key, value):
+        """Stores `value`. Returns False if it could not be written."""
+        try:
+            payload = marshal.dumps(value)
+        except ValueError:
+            return False  # holds something marshal can't represent
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(MAGIC + bytes([FORMAT_VERSION]) + payload)
+                os.replace(tmp, self.path(key))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError:
+            return False
+        return True
+
+    def get_or_build(self, namespace, version, text, build):
+        """Returns the cached value for `text`, calling build() and storing it on a miss."""
+        key = self.key(namespace, version, text)
+        value = self.load(key)
+        if value is None:
+            value = build()
+            self.store(key, value)
+        return value
+
+    def clear(self):
+        """Removes every cache file in the directory."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith('.bin'):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
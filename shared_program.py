@@ -0,0 +1,213 @@
+"""
+Shared-memory programs and memory images for emulator worker pools.
+
+Fanning jobs out to worker processes normally pickles each job's program
+to its worker, and every worker parses it again. A SharedProgram decodes
+a program once, in the parent, and stores its plain-data form (see
+ARM64Emulator.pack_program) in a multiprocessing.shared_memory segment.
+Jobs then carry only the segment's handle. A worker attaches once,
+unmarshals the records once, and binds them to each job's emulator with
+unpack_program().
+
+A SharedImage holds memory pages (a stack or data region prepared in
+advance) in a segment. map_into() installs read-only memoryviews of them
+as the pages of a PagedMemory, so no bytes are copied when a job starts.
+A job that writes to a page gets its own copy on the first write, just
+like a page shared with a snapshot, and untouched pages stay shared by
+every worker. SharedPages is the writable variant: processes that map it
+all see each other's stores, which is how multicore.py runs cores in
+parallel over one memory.
+
+The process that create()s a segment owns it and must unlink() it once
+the workers are done; workers attach() with the handle. Memories that map
+an image hold views of its segment, so drop them before close():
+
+    program = SharedProgram.create(ARM64Emulator(), lines)
+    image = SharedImage.create(setup_emulator.memory.pages)
+    ... jobs carry program.handle and image.handle ...
+    # in a worker:
+    emulator = ARM64Emulator()
+    decoded = SharedProgram.attach(handle).decode_into(emulator)
+    SharedImage.attach(image_handle).map_into(emulator.memory)
+    emulator.run_decoded_budgeted(decoded, max_instructions)
+"""
+
+import marshal
+import struct
+from multiprocessing import shared_memory
+
+from paged_memory import PAGE_SHIFT, PAGE_SIZE
+
+# Image segment header: page count, then one page number per page
+_COUNT = struct.Struct('<Q')
+
+# Segments already attached in this process, by handle
+_attached = {}
+
+
+def _open(name):
+    """Attaches to an existing segment without handing it to the resource tracker (3.13+)."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class _Segment:
+    """A shared-memory segment, owned (created here) or attached."""
+    def __init__(self, segment, owner):
+        self.segment = segment
+        self.owner = owner
+
+    @classmethod
+    def attach(cls, handle):
+        """The object for `handle`, attached once per process."""
+        attached = _attached.get(handle)
+        if attached is None:
+            attached = _attached[handle] = cls._from_handle(handle)
+        return attached
+
+    def close(self):
+        _attached.pop(self.handle, None)
+        self._release()
+        self.segment.close()
+
+    def unlink(self):
+        """Closes the segment and, in the owner, removes it."""
+        self.close()
+        if self.owner:
+            self.segment.unlink()
+
+    def _release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.unlink()
+
+
+class SharedProgram(_Segment):
+    """A decoded program, in pack_program() form, in a shared-memory segment."""
+    def __init__(self, segment, size, owner=False):
+        super().__init__(segment, owner)
+        self.size = size
+        self._entry = None
+
+    @classmethod
+    def create(cls, emulator, program):
+        """
+        Decodes `program` (a list of lines) with `emulator` and shares it.
+        Raises ValueError if a record has no plain-data form (a decode error
+        of a non-builtin exception type).
+        """
+        entry = emulator.pack_program(emulator.decode(program))
+        if entry is None:
+            raise ValueError("program has a record that can't be shared")
+        data = marshal.dumps(entry)
+        segment = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        segment.buf[:len(data)] = data
+        return cls(segment, len(data), owner=True)
+
+    @classmethod
+    def _from_handle(cls, handle):
+        name, size = handle
+        return cls(_open(name), size)
+
+    @property
+    def handle(self):
+        """Picklable (name, size) to attach() with."""
+        return self.segment.name, self.size
+
+    def decode_into(self, emulator):
+        """The program's decoded records, bound to `emulator` (whose labels it sets)."""
+        if self._entry is None:
+            self._entry = marshal.loads(self.segment.buf[:self.size])
+        return emulator.unpack_program(self._entry)
+
+
+class SharedImage(_Segment):
+    """Memory pages in a shared-memory segment, mapped copy-on-write into PagedMemory."""
+    writable = False
+
+    def __init__(self, segment, owner=False):
+        super().__init__(segment, owner)
+        view = segment.buf
+        count = _COUNT.unpack_from(view)[0]
+        self.page_numbers = struct.unpack_from(f'<{count}Q', view, _COUNT.size)
+        self._data_start = self._data_offset(count)
+        self._view = view if self.writable else view.toreadonly()
+
+    @staticmethod
+    def _data_offset(count):
+        # Pages start on a page boundary after the header
+        header = _COUNT.size + 8 * count
+        return -(-header // PAGE_SIZE) * PAGE_SIZE
+
+    @classmethod
+    def create(cls, pages):
+        """Shares `pages` (page number -> page contents, e.g. PagedMemory.pages); all-zero pages are left out."""
+        return cls._create(sorted(number for number, page in pages.items() if any(page)), pages)
+
+    @classmethod
+    def _create(cls, numbers, pages):
+        start = cls._data_offset(len(numbers))
+        segment = shared_memory.SharedMemory(create=True, size=start + len(numbers) * PAGE_SIZE)
+        _COUNT.pack_into(segment.buf, 0, len(numbers))
+        struct.pack_into(f'<{len(numbers)}Q', segment.buf, _COUNT.size, *numbers)
+        for i, number in enumerate(numbers):
+            if number in pages:
+                offset = start + i * PAGE_SIZE
+                segment.buf[offset:offset + PAGE_SIZE] = pages[number]
+        return cls(segment, owner=True)
+
+    @classmethod
+    def _from_handle(cls, handle):
+        return cls(_open(handle))
+
+    @property
+    def handle(self):
+        """Picklable segment name to attach() with."""
+        return self.segment.name
+
+    def map_into(self, memory):
+        """Installs the image's pages in PagedMemory `memory`, replacing any it has at those numbers."""
+        view = self._view
+        offset = self._data_start
+        pages = memory.pages
+        for number in self.page_numbers:
+            pages[number] = view[offset:offset + PAGE_SIZE]
+            offset += PAGE_SIZE
+
+    def _release(self):
+        self._view.release()
+
+
+class SharedPages(SharedImage):
+    """
+    Every page of a PagedMemory's regions in a segment that each process
+    maps writable, so stores from any of them are seen by all (multicore.py).
+    """
+    writable = True
+
+    @classmethod
+    def create(cls, memory):
+        """Shares every page that `memory`'s regions touch, with their current contents."""
+        numbers = sorted({number for region in memory.regions
+                          for number in range(region.start >> PAGE_SHIFT, ((region.end - 1) >> PAGE_SHIFT) + 1)})
+        return cls._create(numbers, memory.pages)
+
+    def copy_into(self, memory):
+        """Replaces `memory`'s pages with private copies of the shared ones (all-zero pages dropped)."""
+        view = self._view
+        offset = self._data_start
+        pages = memory.pages
+        for number in self.page_numbers:
+            page = view[offset:offset + PAGE_SIZE]
+            if any(page):
+                pages[number] = bytearray(page)
+            else:
+                pages.pop(number, None)
+            page.release()
+            offset += PAGE_SIZE
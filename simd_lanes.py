@@ -0,0 +1,261 @@
+"""
+Lockstep "SIMD lanes" execution of one program over many inputs.
+
+LaneEmulator runs the same program once per lane, all lanes at the same
+time: every register is a NumPy uint64 array with one element per lane,
+each ALU op is a single array op, and every lane has its own stack. The
+program is decoded by ARM64Emulator and lowered to the block translator's
+IR, so the two engines share one decoder.
+
+Lanes that branch differently simply end up at different PCs. Each step
+picks the lowest PC that any live lane is at and runs that instruction
+under a lane mask, so lanes run apart after a divergent branch and run
+together again once their PCs meet. Per lane, the final registers, flags,
+stack, PC, instruction count and halt reason are bit-identical to a
+scalar ARM64Emulator.run() with the same initial registers. Errors that
+the scalar emulator raises (a bad memory access, an undefined label, an
+unknown instruction) stop only the lanes that hit them.
+
+Only the stack region is modelled. NumPy is optional for the rest of the
+repo, so it is imported here and LaneEmulator raises ImportError when it
+is missing.
+
+Usage:
+    lanes = LaneEmulator(10000)
+    lanes.set_register('X0', range(10000))
+    lanes.run(program_lines)
+    lanes.register('X0')          # uint64 array, one value per lane
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from emulator import (ARM64Emulator, INSTRUCTION_LIMIT, MASK64, NUM_REG_SLOTS,
+                      REG_SP, REG_TABLE, SIGN64)
+
+# Lane status codes (LaneEmulator.status) and their names, which match the
+# halt reasons returned by ARM64Emulator.run_budgeted
+RUNNING, RET, PC_OUT_OF_BOUNDS, LIMIT_REACHED, ERROR = range(5)
+STATUS_NAMES = ('running', 'ret', 'pc_out_of_bounds', 'instruction_limit', 'error')
+
+# ALU symbol -> NumPy ufunc name; uint64 arrays wrap modulo 2**64 like the
+# scalar emulator's masked Python ints
+_ALU_UFUNCS = {'+': 'add', '-': 'subtract', '*': 'multiply',
+               '&': 'bitwise_and', '^': 'bitwise_xor'}
+
+
+class LaneEmulator:
+    """Runs one program on `num_lanes` independent register files and stacks."""
+    def __init__(self, num_lanes, stack_size=256):
+        if np is None:
+            raise ImportError("simd_lanes needs NumPy: pip install numpy")
+        self.num_lanes = num_lanes
+        self.stack_size = stack_size
+        self._decoder = ARM64Emulator(stack_size=stack_size)
+        self.stack_base_addr = self._decoder.stack_base_addr
+
+        self.regs = np.zeros((NUM_REG_SLOTS, num_lanes), dtype=np.uint64)
+        self.regs[REG_SP] = self.stack_base_addr + stack_size
+        self.flag_result = np.zeros(num_lanes, dtype=np.uint64)
+        self.pc = np.zeros(num_lanes, dtype=np.int64)
+        self.instruction_count = np.zeros(num_lanes, dtype=np.int64)
+        self.status = np.full(num_lanes, RUNNING, dtype=np.int8)
+        self.errors = {}   # lane -> exception the scalar emulator would raise
+        self.stack = np.zeros((num_lanes, stack_size), dtype=np.uint8)
+        self._lanes = np.arange(num_lanes)
+        self._ufuncs = {sym: getattr(np, name) for sym, name in _ALU_UFUNCS.items()}
+
+    # --- Per-Lane Registers ---
+    def set_register(self, name, values):
+        """Sets register `name` to `values` (one per lane, or a scalar for all)."""
+        index, mask = self._decoder._decode_dest(name)
+        if np.isscalar(values):
+            self.regs[index] = int(values) & mask
+        elif isinstance(values, np.ndarray) and values.dtype.kind in 'iu':
+            self.regs[index] = values.astype(np.uint64) & np.uint64(mask)
+        else:
+            self.regs[index] = np.array([int(v) & mask for v in values], dtype=np.uint64)
+
+    def register(self, name):
+        """Returns register `name` for every lane as a uint64 array."""
+        index, mask = REG_TABLE[name]
+        return self.regs[index] & np.uint64(mask)
+
+    @property
+    def n_flag(self):
+        return (self.flag_result >= np.uint64(SIGN64)).astype(np.uint8)
+
+    @property
+    def z_flag(self):
+        return (self.flag_result == 0).astype(np.uint8)
+
+    def status_names(self):
+        return [STATUS_NAMES[s] for s in self.status]
+
+    # --- Execution ---
+    def run(self, program, max_instructions=INSTRUCTION_LIMIT):
+        """Runs every lane until it returns, leaves the program, faults or hits the limit."""
+        decoded = self._decoder.decode(program)
+        ir = [self._decoder._lower_record(record) for record in decoded]
+        end_pc = len(ir) * 4
+        with np.errstate(over='ignore'):
+            self._run_lanes(ir, end_pc, max_instructions)
+
+    def _run_lanes(self, ir, end_pc, max_instructions):
+        pc, status = self.pc, self.status
+        while True:
+            live = status == RUNNING
+            if not live.any():
+                break
+            out = live & ((pc < 0) | (pc >= end_pc))
+            if out.any():
+                status[out] = PC_OUT_OF_BOUNDS
+                continue
+            at = int(pc[live].min())
+            mask = live & (pc == at)
+            entry = ir[at // 4]
+            if entry is None:
+                pc[mask] += 4
+                continue
+
+            mask = self._execute(entry, mask, at)
+            count = self.instruction_count
+            count[mask] += 1
+            status[mask & (count > max_instructions) & (status == RUNNING)] = LIMIT_REACHED
+            pc[mask] += 4
+
+    def _src(self, operand):
+        if operand[0] == 'imm':
+            return np.uint64(operand[1] & MASK64)
+        _, index, mask = operand
+        value = self.regs[index]
+        return value if mask == MASK64 else value & np.uint64(mask)
+
+    def _write(self, dst, value, mask, full):
+        if dst is None:
+            return
+        index, dmask = dst
+        if dmask != MASK64:
+            value = value & np.uint64(dmask)
+        if full:
+            self.regs[index] = value
+        else:
+            self.regs[index] = np.where(mask, value, self.regs[index])
+
+    def _execute(self, entry, mask, pc):
+        """Executes one IR entry on the lanes in `mask`; returns the lanes that completed it."""
+        full = mask.all()
+        op = entry[0]
+        if op == 'alu':
+            _, sym, dst, src1, src2, _ = entry
+            result = self._ufuncs[sym](self._src(src1), self._src(src2))
+            result = np.broadcast_to(result, (self.num_lanes,))
+            self._set_flags(result, mask, full)
+            self._write(dst, result, mask, full)
+        elif op == 'mov':
+            _, dst, src = entry
+            value = np.broadcast_to(self._src(src), (self.num_lanes,))
+            self._write(dst, value, mask, full)
+        elif op == 'cmp':
+            _, src1, src2 = entry
+            result = np.subtract(self._src(src1), self._src(src2))
+            self._set_flags(np.broadcast_to(result, (self.num_lanes,)), mask, full)
+        elif op in ('load', 'store'):
+            return self._memory_op(entry, mask)
+        elif op == 'b':
+            _, cond, target, label = entry
+            if cond is None:
+                taken = mask
+            else:
+                gt = (self.flag_result != 0) & (self.flag_result < np.uint64(SIGN64))
+                taken = mask & (gt if cond == 'GT' else ~gt)
+            if target is None:
+                if taken.any():
+                    self._fail(taken, ValueError(f"Undefined label: {label}"))
+                return mask & ~taken
+            self.pc[taken] = target - 4
+        elif op == 'ret':
+            self.status[mask] = RET
+        elif op == 'call':
+            # Only deferred decode errors are left for the interpreter
+            try:
+                entry[1](*entry[2])
+            except Exception as e:
+                self._fail(mask, e)
+                return mask & False
+        return mask
+
+    def _set_flags(self, result, mask, full):
+        if full:
+            self.flag_result = result.copy()
+        else:
+            self.flag_result = np.where(mask, result, self.flag_result)
+
+    def _memory_op(self, entry, mask):
+        op, reg, base, offset, num_bytes = entry
+        start = self.stack_base_addr
+        address = self._src(base)
+        # In range when start <= address + offset <= end - num_bytes
+        low = start - offset
+        high = start + self.stack_size - num_bytes - offset
+        if high < 0 or low > MASK64:
+            ok = mask & False
+        else:
+            ok = (mask & (address >= np.uint64(max(low, 0)))
+                  & (address <= np.uint64(min(high, MASK64))))
+        bad = mask & ~ok
+        for lane in np.nonzero(bad)[0]:
+            self._fail_lane(lane, self._memory_error(int(address[lane]) + offset, num_bytes))
+
+        lanes = self._lanes[ok]
+        if len(lanes):
+            # Exact for in-range lanes even though the uint64 arithmetic wraps
+            index = (address[ok] + np.uint64(offset & MASK64) - np.uint64(start)).astype(np.int64)
+            columns = index[:, None] + np.arange(num_bytes)
+            if op == 'store':
+                value = self._src(reg)
+                value = np.broadcast_to(value, (self.num_lanes,))[ok]
+                data = value.astype('<u8').view(np.uint8).reshape(-1, 8)[:, :num_bytes]
+                self.stack[lanes[:, None], columns] = data
+            else:
+                data = np.zeros((len(lanes), 8), dtype=np.uint8)
+                data[:, :num_bytes] = self.stack[lanes[:, None], columns]
+                value = data.view('<u8').reshape(-1).astype(np.uint64)
+                if reg is not None:
+                    index, dmask = reg
+                    if dmask != MASK64:
+                        value &= np.uint64(dmask)
+                    self.regs[index, lanes] = value
+        return ok
+
+    def _memory_error(self, address, num_bytes):
+        # Same messages as PagedMemory
+        start, end = self.stack_base_addr, self.stack_base_addr + self.stack_size
+        if start <= address < end:
+            return MemoryError(f"Memory access out of bounds at address {address:#x}")
+        return MemoryError(f"Memory access violation at address {address:#x}")
+
+    def _fail(self, mask, error):
+        for lane in np.nonzero(mask)[0]:
+            self._fail_lane(lane, error)
+
+    def _fail_lane(self, lane, error):
+        self.status[lane] = ERROR
+        self.errors[int(lane)] = error
+
+    # --- Per-Lane Results ---
+    def lane_state(self, lane):
+        """Final state of one lane in plain Python ints, for comparing with ARM64Emulator."""
+        return {
+            'registers': {f'X{i}': int(self.regs[i, lane]) for i in range(31)} |
+                         {'SP': int(self.regs[REG_SP, lane])},
+            'n_flag': int(self.n_flag[lane]),
+            'z_flag': int(self.z_flag[lane]),
+            'pc': int(self.pc[lane]),
+            'instruction_count': int(self.instruction_count[lane]),
+            'status': STATUS_NAMES[self.status[lane]],
+            'error': self.errors.get(int(lane)),
+            'stack': self.stack[lane].tobytes(),
+        }